@@ -1,6 +1,7 @@
 from __future__ import annotations
-from css_parser import CSSOM
+from css_parser import CSSOM, Compound, Selector, BLOOM_FILTER_BITS, bloom_filter_bits
 from html_parser import DOMNode
+from budget import Budget
 import re
 from css_properties import *
 
@@ -49,20 +50,88 @@ def inherit_style(node: DOMNode):
             node.styles[prop] = node.parent.styles[prop]
 
 
-def compute_style(node: DOMNode, cssom: CSSOM):
-    # CSS Specificity and Cascade (partly)
-    # apply universal styles
-    node.styles.update(cssom.universal_rule.declarations)
-    # override with tag styles
-    if node.tag in cssom.tag_rules:
-        node.styles.update(cssom.tag_rules[node.tag].declarations)
-    # override with class styles
+class AncestorFilter:
+    # Counting Bloom filter of the keys (tag, `#id` and `.class`) of the ancestors of the node being styled,
+    # used to quickly reject selectors needing ancestors that are not present (like browsers do)
+    # Note: it can have false positives (selector is then matched fully) but never false negatives
+    # The set bits are kept as an integer, so that a selector is checked with a single `&` of its mask
+    def __init__(self):
+        self.counts = [0] * BLOOM_FILTER_BITS
+        self.bits = 0
+
+    def add(self, keys: [str]):
+        for key in keys:
+            for bit in bloom_filter_bits(key):
+                if not self.counts[bit]:
+                    self.bits |= 1 << bit
+                self.counts[bit] += 1
+
+    def remove(self, keys: [str]):
+        for key in keys:
+            for bit in bloom_filter_bits(key):
+                self.counts[bit] -= 1
+                if not self.counts[bit]:
+                    self.bits &= ~(1 << bit)
+
+
+def node_keys(node: DOMNode):
+    # keys of the node as used by the ancestor filter
+    keys = [f'.{class_name}' for class_name in node.classes]
+    if node.id:
+        keys.append(f'#{node.id}')
+    keys.append(node.tag)
+    return keys
+
+
+def match_compound(compound: Compound, node: DOMNode):
+    return (compound.tag is None or compound.tag == node.tag) and \
+        (compound.id is None or compound.id == node.id) and \
+        all(class_name in node.classes for class_name in compound.classes)
+
+
+def match_selector(selector: Selector, node: DOMNode, index=None):
+    # Matches the selector from right to left, starting with the node for the rightmost compound
+    # For descendant combinator, backtracks to farther ancestors if the nearer ones do not lead to a match
+    if index is None:
+        index = len(selector.compounds) - 1
+    if not match_compound(selector.compounds[index], node):
+        return False
+    if index == 0:
+        return True
+    ancestor = node.parent
+    if selector.combinators[index - 1] == '>':
+        return ancestor is not None and match_selector(selector, ancestor, index - 1)
+    while ancestor is not None:
+        if match_selector(selector, ancestor, index - 1):
+            return True
+        ancestor = ancestor.parent
+    return False
+
+
+def matching_rules(node: DOMNode, cssom: CSSOM, ancestor_filter: AncestorFilter = None):
+    # Returns the rules matching the node in cascade order
+    # Only the buckets of rules whose rightmost compound can match the node are looked up
+    candidates = cssom.universal_rules + cssom.tag_rules.get(node.tag, [])
     for class_name in node.classes:
-        if f'.{class_name}' in cssom.class_rules:
-            node.styles.update(cssom.class_rules[f'.{class_name}'].declarations)
-    # finally override with id styles
-    if f'#{node.id}' in cssom.id_rules:
-        node.styles.update(cssom.id_rules[f'#{node.id}'].declarations)
+        candidates += cssom.class_rules.get(class_name, [])
+    if node.id:
+        candidates += cssom.id_rules.get(node.id, [])
+
+    # Selectors needing ancestors which are definitely not present are rejected without matching
+    bits = ancestor_filter.bits if ancestor_filter else -1  # all bits set when not filtering
+    rules = [rule for rule in candidates
+             if rule.selector.ancestor_mask & bits == rule.selector.ancestor_mask
+             and match_selector(rule.selector, node)]
+    # CSS Specificity and Cascade - more specific rules override less specific ones,
+    # and rules of same specificity defined later override the earlier ones
+    rules.sort(key=lambda rule: (rule.selector.specificity, rule.order))
+    return rules
+
+
+def compute_style(node: DOMNode, cssom: CSSOM, ancestor_filter: AncestorFilter = None):
+    # CSS Specificity and Cascade (partly)
+    for rule in matching_rules(node, cssom, ancestor_filter):
+        node.styles.update(rule.declarations)
 
     # Filter out supported styles
     node.styles = parse_style(node.styles)
@@ -82,12 +151,25 @@ def compute_style(node: DOMNode, cssom: CSSOM):
     inherit_style(node)
 
 
-def attach_styles(dom: DOMNode, cssom: CSSOM):
+def attach_styles(dom: DOMNode, cssom: CSSOM, budget: Budget = None):
     # Takes DOM and CSSOM and computes styles for each of the dom node.
-    nodes = [dom]
-    while nodes:  # Breadth First Traversal
-        node = nodes.pop(0)
-        compute_style(node, cssom)  # Compute parent's style before children
-        for child_node in node.children:
+    # The ancestor filter contains the keys of the ancestors of the node being styled
+    # Raises BudgetExceeded when it runs out of the time of `budget`
+    if budget is not None:
+        budget.start('style')
+    ancestor_filter = AncestorFilter()
+    nodes = [(dom, None)]  # (node, keys), keys are set once the node has been styled
+    while nodes:  # Depth First Traversal
+        node, keys = nodes.pop()
+        if keys is not None:  # leaving the node, after all its descendants are styled
+            ancestor_filter.remove(keys)
+            continue
+        if budget is not None:
+            budget.tick()
+        compute_style(node, cssom, ancestor_filter)  # Compute parent's style before children
+        keys = node_keys(node)
+        ancestor_filter.add(keys)
+        nodes.append((node, keys))
+        for child_node in reversed(node.children):
             if isinstance(child_node, DOMNode):
-                nodes.append(child_node)
+                nodes.append((child_node, None))
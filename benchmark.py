@@ -0,0 +1,824 @@
+import argparse
+import io
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+import css_parser
+import attachment
+import user_agent
+from html_parser import DOMNode, TextNode
+from utils import Diagnostics
+
+
+def timed(function, *args, **kwargs):
+    # Returns the result of the function and the (wall) time it took in seconds
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def generate_stylesheet(num_rules: int):
+    # Stylesheet with a mixture of tag, class and id rules, with comments in between
+    rules = []
+    for i in range(num_rules):
+        selector = ['div', f'.class-{i}', f'#id-{i}'][i % 3]
+        rules.append(f'/* rule {i} */\n{selector} {{\n    margin-top: {i % 50}px;\n    width: {i % 100}%;\n'
+                     f'    color: #{i % 0xffffff:06x};\n    display: block;\n}}\n')
+    return ''.join(rules)
+
+
+def generate_malformed_stylesheet(size: int):
+    # Stylesheet which made the old regex based parser backtrack (rules which never close
+    # properly) along with stray text which was reported character by character
+    chunk = 'div { margin-top: 10px; margin-left: 10px; width 10px color: red; ; } junk ; ' \
+            '.a { color: #ffffff; padding-top: 1px 2px; } ~~~ '
+    return chunk * (size // len(chunk) + 1)
+
+
+def benchmark_css(sizes):
+    print('CSS Parser')
+    for num_rules in sizes:
+        css = generate_stylesheet(num_rules)
+        cssom, duration = timed(css_parser.parse, css)
+        num_selectors = len(cssom.tag_rules) + len(cssom.class_rules) + len(cssom.id_rules)
+        print(f'  {len(css) / 1e6:7.2f} MB {num_rules:8} rules {num_selectors:8} selectors '
+              f'{duration:7.3f} s {len(css) / 1e6 / duration:6.2f} MB/s')
+    for num_rules in sizes:
+        css = generate_malformed_stylesheet(num_rules * 100)
+        diagnostics = Diagnostics()
+        _, duration = timed(css_parser.parse, css, None, diagnostics)
+        print(f'  {len(css) / 1e6:7.2f} MB (malformed) {diagnostics.count:8} errors ({len(diagnostics.entries)} kept) '
+              f'{duration:7.3f} s {len(css) / 1e6 / duration:6.2f} MB/s')
+
+
+def benchmark_load(num_files, size):
+    import os
+    import tempfile
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+    import loader
+    print('Loading stylesheets')
+    with tempfile.TemporaryDirectory() as directory:
+        style_sheets = []
+        for i in range(num_files):
+            style_sheets.append(os.path.join(directory, f'style-{i}.css'))
+            with open(style_sheets[-1], 'w') as f_css:
+                f_css.write(generate_stylesheet(size // 100))
+
+        def sequential():
+            cssom = None
+            for style_sheet in style_sheets:
+                with open(style_sheet) as f_css:
+                    cssom = css_parser.parse(f_css.read(), cssom)
+            return cssom
+
+        def concurrent():
+            with ThreadPoolExecutor() as executor:
+                return loader.load_stylesheets(executor, style_sheets).result()
+
+        for load in [sequential, concurrent]:
+            _, duration = timed(load)
+            tracemalloc.start()  # memory is traced separately, tracing slows down parsing
+            load()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'  {load.__name__:10} {num_files:4} files {os.path.getsize(style_sheets[0]) / 1e6:6.2f} MB each '
+                  f'{duration:7.3f} s  peak {peak / 1e6:7.2f} MB')
+
+
+def generate_page(num_nodes: int):
+    # DOM of a page made of repeated cards, each card is 5 nodes (built directly, without parsing)
+    def element(tag, parent, **attributes):
+        node = DOMNode(tag, attributes, token=None)
+        parent.add_child(node)
+        return node
+
+    html = DOMNode('html', {}, token=None)
+    body = element('body', html)
+    container = element('div', body, **{'class': 'list'})
+    for i in range(max(num_nodes // 5, 1)):
+        card = element('div', container, **{'class': f'card card-{i % 1000}', 'id': f'card-{i}'})
+        element('h2', card).add_child(TextNode(f'Card {i}', token=None))
+        paragraph = element('p', card, **{'class': 'text'})
+        paragraph.add_child(TextNode('Some text', token=None))
+        element('span', paragraph, **{'class': f'tag tag-{i % 100}'})
+    return html
+
+
+def generate_selector_stylesheet(num_rules: int):
+    # Stylesheet with compound selectors and descendant and child combinators
+    rules = []
+    for i in range(num_rules):
+        selector = [f'.card-{i % 1000} p', f'.list > .card-{i % 1000}', f'div.card-{i % 1000} span.tag-{i % 100}',
+                    f'#card-{i}', f'body .text .tag-{i}', f'.missing-{i} p'][i % 6]
+        rules.append(f'{selector} {{ margin-top: {i % 50}px; color: #{i % 0xffffff:06x}; }}\n')
+    return ''.join(rules)
+
+
+def benchmark_style(sizes, num_rules):
+    print('Attachment (style computation)')
+    agent_css = open('agent.css').read()
+    cssom = css_parser.parse(generate_selector_stylesheet(num_rules), css_parser.parse(agent_css))
+    for num_nodes in sizes:
+        dom = generate_page(num_nodes)
+        _, duration = timed(attachment.attach_styles, dom, cssom)
+        print(f'  {num_nodes:8} nodes {len(cssom.rules):8} rules {duration:7.3f} s '
+              f'{duration / num_nodes * 1e6:7.2f} us/node')
+
+
+def benchmark_user_agent(repeat):
+    print('User agent stylesheet')
+    with open(user_agent.USER_AGENT_STYLESHEET) as f_css:
+        agent_css = f_css.read()
+    _, duration = timed(lambda: [css_parser.parse(agent_css) for _ in range(repeat)])
+    print(f'  parse per page              {duration / repeat * 1e6:9.1f} us')
+    user_agent._compiled_cssoms.clear()  # force loading from the disk cache
+    _, duration = timed(user_agent.load_user_agent_cssom)
+    print(f'  load compiled (first page)  {duration * 1e6:9.1f} us')
+    _, duration = timed(lambda: [user_agent.load_user_agent_cssom().layer() for _ in range(repeat)])
+    print(f'  layer per page              {duration / repeat * 1e6:9.1f} us')
+
+
+def generate_block_page(num_blocks: int, fan_out=8):
+    # DOM of nested blocks (with a few texts), built directly without parsing
+    html = DOMNode('html', {}, token=None)
+    body = DOMNode('body', {}, token=None)
+    html.add_child(body)
+    parents, count = [body], 1
+    while count < num_blocks:
+        parent = parents.pop(0)
+        for i in range(fan_out):
+            node = DOMNode('div', {'class': f'box box-{count % 7}'}, token=None)
+            parent.add_child(node)
+            parents.append(node)
+            count += 1
+    for leaf in parents[::100]:
+        leaf.add_child(TextNode('Some text', token=None))
+    return html
+
+
+def benchmark_layout(sizes):
+    import renderer
+    import layout
+    import vectorized_layout
+    print('Layout (scalar vs vectorized)')
+    css = '.box { padding-top: 2px; padding-left: 1%; margin-bottom: 1px; border-top-width: 1px; } ' + \
+          ' '.join(f'.box-{i} {{ width: {90 + i}%; margin-left: {i}px; }}' for i in range(7)) + \
+          ' .box-3 { position: relative; top: 2px; } .box-5 { position: absolute; right: 3px; bottom: 1%; }'
+    cssom = css_parser.parse(css, user_agent.load_user_agent_cssom().layer())
+    for num_blocks in sizes:
+        durations = []
+        for construct_layout in [layout.construct_layout, vectorized_layout.construct_layout]:
+            dom = generate_block_page(num_blocks)
+            attachment.attach_styles(dom, cssom)
+            render_tree = renderer.construct_render_tree(dom)
+            _, duration = timed(construct_layout, render_tree, 1000, 600)
+            durations.append(duration)
+        print(f'  {num_blocks:8} blocks  scalar {durations[0]:7.3f} s  vectorized {durations[1]:7.3f} s')
+
+
+def benchmark_progressive_layout(sizes, time_budget):
+    # Frames while the page is laid out progressively, as in the viewer: each frame lays out for `time_budget`
+    # and paints the part laid out so far (the display list is extended by the blocks of the step), and the frames
+    # once the layout is complete (the display list of the page), scrolled through the page
+    import statistics
+    import pygame
+    import renderer
+    import layout
+    import paint
+    print('Progressive layout (time to first paint, and paint time of the frames)')
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = css_parser.parse('.box { padding-top: 2px; margin-bottom: 1px; border-top-width: 1px; }',
+                             user_agent.load_user_agent_cssom().layer())
+    for num_blocks in sizes:
+        dom = generate_block_page(num_blocks)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        start = time.perf_counter()
+        layout_steps = layout.construct_layout_progressively(render_tree, 1000, 600, time_budget)
+        display_list = paint.ProgressiveDisplayList(render_tree)
+        paint_durations, scroll_top, first_paint = [], 0, None
+        while True:
+            completed = next(layout_steps, None) is None
+            paint_start = time.perf_counter()
+            display_list.update()
+            paint.paint_display_list(win, display_list, 0, -scroll_top)
+            paint_durations.append(time.perf_counter() - paint_start)
+            first_paint = first_paint or time.perf_counter() - start
+            scroll_top += 600  # scrolling down while the page is laid out
+            if completed:
+                break
+        complete = time.perf_counter() - start
+        display_list = paint.construct_display_list(render_tree)
+        page_height = display_list.containing_rect.bottom
+        _, indexing = timed(lambda: display_list.tiles)
+        complete_durations = []
+        for i in range(20):
+            complete_durations.append(timed(paint.paint_display_list, win, display_list, 0, -i * page_height // 20)[1])
+        print(f'  {num_blocks:8} blocks  first paint {first_paint:7.3f} s  complete {complete:7.3f} s  '
+              f'({len(paint_durations)} frames)  paint median {statistics.median(paint_durations) * 1000:6.1f} ms  '
+              f'worst {max(paint_durations) * 1000:6.1f} ms  complete page: indexed {indexing:6.3f} s  '
+              f'paint worst {max(complete_durations) * 1000:6.1f} ms')
+
+
+def generate_text_page(num_paragraphs: int, num_words=60):
+    # DOM of paragraphs of text (with inline elements), built directly without parsing
+    html = DOMNode('html', {}, token=None)
+    body = DOMNode('body', {}, token=None)
+    html.add_child(body)
+    for i in range(num_paragraphs):
+        paragraph = DOMNode('p', {}, token=None)
+        body.add_child(paragraph)
+        paragraph.add_child(TextNode(' '.join(f'word{j}' for j in range(i % 7, num_words)), token=None))
+        emphasis = DOMNode('b', {}, token=None)
+        emphasis.add_child(TextNode('bold words', token=None))
+        paragraph.add_child(emphasis)
+    return html
+
+
+def benchmark_lazy_text(sizes):
+    import pygame
+    import renderer
+    import layout
+    print('Lazy text layout (layout of the first screen)')
+    pygame.init()
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_paragraphs in sizes:
+        durations = []
+        for lazy_text in (None, layout.LazyTextLayout(fold=600, margin=600)):
+            dom = generate_text_page(num_paragraphs)
+            attachment.attach_styles(dom, cssom)
+            render_tree = renderer.construct_render_tree(dom)
+            layout.clear_memos()  # laid out again (not replayed from the previous layout)
+            start = time.perf_counter()
+            layout.construct_layout(render_tree, 1000, 600, lazy_text=lazy_text)
+            if lazy_text:
+                lazy_text.realize(0, 600)
+            durations.append(time.perf_counter() - start)
+        print(f'  {num_paragraphs:8} paragraphs  all text {durations[0]:7.3f} s  lazy text {durations[1]:7.3f} s')
+
+
+def benchmark_text(sizes, frames):
+    import tracemalloc
+    import pygame
+    import renderer
+    import layout
+    import paint
+    print('Text (runs of words)')
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_paragraphs in sizes:
+        dom = generate_text_page(num_paragraphs)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.clear_memos()  # laid out again (not replayed from the previous layout)
+        _, duration = timed(layout.construct_layout, render_tree, 1000, 600)
+        # memory of the words and lines (layout again, as the fonts and regular expressions are cached by now)
+        layout.clear_memos()
+        tracemalloc.start()
+        layout.construct_layout(render_tree, 1000, 600)
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lines = [line_object for ro in render_tree.children[0].iter_children()
+                 for line_object in ro.lines_object.children]
+        num_words, num_runs = sum(lo.num_words for lo in lines), sum(len(lo.children) for lo in lines)
+        # Note: paint draws every paragraph, including the ones outside the window
+        _, paint_duration = timed(lambda: [paint.paint_layout(win, render_tree, 0, -i) for i in range(frames)])
+        print(f'  {num_paragraphs:8} paragraphs  layout {duration:7.3f} s  paint {paint_duration / frames:7.3f} s/frame  '
+              f'{num_words} words in {num_runs} runs  {allocated / num_words:5.1f} bytes/word')
+
+
+def benchmark_text_paint(sizes, frames):
+    # Frames scrolling through a text page, with the rendered runs reused (see `paint.RunSurfaces`)
+    # against rendering every run of each frame
+    import pygame
+    import renderer
+    import layout
+    import paint
+    print('Text paint (scrolling frames)')
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_paragraphs in sizes:
+        dom = generate_text_page(num_paragraphs)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)
+        display_list = paint.construct_display_list(render_tree)
+        durations = []
+        for max_pixels in [0, paint.RUN_SURFACES_PIXELS]:
+            paint.run_surfaces = paint.RunSurfaces(max_pixels)
+            _, duration = timed(lambda: [paint.paint_display_list(win, display_list, 0, -i * 10) for i in range(frames)])
+            durations.append(duration / frames)
+        paint.run_surfaces = paint.RunSurfaces(paint.RUN_SURFACES_PIXELS)
+        print(f'  {num_paragraphs:8} paragraphs  render every run {durations[0] * 1000:7.2f} ms/frame  '
+              f'reuse runs {durations[1] * 1000:7.2f} ms/frame')
+
+
+def consume_pipe(connection, size: int):
+    # Reads frames (copies of the pixels) from the connection till it's closed, returns the number of frames read
+    frames = 0
+    try:
+        while True:
+            assert len(connection.recv_bytes()) == size
+            frames += 1
+    except EOFError:
+        return frames
+
+
+def benchmark_framebuffer(num_paragraphs, frames, width=1000, height=600):
+    # Frames of a scrolling text page published to a shared memory frame buffer (read by another process without
+    # copies) against sending a copy of each frame's pixels to the other process through a pipe, and the same
+    # with frames which are only filled (the throughput of the transport itself)
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    import pygame
+    import engine
+    import framebuffer
+    print(f'Frame buffer ({frames} frames of {width}x{height})')
+    pygame.init()
+    document = engine.Engine().document(generate_text_html(num_paragraphs), width=width, height=height)
+    win = pygame.Surface((width, height))
+    for i in range(frames):  # runs of text are rendered (see `paint.RunSurfaces`) before any frame is timed
+        document.paint(win, 0, -i * 10)
+
+    def paint_frame(surface: pygame.Surface, i: int, text: bool):
+        surface.fill(engine.DEFAULT_BROWSER_BACKGROUND if text else (i % 256, 0, 0))
+        if text:
+            document.paint(surface, 0, -i * 10)
+
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        executor.submit(time.sleep, 0).result()  # consumer process is started
+        for text in [True, False]:
+            frame_buffer = framebuffer.FrameBuffer(width, height)
+            consumer = executor.submit(framebuffer.consume, frame_buffer.name, None, None, 0.0005, None)
+            start = time.perf_counter()
+            for i in range(frames):
+                paint_frame(frame_buffer.begin(), i, text)
+                frame_buffer.publish(0, -i * 10)
+            duration = time.perf_counter() - start
+            frame_buffer.close()
+            frames_read, missed, torn = consumer.result()
+            name = 'text page' if text else 'fill only'
+            print(f'  {name}  shared memory  {frames / duration:7.1f} fps  read {frames_read} frames '
+                  f'({missed} missed, {torn} torn)')
+
+            receiver, sender = context.Pipe(duplex=False)
+            consumer = executor.submit(consume_pipe, receiver, width * height * 4)
+            start = time.perf_counter()
+            for i in range(frames):
+                paint_frame(win, i, text)
+                sender.send_bytes(pygame.image.tobytes(win, framebuffer.PIXEL_FORMAT))
+            sender.close()
+            frames_read = consumer.result()
+            duration = time.perf_counter() - start
+            print(f'  {name}  pipe (copies)  {frames / duration:7.1f} fps  read {frames_read} frames')
+
+def benchmark_font_metrics(sizes, num_words):
+    import pygame
+    import renderer
+    import layout
+    import text_layout
+    import font_metrics
+    print('Font metrics (word widths from tables instead of font.size)')
+    pygame.init()
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_paragraphs in sizes:
+        dom = generate_text_page(num_paragraphs, num_words)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)  # fonts are loaded
+        layout.clear_memos()  # laid out again (not replayed from the previous layout)
+        _, duration = timed(layout.construct_layout, render_tree, 1000, 600)
+        text_layout.use_font_metrics()
+        _, tables_duration = timed(layout.construct_layout, render_tree, 1000, 600)
+        text_layout.use_font_metrics(validate=True)
+        font_metrics.divergences.clear()
+        font_metrics.run_divergences.clear()
+        layout.construct_layout(render_tree, 1000, 600)
+        text_layout.font_metrics_tables = None
+        num_words_laid_out = sum(ro.lines_object.num_words for ro in render_tree.children[0].iter_children())
+        num_runs_laid_out = sum(len(ro.lines_object.run_widths) for ro in render_tree.children[0].iter_children())
+        print(f'  {num_paragraphs:8} paragraphs of {num_words} words  font.size {duration:7.3f} s  '
+              f'tables {tables_duration:7.3f} s  '
+              f'{len(font_metrics.divergences) / num_words_laid_out * 100:5.1f}% words and '
+              f'{len(font_metrics.run_divergences) / num_runs_laid_out * 100:5.1f}% runs differ from font.size')
+
+
+def benchmark_long_text(sizes):
+    import tracemalloc
+    import pygame
+    import html_parser
+    import renderer
+    import layout
+    import text_layout
+    print('Long text (one paragraph, spaced and measured a chunk at a time)')
+    pygame.init()
+    cssom = user_agent.load_user_agent_cssom().layer()
+    text_layout.use_font_metrics()
+    for num_words in sizes:
+        text = ''.join(f'word{j},  ' + '\n' * (j % 3) for j in range(num_words))  # spaces to collapse
+        html = f'<html><body><p>{text}</p></body></html>'
+        dom, parse_duration = timed(html_parser.parse, html)
+        tracemalloc.start()
+        html_parser.parse(html)
+        _, parse_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)  # fonts are loaded
+        layout.clear_memos()
+        _, layout_duration = timed(layout.construct_layout, render_tree, 1000, 600)
+        layout.clear_memos()
+        tracemalloc.start()
+        layout.construct_layout(render_tree, 1000, 600)
+        _, layout_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        layout.clear_memos()
+        print(f'  {num_words:8} words {len(html) / 1e6:6.2f} MB  parse {parse_duration:7.3f} s  '
+              f'peak {parse_peak / 1e6:7.2f} MB  layout {layout_duration:7.3f} s  peak {layout_peak / 1e6:7.2f} MB')
+    text_layout.font_metrics_tables = None
+
+
+def benchmark_render_tree(sizes):
+    import tracemalloc
+    import renderer
+    import layout
+    import paint
+    print('Render tree')
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_blocks in sizes:
+        dom = generate_block_page(num_blocks)
+        attachment.attach_styles(dom, cssom)
+        tracemalloc.start()
+        render_tree, duration = timed(renderer.construct_render_tree, dom)
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # render object views created by layout and the display list, counted by the arena of the tree
+        arena, num_views = render_tree.arena, [0]
+        view = arena.view
+
+        def counted_view(index):
+            num_views[0] += 1
+            return view(index)
+        arena.view = counted_view
+        layout.construct_layout(render_tree, 1000, 600)
+        paint.construct_display_list(render_tree)
+
+        # structural edits on the children of a single wide block
+        dom = generate_block_page(num_blocks, fan_out=num_blocks)
+        attachment.attach_styles(dom, cssom)
+        body_ro = renderer.construct_render_tree(dom).children[0]
+        children = body_ro.children
+
+        def edit():
+            # moves every child after the first child, then back to the end
+            for child_ro in children[1:]:
+                body_ro.remove_child(child_ro)
+                body_ro.insert_after(child_ro, children[0])
+            for child_ro in children:
+                body_ro.remove_child(child_ro)
+                body_ro.add_child(child_ro)
+        _, edit_duration = timed(edit)
+        print(f'  {num_blocks:8} blocks  construct {duration:7.3f} s  {allocated / num_blocks:7.1f} bytes/object  '
+              f'edits {edit_duration / (4 * num_blocks) * 1e6:6.2f} us/edit  '
+              f'layout and display list {num_views[0] / len(arena):5.2f} views/object')
+
+
+def benchmark_paint(sizes, frames):
+    import tracemalloc
+    import pygame
+    import renderer
+    import layout
+    import paint
+    from box_model import BoxModel
+    print('Paint')
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    box_models = [BoxModel() for _ in range(10000)]
+    allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'lineno'))
+    tracemalloc.stop()
+    del box_models
+    print(f'  memory per box model  {allocated / 10000:7.1f} bytes')
+
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = css_parser.parse('.box { padding-top: 2px; margin-bottom: 1px; border-top-width: 1px; '
+                             'border-left-width: 2px; background-color: #eeeeee; }',
+                             user_agent.load_user_agent_cssom().layer())
+    for num_blocks in sizes:
+        dom = generate_block_page(num_blocks)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)
+        _, duration = timed(lambda: [paint.paint_layout(win, render_tree, 0, -i) for i in range(frames)])
+        print(f'  {num_blocks:8} blocks {duration / frames:7.3f} s/frame')
+
+
+def benchmark_hit_test(sizes, num_queries):
+    # Index built after layout, and the latency of `element_from_point` at random points of the page
+    # (against scanning the display list for the topmost block)
+    import pygame
+    import renderer
+    import layout
+    import paint
+    import hit_test
+    print('Hit testing (element from point)')
+    css = '.box { padding-top: 2px; padding-left: 1%; margin-bottom: 1px; border-top-width: 1px; } ' + \
+          ' '.join(f'.box-{i} {{ width: {90 + i}%; margin-left: {i}px; }}' for i in range(7)) + \
+          ' .box-3 { position: relative; top: 2px; } .box-5 { position: absolute; right: 3px; bottom: 1%; }'
+    cssom = css_parser.parse(css, user_agent.load_user_agent_cssom().layer())
+    rng = random.Random(0)
+    for num_blocks in sizes:
+        dom = generate_block_page(num_blocks)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)
+        display_list = paint.construct_display_list(render_tree)
+        index, build_duration = timed(hit_test.HitTestIndex, display_list)
+        page = display_list.containing_rect
+        points = [(rng.randrange(page.left, page.right), rng.randrange(page.top, page.bottom))
+                  for _ in range(num_queries)]
+        _, duration = timed(lambda: [index.element_from_point(x, y) for x, y in points])
+
+        def scan(x, y):
+            topmost = None
+            for ro in display_list.blocks:
+                if ro.position != 'fixed' and pygame.Rect(ro.box_model.border_rect).collidepoint(x, y):
+                    topmost = ro
+            return topmost
+        _, scan_duration = timed(lambda: [scan(x, y) for x, y in points[:10]])
+        print(f'  {num_blocks:8} blocks  index {build_duration:7.3f} s  query {duration / num_queries * 1e6:7.1f} us  '
+              f'scan {scan_duration / 10 * 1e6:9.1f} us')
+
+
+def benchmark_find_in_page(sizes, query):
+    # Index built from the display list, and the latency of each keystroke while typing the query (ie, each prefix
+    # of it), against walking the words of every block's lines for the whole query
+    import pygame
+    import renderer
+    import layout
+    import paint
+    import find_in_page
+    print(f'Find in page (typing {query!r})')
+    pygame.init()
+    cssom = user_agent.load_user_agent_cssom().layer()
+    for num_paragraphs in sizes:
+        dom = generate_text_page(num_paragraphs)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)
+        display_list = paint.construct_display_list(render_tree)
+        num_words = sum(ro.lines_object.num_words for ro in display_list.blocks if ro.lines_object)
+        index, build_duration = timed(find_in_page.TextIndex, display_list)
+        keystrokes = []
+        for end in range(1, len(query) + 1):
+            matches, duration = timed(index.find, query[:end])
+            keystrokes.append(duration)
+        _, locate_duration = timed(lambda: [index.locate(offset, len(query)) for offset in matches[:100]])
+
+        def walk():
+            found = 0
+            for ro in display_list.blocks:
+                if ro.lines_object:
+                    for text_object in ro.lines_object.text_objects:
+                        found += sum(query in word.lower() for word in ro.lines_object.words(text_object))
+            return found
+        _, walk_duration = timed(walk)
+        print(f'  {num_words:9} words  index {build_duration:7.3f} s  keystroke {max(keystrokes) * 1000:7.2f} ms (max)  '
+              f'{len(matches):5} matches  locate {locate_duration / min(len(matches), 100) * 1e6 if matches else 0:6.1f} us  '
+              f'walk {walk_duration * 1000:9.2f} ms')
+
+
+def generate_deep_html(depth: int, tag: str):
+    # Elements nested `depth` levels deep, each with a word of text before its child
+    return '<html><body>' + f'<{tag}>word ' * depth + f'</{tag}>' * depth + '</body></html>'
+
+
+def benchmark_deep_nesting(sizes, recursion_limit=200):
+    # Every stage walks the tree iteratively, so deep documents work within a small recursion limit
+    import pygame
+    import html_parser
+    import renderer
+    import layout
+    import paint
+    import utils
+    print(f'Deeply nested elements (recursion limit {recursion_limit})')
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = user_agent.load_user_agent_cssom().layer()
+    default_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(recursion_limit)
+    try:
+        for tag in ('span', 'div'):
+            for depth in sizes:
+                html = generate_deep_html(depth, tag)
+                start = time.perf_counter()
+                dom = html_parser.parse(html)
+                attachment.attach_styles(dom, cssom)
+                render_tree = renderer.construct_render_tree(dom)
+                layout.construct_layout(render_tree, 1000, 600)
+                paint.paint_layout(win, render_tree)
+                with redirect_stdout(io.StringIO()):
+                    utils.print_tree(render_tree)
+                duration = time.perf_counter() - start
+                print(f'  {depth:8} nested {tag:4}  {duration:7.3f} s  {duration / depth * 1e6:6.1f} us/level')
+    finally:
+        sys.setrecursionlimit(default_limit)
+
+
+def generate_adversarial_html(kind: str, num_tags: int, depth=1000, seed=0):
+    # Broken pages which made the parser scan the stack of open elements (and print a line) for every error
+    #   stray    end tags of elements which are not open, within deeply nested elements
+    #   unclosed elements which are never closed, closed by the end tag of their ancestor
+    #   random   random start, end, self-closing tags and text
+    if kind == 'stray':
+        return '<html><body>' + '<div>' * depth + '</span>' * num_tags + '</div>' * depth + '</body></html>'
+    if kind == 'unclosed':
+        return '<html><body>' + ('<div>' + '<b>' * (depth - 1) + '</div>') * (num_tags // depth) + '</body></html>'
+    rng = random.Random(seed)
+    tags = ['div', 'p', 'span', 'b', 'ul', 'li']
+    parts = ['<html><body>']
+    for _ in range(num_tags):
+        tag, kind = rng.choice(tags), rng.random()
+        parts.append(f'<{tag}>' if kind < 0.45 else f'</{tag}>' if kind < 0.8 else f'<{tag}/>' if kind < 0.9 else 'word ')
+    return ''.join(parts) + '</body></html>'
+
+
+def benchmark_adversarial_html(sizes):
+    # Parse time per tag stays the same as the pages grow (and the diagnostics kept are bounded)
+    import html_parser
+    print('Adversarial HTML (parse)')
+    for kind in ['stray', 'unclosed', 'random']:
+        for num_tags in sizes:
+            html = generate_adversarial_html(kind, num_tags)
+            diagnostics = html_parser.Diagnostics()
+            _, duration = timed(html_parser.parse, html, diagnostics)
+            print(f'  {kind:8} {num_tags:8} tags  {duration:7.3f} s  {duration / num_tags * 1e6:6.2f} us/tag  '
+                  f'{diagnostics.count:8} errors ({len(diagnostics.entries)} kept)')
+
+
+def generate_text_html(num_paragraphs: int, num_words=60):
+    # Same page as `generate_text_page`, as html source
+    paragraphs = ''.join(f'<p>{" ".join(f"word{j}" for j in range(i % 7, num_words))}<b>bold words</b></p>'
+                         for i in range(num_paragraphs))
+    return f'<html><body>{paragraphs}</body></html>'
+
+
+def benchmark_viewports(sizes, viewports):
+    # Rendering the page once for all the viewports (sharing parsing, styles and render tree, with the
+    # viewports rendered in parallel) against rendering each viewport separately
+    import engine
+    print(f'Viewports ({len(viewports)} viewports)')
+    rendering_engine = engine.Engine()
+    for num_paragraphs in sizes:
+        html = generate_text_html(num_paragraphs)
+        _, shared_duration = timed(lambda: rendering_engine.document(html).render_viewports(viewports))
+        _, separate_duration = timed(lambda: [engine.render_viewport(viewport, rendering_engine.document(html))
+                                              for viewport in viewports])
+        print(f'  {num_paragraphs:8} paragraphs  shared {shared_duration:7.3f} s  separate {separate_duration:7.3f} s')
+
+
+def benchmark_snapshot(sizes, band_height):
+    # Snapshot of the entire page painted into bands by one process against all the CPUs (the bands are painted
+    # from the same layout, shared by the forked processes)
+    import os
+    import tempfile
+    import engine
+    workers = sorted({1, os.cpu_count() or 1})
+    print(f'Snapshot (bands of {band_height} pixels, {" and ".join(map(str, workers))} processes)')
+    rendering_engine = engine.Engine()
+    for num_paragraphs in sizes:
+        document = rendering_engine.document(generate_text_html(num_paragraphs))
+        document.display_list  # noqa, stages before painting are not timed
+        durations = []
+        for num_workers in workers:
+            with tempfile.TemporaryDirectory() as directory:
+                bands, duration = timed(document.render_snapshot, directory, 'snapshot', band_height, num_workers)
+                durations.append(f'{num_workers:3} processes {duration:7.3f} s')
+        print(f'  {num_paragraphs:8} paragraphs  {len(bands):5} bands ({sum(band.height for band in bands)} pixels)  '
+              f'{"  ".join(durations)}')
+
+
+def benchmark_budget(num_paragraphs, stage_time):
+    # Overhead of checking an (unlimited) budget while rendering, and how soon pathological pages are stopped
+    import pygame
+    import engine
+    import layout
+    from budget import Budget, BudgetExceeded
+    print(f'Resource budgets (stage time {stage_time} s)')
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    rendering_engine = engine.Engine()
+    html = generate_text_html(num_paragraphs)
+    durations = []
+    for budget in [None, Budget()]:
+        layout.clear_memos()
+        document = rendering_engine.document(html, budget=budget)
+        _, duration = timed(document.paint, win)
+        durations.append(duration)
+    print(f'  {num_paragraphs:8} paragraphs  without budget {durations[0]:7.3f} s  with budget {durations[1]:7.3f} s')
+    pages = {
+        'nodes': '<html><body>' + '<div>x</div>' * 1000000 + '</body></html>',
+        'words': '<html><body><p>' + 'word ' * 2000000 + '</p></body></html>',
+        'depth': generate_deep_html(100000, 'div'),
+    }
+    limits = {'max_nodes': 10000, 'max_words': 100000, 'max_depth': 1000, 'stage_time': stage_time}
+    for name, page in pages.items():
+        document = rendering_engine.document(page, budget=Budget(**limits))
+        start = time.perf_counter()
+        try:
+            document.paint(win)
+            result = 'rendered'
+        except BudgetExceeded as e:
+            result = str(e)
+        print(f'  {name:8} {time.perf_counter() - start:7.3f} s  {result}')
+    # layout and paint of the text page, within a tenth of the stage time
+    layout.clear_memos()
+    document = rendering_engine.document(html)
+    document.render_tree  # noqa, stages before layout are not timed
+    document.budget = Budget(stage_time=stage_time / 10, partial=True)
+    _, duration = timed(document.paint, win)
+    print(f'  partial  {duration:7.3f} s  {document.budget.truncated} (laid out {len(document.display_list.blocks)} '
+          f'of {num_paragraphs + 2} blocks)')
+
+
+def generate_component_page(num_components: int, num_variants=8):
+    # Page of repeated components (cards with a title, text and a list), each one of a few variants
+    components = []
+    for i in range(num_components):
+        variant = i % num_variants
+        items = ''.join(f'<li>Item {j} of variant {variant}</li>' for j in range(3))
+        components.append(f'<div class="card"><div class="title">Card variant {variant}</div>'
+                          f'<p>{" ".join(f"word{j}" for j in range(variant, 40))}</p><ul>{items}</ul></div>')
+    return f'<html><body>{"".join(components)}</body></html>'
+
+
+def benchmark_layout_memo(sizes):
+    # Layout of a page of repeated components (a few variants) and of a page of distinct components, without the
+    # subtree memo, with the memo cleared (replayed within the document only) and with the memo of previous documents
+    # with the same components (replayed across documents, a subtree is memoized once it's seen again)
+    import layout
+    import engine
+    print('Layout memo')
+    rendering_engine = engine.Engine()
+    css = ['.card { margin-bottom: 10px; padding-top: 8px; padding-left: 8px; border-top-width: 1px; width: 50%; } '
+           '.title { font-weight: bold; font-size: 19px; } ul { display: block; } li { display: block; }']
+    for num_components in sizes:
+        for name, num_variants in [('repeated', 8), ('distinct', num_components)]:
+            html = generate_component_page(num_components, num_variants)
+            durations = []
+            for memoize, num_previous in [(False, 0), (True, 0), (True, 2)]:
+                layout.clear_memos()
+                for _ in range(num_previous):
+                    layout.construct_layout(rendering_engine.document(html, css).render_tree, 1000, 600)
+                render_tree = rendering_engine.document(html, css).render_tree
+                _, duration = timed(layout.construct_layout, render_tree, 1000, 600, memoize=memoize)
+                durations.append(duration)
+            print(f'  {num_components:8} {name} components  no memo {durations[0]:7.3f} s  '
+                  f'within document {durations[1]:7.3f} s  across documents {durations[2]:7.3f} s')
+
+
+BENCHMARKS = {
+    'css': lambda: benchmark_css([1000, 10000, 50000]),
+    'style': lambda: benchmark_style([5000, 10000, 50000], 10000),
+    'load': lambda: benchmark_load(8, 1500000),
+    'agent': lambda: benchmark_user_agent(1000),
+    'layout': lambda: benchmark_layout([10000, 100000, 300000]),
+    'progressive': lambda: benchmark_progressive_layout([10000, 100000], 1 / 120),
+    'lazy': lambda: benchmark_lazy_text([1000, 10000]),
+    'memo': lambda: benchmark_layout_memo([1000, 10000]),
+    'text': lambda: benchmark_text([100, 1000, 10000], 5),
+    'textpaint': lambda: benchmark_text_paint([100, 1000, 10000], 60),
+    'framebuffer': lambda: benchmark_framebuffer(1000, 600),
+    'metrics': lambda: (benchmark_font_metrics([1000, 10000], 60), benchmark_font_metrics([100], 5000)),
+    'longtext': lambda: benchmark_long_text([100000, 1000000]),
+    'render': lambda: benchmark_render_tree([1000, 10000, 20000]),
+    'paint': lambda: benchmark_paint([1000, 10000], 5),
+    'hit': lambda: benchmark_hit_test([1000, 10000, 100000], 10000),
+    'find': lambda: (benchmark_find_in_page([1000, 10000, 160000], 'word42 word43'),
+                     benchmark_find_in_page([160000], 'not on the page')),
+    'deep': lambda: benchmark_deep_nesting([10000, 100000]),
+    'html': lambda: benchmark_adversarial_html([10000, 100000, 1000000]),
+    'snapshot': lambda: benchmark_snapshot([1000, 10000], 2048),
+    'budget': lambda: benchmark_budget(3000, 0.5),
+    'viewports': lambda: benchmark_viewports([100, 1000], [(320, 568), (375, 667), (768, 1024), (1024, 768),
+                                                           (1280, 800), (1440, 900), (1920, 1080), (2560, 1440)]),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the rendering engine')
+    parser.add_argument('benchmarks', type=str, nargs='*',
+                        help=f'benchmarks to run, one of {", ".join(BENCHMARKS)} (runs all by default)')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name!r}')
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,61 +1,117 @@
+from operator import attrgetter
+
+
+def box_model_input(name: str, changes_size=True):
+    # Property for a box model input (stored in slot `_<name>`)
+    # Setting a different value invalidates the cached geometry derived from it
+    slot = f'_{name}'
+
+    def set_input(self, value):
+        if value != getattr(self, slot):
+            setattr(self, slot, value)
+            self._geometry = None
+            if changes_size:
+                self._size = None
+
+    return property(attrgetter(slot), set_input)
+
+
 class BoxModel:
-    def __init__(self):
+    # Derived geometry (box size, positions and rectangles) is computed once on first use
+    # (ie, after layout and positioning) and is cached till some input it depends on changes
+    __slots__ = ('_margin_top', '_margin_right', '_margin_bottom', '_margin_left',
+                 '_padding_top', '_padding_right', '_padding_bottom', '_padding_left',
+                 '_border_top', '_border_right', '_border_bottom', '_border_left',
+                 '_content_width', '_content_height', 'relative_left', 'relative_top',
+                 '_left', '_top', '_size', '_geometry')
+
+    def __init__(self, margin_top=0, margin_right=0, margin_bottom=0, margin_left=0,
+                 padding_top=0, padding_right=0, padding_bottom=0, padding_left=0,
+                 border_top=0, border_right=0, border_bottom=0, border_left=0,
+                 content_width=0, content_height=0, relative_left=0, relative_top=0):
+        # box model properties
+        self._margin_top = margin_top
+        self._margin_right = margin_right
+        self._margin_bottom = margin_bottom
+        self._margin_left = margin_left
+
+        self._padding_top = padding_top
+        self._padding_right = padding_right
+        self._padding_bottom = padding_bottom
+        self._padding_left = padding_left
+
+        self._border_top = border_top
+        self._border_right = border_right
+        self._border_bottom = border_bottom
+        self._border_left = border_left
+
         # width and height available for it's content (ie children)
         # however note it may overflow
-        self.content_width = 0
-        self.content_height = 0
+        self._content_width = content_width
+        self._content_height = content_height
 
-        # box model properties
-        self.margin_top = 0
-        self.margin_right = 0
-        self.margin_bottom = 0
-        self.margin_left = 0
+        # the relative position of the element from it's parent's content box
+        # (does not affect the box model's own geometry)
+        self.relative_left = relative_left
+        self.relative_top = relative_top
 
-        self.padding_top = 0
-        self.padding_right = 0
-        self.padding_bottom = 0
-        self.padding_left = 0
+        # absolute positions of the entire box (including margin), set during paint phase
+        self._left = 0
+        self._top = 0
 
-        self.border_top = 0
-        self.border_right = 0
-        self.border_bottom = 0
-        self.border_left = 0
+        # cached derived geometry
+        self._size = None
+        self._geometry = None
 
-        # the relative position of the element from it's parent's content box
-        self.relative_left = 0
-        self.relative_top = 0
+    margin_top = box_model_input('margin_top')
+    margin_right = box_model_input('margin_right')
+    margin_bottom = box_model_input('margin_bottom')
+    margin_left = box_model_input('margin_left')
+
+    padding_top = box_model_input('padding_top')
+    padding_right = box_model_input('padding_right')
+    padding_bottom = box_model_input('padding_bottom')
+    padding_left = box_model_input('padding_left')
+
+    border_top = box_model_input('border_top')
+    border_right = box_model_input('border_right')
+    border_bottom = box_model_input('border_bottom')
+    border_left = box_model_input('border_left')
+
+    content_width = box_model_input('content_width')
+    content_height = box_model_input('content_height')
 
     @property
     def padding_width(self):
-        return self.padding_left + self.padding_right
+        return self._padding_left + self._padding_right
 
     @property
     def padding_height(self):
-        return self.padding_top + self.padding_bottom
+        return self._padding_top + self._padding_bottom
 
     @property
     def border_width(self):
-        return self.border_left + self.border_right
+        return self._border_left + self._border_right
 
     @property
     def border_height(self):
-        return self.border_top + self.border_bottom
+        return self._border_top + self._border_bottom
 
     @property
     def margin_width(self):
-        return self.margin_left + self.margin_right
+        return self._margin_left + self._margin_right
 
     @property
     def margin_height(self):
-        return self.margin_top + self.margin_bottom
+        return self._margin_top + self._margin_bottom
 
     @property
     def width(self):
-        return self.border_width + self.padding_width + self.content_width
+        return self.border_width + self.padding_width + self._content_width
 
     @property
     def height(self):
-        return self.border_height + self.padding_height + self.content_height
+        return self.border_height + self.padding_height + self._content_height
 
     @width.setter
     def width(self, width):  # content width cannot be negative
@@ -65,13 +121,21 @@ class BoxModel:
     def height(self, height):  # content height cannot be negative
         self.content_height = max(height - self.border_height - self.padding_height, 0)
 
+    @property
+    def size(self):
+        # (box_width, box_height) cached till any of the box model properties change
+        if self._size is None:
+            self._size = (self._content_width + self.padding_width + self.border_width + self.margin_width,
+                          self._content_height + self.padding_height + self.border_height + self.margin_height)
+        return self._size
+
     @property
     def box_width(self):
-        return self.content_width + self.padding_width + self.border_width + self.margin_width
+        return self.size[0]
 
     @property
     def box_height(self):
-        return self.content_height + self.padding_height + self.border_height + self.margin_height
+        return self.size[1]
 
     @box_width.setter
     def box_width(self, box_width):
@@ -82,45 +146,64 @@ class BoxModel:
         self.content_height = max(box_height - self.padding_height - self.border_height - self.margin_height, 0)
 
     def __str__(self):
-        return f'BoxModel(content_size=({self.content_width, self.content_height}), ' \
+        return f'BoxModel(content_size=({self._content_width, self._content_height}), ' \
             f'box_size=({self.box_width}, {self.box_height}))'
 
     # These properties are set during paint phase
     # these are absolute positions of the entire box (including margin)
-    left: int
-    top: int
+    left = box_model_input('left', changes_size=False)
+    top = box_model_input('top', changes_size=False)
+
+    @property
+    def geometry(self):
+        # (content_left, content_top, content_rect, padding_rect, border_rect, box_rect)
+        # cached till any of the box model properties or the position changes
+        if self._geometry is None:
+            box_width, box_height = self.size
+            left, top = self._left, self._top
+            border_x, border_y = left + self._margin_left, top + self._margin_top
+            padding_x, padding_y = border_x + self._border_left, border_y + self._border_top
+            content_x, content_y = padding_x + self._padding_left, padding_y + self._padding_top
+            self._geometry = (
+                content_x, content_y,
+                (content_x, content_y, self._content_width, self._content_height),
+                (padding_x, padding_y,
+                 self._content_width + self.padding_width, self._content_height + self.padding_height),
+                (border_x, border_y, box_width - self.margin_width, box_height - self.margin_height),
+                (left, top, box_width, box_height),
+            )
+        return self._geometry
 
     @property
     def right(self):
-        return self.left + self.box_width
+        return self._left + self.size[0]
 
     @property
     def bottom(self):
-        return self.top + self.box_height
+        return self._top + self.size[1]
 
     # Properties below are used in the paint phase once left, and top are set
     @property
     def content_left(self):
-        return self.left + self.margin_left + self.border_left + self.padding_left
+        return self.geometry[0]
 
     @property
     def content_top(self):
-        return self.top + self.margin_top + self.border_top + self.padding_top
+        return self.geometry[1]
 
     # Rectangles used for painting layouts
     @property
     def content_rect(self):
-        return self.content_left, self.content_top, self.content_width, self.content_height
+        return self.geometry[2]
 
     @property
     def padding_rect(self):
-        return self.content_left - self.padding_left, self.content_top - self.padding_top, \
-               self.content_width + self.padding_width, self.content_height + self.padding_height
+        return self.geometry[3]
 
     @property
     def border_rect(self):
-        return self.left + self.margin_left, self.top + self.margin_top, self.width, self.height
+        return self.geometry[4]
 
     @property
     def box_rect(self):
-        return self.left, self.top, self.box_width, self.box_height
+        return self.geometry[5]
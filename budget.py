@@ -0,0 +1,78 @@
+import time
+
+# Resource budgets of a page, so a pathological page (eg, an untrusted page in the render server) cannot hold
+# the renderer for long. Stages check the budget cooperatively as they go, and raise `BudgetExceeded` once
+# a limit is crossed (limits are None when unlimited)
+#   max_nodes   elements and texts of the DOM (checked while tokenizing)
+#   max_depth   nesting of the elements (checked while parsing)
+#   max_words   words of all the texts (checked while tokenizing, ie, before any of them is measured)
+#   max_blocks  render blocks (checked while constructing the render tree, ie, before layout)
+#   stage_time  wall time of each stage in seconds (checked every few nodes by each stage)
+# With `partial`, layout and paint stop once they run out of time and keep the part done so far
+# (blocks yet to be laid out have no box model and are not painted), instead of raising
+# Note: the clock is read once every `TICKS_PER_CHECK` units of work (eg, nodes or words)
+TICKS_PER_CHECK = 256
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, resource: str, limit, stage: str):
+        super().__init__(f'{stage} exceeded the budget of {limit} {resource}')
+        self.resource = resource  # nodes, depth, words, blocks or seconds
+        self.limit = limit
+        self.stage = stage
+
+    def __reduce__(self):  # pickled by its fields (eg, raised in a worker process)
+        return BudgetExceeded, (self.resource, self.limit, self.stage)
+
+    def to_dict(self):
+        return {'resource': self.resource, 'limit': self.limit, 'stage': self.stage}
+
+
+class Budget:
+    def __init__(self, max_nodes: int = None, max_depth: int = None, max_words: int = None, max_blocks: int = None,
+                 stage_time: float = None, partial=False):
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.max_words = max_words
+        self.max_blocks = max_blocks
+        self.stage_time = stage_time
+        self.partial = partial
+        self.truncated = None  # BudgetExceeded of the first stage which stopped early (with `partial`)
+        self.stage = None  # stage being checked
+        self.deadline = None
+        self.ticks = 0
+
+    def start(self, stage: str):
+        # Starts the clock of a stage
+        self.stage, self.ticks = stage, 0
+        self.deadline = None if self.stage_time is None else time.perf_counter() + self.stage_time
+
+    def check(self, resource: str, value: int):
+        # Checks a count (eg, nodes so far) against the limit of the resource
+        limit = getattr(self, f'max_{resource}')
+        if limit is not None and value > limit:
+            raise BudgetExceeded(resource, limit, self.stage)
+
+    def check_time(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceeded('seconds', self.stage_time, self.stage)
+
+    def tick(self, cost=1):
+        # Counts `cost` units of work, and checks the time once every `TICKS_PER_CHECK` units
+        self.ticks += cost
+        if self.ticks >= TICKS_PER_CHECK:
+            self.ticks = 0
+            self.check_time()
+
+    def stop(self, cost=1) -> bool:
+        # Same as `tick`, for the stages which can stop early (layout and paint)
+        # With `partial`, returns True when out of time (the error is kept in `truncated`) instead of raising
+        try:
+            self.tick(cost)
+        except BudgetExceeded as e:
+            if not self.partial:
+                raise
+            if self.truncated is None:
+                self.truncated = e
+            return True
+        return False
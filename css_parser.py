@@ -1,17 +1,160 @@
 from __future__ import annotations
+from collections import namedtuple
 import re
+import zlib
+from utils import count_newlines, rfind_newline, decode, Diagnostics
+
+# Tokens produced by the CSS tokenizer
+# Note: line and column are 1-based positions of the first character of the token
+Token = namedtuple('Token', ['kind', 'value', 'line', 'column'])
+
+# Spaces and comments before a token are skipped as part of the token's match,
+# so that only the significant tokens are handled in python.
+# An unterminated comment runs till the end of the stylesheet (as in browsers).
+SKIP = r'\s*(?:/[*](?:.*?[*]/|.*)\s*)*'
+# TEXT is a run of anything but braces, semicolons and comments (eg, a selector or a declaration),
+# it always starts with a non space character. Selectors and declarations are parsed from it later.
+# BLOCK is a declaration block `{ ... }` without comments and nested blocks (the common case),
+# other blocks are tokenized as LBRACE, TEXT, SEMICOLON and RBRACE tokens.
+# Every position (after skipping) starts one of the alternatives, and none of them
+# backtrack beyond the next brace or comment, so the tokenizer runs in linear time.
+TOKEN_SPECIFICATION = [
+    ('BLOCK', r'{[^{}/]*(?:/(?![*])[^{}/]*)*}'),
+    ('TEXT', r'(?:[^{};/\s]|/(?![*]))[^{};/]*(?:/(?![*])[^{};/]*)*'),
+    ('LBRACE', r'{'),
+    ('RBRACE', r'}'),
+    ('SEMICOLON', r';'),
+    ('EOF', r'$'),
+]
+TOKEN_REGEX = re.compile(SKIP + '(?:' + '|'.join('(?P<%s>%s)' % pair for pair in TOKEN_SPECIFICATION) + ')',
+                         flags=re.DOTALL)
+# Same tokenizer for stylesheets in bytes-like buffers (eg, memory mapped files), matched without decoding them
+BYTES_TOKEN_REGEX = re.compile(TOKEN_REGEX.pattern.encode(), flags=re.DOTALL)
+DECLARATION_REGEX = re.compile(r'(?P<PROPERTY>[\w-]+)\s*:\s*(?P<VALUE>#?[\w-]+%?)\s*')
+# Selectors are sequences of compound selectors (eg, `div.a#b`) separated by combinators,
+# descendant (`a b`) and child (`a > b`)
+SELECTOR_TOKEN_REGEX = re.compile(r'\s*(?P<CHILD>>)\s*|(?P<DESCENDANT>\s+)|(?P<UNIVERSAL>[*])|(?P<TAG>[\w-]+)|'
+                                  r'(?P<CLASS>[.][\w-]+)|(?P<ID>#[\w-]+)|(?P<EXCEPTION>.)', flags=re.DOTALL)
+
+# Size of the Bloom filter of ancestor keys used during style computation (see attachment.AncestorFilter)
+BLOOM_FILTER_BITS = 1 << 10
+
+
+def bloom_filter_bits(key: str):
+    # positions of the bits set for the key in the ancestor Bloom filter
+    # Note: unlike `hash`, crc32 is the same across processes, so masks of cached selectors stay valid
+    h = zlib.crc32(key.encode())
+    return h % BLOOM_FILTER_BITS, (h // BLOOM_FILTER_BITS) % BLOOM_FILTER_BITS
+
+
+class Compound:
+    # Compound selector, matches elements with given tag (any if None), id (any if None) and all of the classes
+    def __init__(self, tag=None, id=None, classes=()):
+        self.tag = tag
+        self.id = id
+        self.classes = classes
+
+    @property
+    def keys(self):
+        # keys which an element matching the compound must have (as used by the ancestor filter)
+        keys = [f'.{class_name}' for class_name in self.classes]
+        if self.id is not None:
+            keys.append(f'#{self.id}')
+        if self.tag is not None:
+            keys.append(self.tag)
+        return keys
+
+    def __str__(self):
+        text = (self.tag or '') + (f'#{self.id}' if self.id is not None else '') + \
+            ''.join(f'.{class_name}' for class_name in self.classes)
+        return text or '*'
+
+
+class Selector:
+    def __init__(self, compounds: [Compound], combinators: [str]):
+        # compounds from left to right, combinators[i] is between compounds[i] and compounds[i + 1]
+        assert compounds and len(combinators) == len(compounds) - 1
+        self.compounds = compounds
+        self.combinators = combinators
+        # (ids, classes, tags)
+        self.specificity = (sum(compound.id is not None for compound in compounds),
+                            sum(len(compound.classes) for compound in compounds),
+                            sum(compound.tag is not None for compound in compounds))
+        # keys that ancestors of a matching element must have, used to quickly reject the selector
+        self.ancestor_keys = [key for compound in compounds[:-1] for key in compound.keys]
+        # the ancestor keys as bits of the ancestor Bloom filter
+        self.ancestor_mask = 0
+        for key in self.ancestor_keys:
+            for bit in bloom_filter_bits(key):
+                self.ancestor_mask |= 1 << bit
+        self.text = str(compounds[0]) + ''.join(f' {combinator} {compound}' if combinator == '>' else f' {compound}'
+                                                for combinator, compound in zip(combinators, compounds[1:]))
+
+    @property
+    def subject(self):  # the compound which matches the element itself
+        return self.compounds[-1]
+
+    def __repr__(self):
+        return f'Selector({self.text!r})'
+
+    def __str__(self):
+        return self.text
+
+
+def parse_selector(text: str):
+    # Converts selector text into a selector, returns None if it is not a supported selector
+    compounds, combinators, parts = [], [], []
+    for m in SELECTOR_TOKEN_REGEX.finditer(text.strip().lower()):
+        kind = m.lastgroup
+        if kind == 'CHILD' or kind == 'DESCENDANT':
+            if not parts:
+                return None
+            compounds.append(parts)
+            combinators.append('>' if kind == 'CHILD' else ' ')
+            parts = []
+        elif kind == 'EXCEPTION' or (kind in ['UNIVERSAL', 'TAG'] and parts):
+            # unsupported selector, or tag not at the beginning of the compound
+            return None
+        else:
+            parts.append((kind, m.group()))
+    if not parts:
+        return None
+    compounds.append(parts)
+
+    def compound(parts):
+        tag = next((value for kind, value in parts if kind == 'TAG'), None)
+        ids = {value[1:] for kind, value in parts if kind == 'ID'}
+        if len(ids) > 1:  # can never match
+            return None
+        classes = tuple(dict.fromkeys(value[1:] for kind, value in parts if kind == 'CLASS'))
+        return Compound(tag, ids.pop() if ids else None, classes)
+
+    compounds = [compound(parts) for parts in compounds]
+    if None in compounds:
+        return None
+    return Selector(compounds, combinators)
 
 
 class CSSRule:
-    def __init__(self, selector):
+    def __init__(self, selector: Selector, order=0, line=0, column=0):
         self.selector = selector
         self.declarations = {}
+        # rules defined earlier have lower order, used to cascade rules of equal specificity
+        self.order = order
+        # source position where the rule was first defined
+        self.line = line
+        self.column = column
 
     def __setitem__(self, prop, value):
         self.declarations[prop] = value
 
+    def copy(self):
+        rule = CSSRule(self.selector, self.order, self.line, self.column)
+        rule.declarations = dict(self.declarations)
+        return rule
+
     def __repr__(self):
-        return f'CSSRule({self.selector!r})'
+        return f'CSSRule({self.selector.text!r})'
 
     def __str__(self):
         declarations = ' '.join(f'{prop}: {value};' for prop, value in self.declarations.items())
@@ -19,62 +162,173 @@ class CSSRule:
 
 
 class CSSOM:  # CSS Object Model
-    def __init__(self):
-        self.universal_rule = CSSRule('*')
-        self.tag_rules = {}
-        self.class_rules = {}
-        self.id_rules = {}
-
-    def __getitem__(self, selector):
-        # Returns corresponding CSS Rule for a given selector
-        if re.match(r'^[*]$', selector):
-            return self.universal_rule
-        elif re.match(r'^[.][\w-]+$', selector):
-            if selector not in self.class_rules:
-                self.class_rules[selector] = CSSRule(selector)
-            return self.class_rules[selector]
-        elif re.match(r'^#[\w-]+$', selector):
-            if selector not in self.id_rules:
-                self.id_rules[selector] = CSSRule(selector)
-            return self.id_rules[selector]
-        elif re.match(r'^[\w-]+$', selector):
-            if selector not in self.tag_rules:
-                self.tag_rules[selector] = CSSRule(selector)
-            return self.tag_rules[selector]
-        raise NotImplementedError(f'Cannot handle selector {selector!r}')
+    def __init__(self, base: CSSOM = None):
+        # CSSOM can be layered over a frozen base CSSOM (eg, user agent styles), its rules then cascade
+        # over the base's rules. Base's rules and buckets are shared until modified (copy on write)
+        assert base is None or base.frozen
+        self.base = base
+        self.frozen = False  # frozen CSSOMs cannot be modified
+        self.rules = dict(base.rules) if base else {}  # selector text to CSS rule, in the order of definition
+        # Rules are bucketed by the rightmost (subject) compound selector's id, else first class,
+        # else tag, so that an element only needs to look up the buckets of its id, classes and tag
+        self.universal_rules = base.universal_rules if base else []
+        self.tag_rules = dict(base.tag_rules) if base else {}
+        self.class_rules = dict(base.class_rules) if base else {}
+        self.id_rules = dict(base.id_rules) if base else {}
+
+    def freeze(self):
+        self.frozen = True
+        return self
+
+    def layer(self):
+        # Returns a new CSSOM layered over this (frozen) CSSOM
+        return CSSOM(base=self.freeze())
+
+    def bucket(self, selector: Selector):
+        # Returns the (modifiable) bucket in which the rule for the selector belongs
+        subject = selector.subject
+        if subject.id is not None:
+            name, key = 'id_rules', subject.id
+        elif subject.classes:
+            name, key = 'class_rules', subject.classes[0]
+        elif subject.tag is not None:
+            name, key = 'tag_rules', subject.tag
+        else:
+            if self.base and self.universal_rules is self.base.universal_rules:
+                self.universal_rules = list(self.universal_rules)  # copy on write
+            return self.universal_rules
+        buckets = getattr(self, name)
+        if key not in buckets:
+            buckets[key] = []
+        elif self.base and buckets[key] is getattr(self.base, name).get(key):
+            buckets[key] = list(buckets[key])  # copy on write
+        return buckets[key]
+
+    def get_rule(self, selector: Selector, line=0, column=0):
+        # Returns corresponding (modifiable) CSS Rule for a given selector,
+        # creating it if it is seen for the first time
+        if self.frozen:
+            raise Exception('Cannot modify a frozen CSSOM')
+        rule = self.rules.get(selector.text)
+        if rule is None:
+            rule = CSSRule(selector, len(self.rules), line, column)
+            self.rules[selector.text] = rule
+            self.bucket(selector).append(rule)
+        elif self.base and rule is self.base.rules.get(selector.text):
+            # copy on write, the copy replaces the base's rule in this CSSOM
+            bucket = self.bucket(selector)
+            index = bucket.index(rule)
+            rule = bucket[index] = self.rules[selector.text] = rule.copy()
+        return rule
+
+    def __getitem__(self, selector: str):
+        parsed_selector = parse_selector(selector)
+        if parsed_selector is None:
+            raise NotImplementedError(f'Cannot handle selector {selector!r}')
+        return self.get_rule(parsed_selector)
 
     def __str__(self):
-        return str(self.universal_rule) + '\n\n' \
-               + '\n'.join(map(str, self.tag_rules.values())) + '\n\n' \
-               + '\n'.join(map(str, self.class_rules.values())) + '\n\n' \
-               + '\n'.join(map(str, self.id_rules.values()))
+        return '\n'.join(map(str, self.rules.values()))
 
 
-def parse(css, cssom=None):
+def tokenize(css):
+    # Converts a stylesheet (a string or a bytes-like buffer, eg, memory map) into a stream of tokens
+    # Comments and spaces are dropped, however they are accounted for in line numbers
+    # Line and column numbers are tracked incrementally to keep it linear
+    # Note: columns are in bytes for buffers
+    regex = TOKEN_REGEX if isinstance(css, str) else BYTES_TOKEN_REGEX
+    line, line_start, position = 1, 0, 0
+    for m in regex.finditer(css):
+        kind = m.lastgroup
+        if kind == 'EOF':
+            return
+        start = m.start(kind)
+        newlines = count_newlines(css, position, start)
+        if newlines:
+            line += newlines
+            line_start = rfind_newline(css, position, start) + 1
+        position = start
+        yield Token(kind, decode(m.group(kind)), line, start - line_start + 1)
+
+
+def parse_declarations(block: Token, diagnostics: Diagnostics):
+    # Yields the declarations within a BLOCK token as (property, value) tuples
+    # Invalid declarations are reported (to `diagnostics`) and ignored
+    offset = 1  # offset of the declaration within the block, skipping `{`
+    for declaration in block.value[1:-1].split(';'):
+        m = DECLARATION_REGEX.fullmatch(declaration.strip())
+        if m:
+            yield m.group('PROPERTY').lower(), m.group('VALUE').lower()
+        elif declaration and not declaration.isspace():
+            # position of the declaration is only needed when reporting
+            start = offset + len(declaration) - len(declaration.lstrip())
+            line = block.line + block.value.count('\n', 0, start)
+            column = start - block.value.rfind('\n', 0, start) if line != block.line else block.column + start
+            diagnostics.report('Invalid declaration', Token('TEXT', declaration.strip(), line, column))
+        offset += len(declaration) + 1
+
+
+def parse_block(tokens, diagnostics: Diagnostics):
+    # Consumes tokens till the `}` which closes the current block (or till the end of stylesheet)
+    # and yields the declarations within as (property, value) tuples
+    # Invalid declarations (and nested blocks) are reported (to `diagnostics`) and ignored
+    depth = 0
+    for token in tokens:
+        kind = token.kind
+        if depth:
+            if kind == 'LBRACE':
+                depth += 1
+            elif kind == 'RBRACE':
+                depth -= 1
+        elif kind == 'TEXT':
+            m = DECLARATION_REGEX.fullmatch(token.value)
+            if m:
+                yield m.group('PROPERTY').lower(), m.group('VALUE').lower()
+            else:
+                diagnostics.report('Invalid declaration', token)
+        elif kind == 'RBRACE':
+            return
+        elif kind == 'BLOCK':
+            diagnostics.report('Unexpected block', token)
+        elif kind == 'LBRACE':
+            diagnostics.report('Unexpected block', token)
+            depth = 1
+
+
+def parse(css, cssom=None, diagnostics: Diagnostics = None):
+    # Constructs (or updates) CSSOM from the stylesheet
+    # Rules are applied top to bottom, so later declarations override the former (cascading)
+    # Malformed rules and declarations are skipped as a whole (like browsers do), and reported to `diagnostics`
     if cssom is None:
         cssom = CSSOM()
+    if diagnostics is None:
+        diagnostics = Diagnostics()
 
-    comment = r'/[*].*?[*]/'
-    css = re.sub(comment, '', css, flags=re.DOTALL)  # Remove comments - loses line info.
-    selector = r'(?P<SELECTOR>[*]|[\w-]+|[.][\w-]+|[#][\w-]+)'
-    declaration = r'(\s*(?P<PROPERTY>[\w-]+)\s*:\s*(?P<VALUE>#?\w+%?)\s*;)'
-    rule = rf'\s*{selector}\s*{{(?P<DECLARATIONS>{declaration}+)\s*}}'
-    token_specification = [
-        ('RULE', rule),
-        ('SPACE', r'\s+'),
-        ('EXCEPTION', r'.+'),
-    ]
-    regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-
-    for m in re.finditer(regex, css):
-        kind = m.lastgroup
-        if kind == 'SPACE':
-            continue
-        elif kind == 'RULE':
-            css_rule = cssom[m.group('SELECTOR').lower()]
-            for n in re.finditer(declaration, m.group('DECLARATIONS')):
-                # CSS Cascade rule in action
-                css_rule[n.group('PROPERTY').lower()] = n.group('VALUE').lower()
-        elif kind == 'EXCEPTION':
-            print(f"Unexpected text `{m.group()!r}`")
+    tokens = tokenize(css)
+    prelude = []  # tokens of the selector of the upcoming rule
+    for token in tokens:
+        if token.kind == 'TEXT':
+            prelude.append(token)
+        elif token.kind == 'BLOCK' or token.kind == 'LBRACE':
+            declarations = parse_declarations(token, diagnostics) if token.kind == 'BLOCK' else \
+                parse_block(tokens, diagnostics)
+            selector = parse_selector(''.join(t.value for t in prelude))
+            start = prelude[0] if prelude else token
+            if selector is None:
+                diagnostics.report('Unsupported selector',
+                                   start._replace(value=''.join(t.value for t in prelude).strip()))
+                for _ in declarations:  # skip the rule
+                    pass
+            else:
+                css_rule = cssom.get_rule(selector, start.line, start.column)
+                for prop, value in declarations:
+                    # CSS Cascade rule in action
+                    css_rule[prop] = value
+            prelude = []
+        else:
+            diagnostics.report('Unexpected text', (prelude[0] if prelude else token)._replace(value=token.value))
+            prelude = []
+
+    if prelude:
+        diagnostics.report('Unexpected end of stylesheet', prelude[0])
     return cssom
@@ -0,0 +1,363 @@
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
+
+import pygame
+
+import html_parser
+import css_parser
+import attachment
+import renderer
+import layout
+import paint
+import hit_test
+import find_in_page
+import text_layout
+import user_agent
+import loader
+import utils
+from budget import Budget
+from css_parser import CSSOM
+from render_object import RenderBlock
+
+# Library API of the rendering engine
+# An `Engine` owns what all of its documents share, and a `Document` computes the stages of rendering
+# a page (dom, cssom, styled dom, render tree, layout and display list) on first access, and caches them
+#
+#   engine = Engine()
+#   document = engine.document('<html><body>Hello</body></html>', ['body { color: #ff0000; }'], width=800)
+#   document.paint(surface)  # computes all the stages
+#   document.render_tree     # cached, only the stages till render tree are computed if accessed first
+
+DEFAULT_BROWSER_BACKGROUND = (255, 255, 255)
+SNAPSHOT_BAND_HEIGHT = 2048  # height of the parts (PNG files) of a snapshot of the entire page
+# Trees printed when the engine traces, other stages only trace the time they took
+TRACED_TREES = ['dom', 'render_tree']
+
+
+class Engine:
+    # Fonts are loaded once in the process (when `text_layout` is imported), the browser styles are loaded
+    # (from the precompiled cache) on first use, and font metric tables when enabled
+    # Note: font metric tables are enabled for the process, ie, for all the engines
+    # `trace` is a file to which the documents write their trees and the time taken by each stage (off by default)
+    def __init__(self, user_agent_stylesheet: str = user_agent.USER_AGENT_STYLESHEET, use_font_metrics=False,
+                 validate_font_metrics=False, trace=None):
+        self.user_agent_stylesheet = user_agent_stylesheet
+        self.trace = trace
+        self._user_agent_cssom = None
+        if use_font_metrics or validate_font_metrics:
+            text_layout.use_font_metrics(validate=validate_font_metrics)
+
+    @property
+    def user_agent_cssom(self) -> CSSOM:  # frozen, documents layer their styles over it
+        if self._user_agent_cssom is None:
+            self._user_agent_cssom = user_agent.load_user_agent_cssom(self.user_agent_stylesheet)
+        return self._user_agent_cssom
+
+    def document(self, html, style_sheets: List[str] = (), width=1000, height=600, layout_mode='scalar',
+                 lazy_text: layout.LazyTextLayout = None, budget: Budget = None):
+        # Document of the html source and css sources, nothing is computed till a stage is accessed
+        return Document(self, html, style_sheets, width, height, layout_mode, lazy_text, budget=budget)
+
+    def open(self, html_page: str, style_sheets: List[str] = (), width=1000, height=600, layout_mode='scalar',
+             lazy_text: layout.LazyTextLayout = None, budget: Budget = None):
+        # Document of the html and css files, the files are read concurrently (large files are memory mapped)
+        # and the stylesheets are parsed in the background (eg, while the html is parsed)
+        executor = ThreadPoolExecutor()
+        html_source = executor.submit(loader.load, html_page)
+        css_diagnostics = utils.Diagnostics()
+        cssom = loader.load_stylesheets(executor, list(style_sheets), self.user_agent_cssom.layer(), css_diagnostics)
+        executor.shutdown(wait=False)  # submitted tasks still complete
+        return Document(self, html_source, (), width, height, layout_mode, lazy_text, cssom, budget, css_diagnostics)
+
+    def trace_stage(self, name: str, duration: float, result):
+        # trees are formatted only when tracing
+        if self.trace is None:
+            return
+        print(f'{name}: {duration * 1000:.3f} ms', file=self.trace)
+        if name in TRACED_TREES:
+            utils.print_tree(result, self.trace)
+
+
+def construct_layout(render_tree: RenderBlock, width: int, height: int, layout_mode='scalar',
+                     lazy_text: layout.LazyTextLayout = None, budget: Budget = None):
+    # Note: vectorized layout does not check the time of the budget (its blocks are limited by the render tree)
+    if layout_mode == 'vectorized':
+        import vectorized_layout  # numpy is only needed for vectorized layout
+        vectorized_layout.construct_layout(render_tree, width, height)
+    else:
+        layout.construct_layout(render_tree, width, height, lazy_text, budget)
+
+
+def stage(*requires: str):
+    # A stage of the document, computed on first access (after the stages it requires) and cached
+    # Note: time taken by each stage (excluding the stages it requires) is recorded in `timings`
+    def decorator(compute):
+        name = compute.__name__
+
+        def get(document: 'Document'):
+            if name not in document.stages:
+                for required in requires:
+                    getattr(document, required)
+                start = time.perf_counter()
+                result = compute(document)
+                duration = time.perf_counter() - start
+                document.stages[name], document.timings[name] = result, duration
+                document.engine.trace_stage(name, duration, result)
+            return document.stages[name]
+
+        return property(get)
+
+    return decorator
+
+
+class Document:
+    # html and cssom can also be futures (see `Engine.open`), when cssom is given the style sheets are not parsed
+    # (and its errors are reported to `css_diagnostics`)
+    # With `budget`, the stages raise BudgetExceeded once the page crosses its limits, and with a partial budget
+    # layout and paint keep the part done in time instead (`budget.truncated` is the limit they stopped at)
+    # Note: the stages share objects, eg, the styles are attached to the nodes of `dom` and layout is
+    # stored in the render objects of `render_tree` (which are painted)
+    def __init__(self, engine: Engine, html, style_sheets: List[str] = (), width=1000, height=600,
+                 layout_mode='scalar', lazy_text: layout.LazyTextLayout = None, cssom=None, budget: Budget = None,
+                 css_diagnostics: utils.Diagnostics = None):
+        assert layout_mode in ['scalar', 'vectorized']
+        assert lazy_text is None or layout_mode == 'scalar', 'lazy text is not supported by the vectorized layout'
+        self.engine = engine
+        self.html = html
+        self.style_sheets = list(style_sheets)
+        self.width, self.height = width, height
+        self.layout_mode = layout_mode
+        self.lazy_text = lazy_text
+        self._cssom = cssom
+        self.diagnostics = html_parser.Diagnostics()  # errors recovered from while parsing the html
+        # errors recovered from while parsing the style sheets
+        self.css_diagnostics = utils.Diagnostics() if css_diagnostics is None else css_diagnostics
+        self.budget = budget
+        self.stages = {}  # stage name to its result
+        self.timings = {}  # stage name to the time it took (in seconds)
+
+    @property
+    def source(self):
+        # html source, either a string or a memory map (large files)
+        if isinstance(self.html, Future):
+            self.html = self.html.result()
+        return self.html
+
+    @stage()
+    def dom(self) -> html_parser.DOMNode:
+        return html_parser.parse(self.source, self.diagnostics, self.budget)
+
+    @property
+    def title(self) -> str:
+        return html_parser.get_page_title(self.dom)
+
+    @stage()
+    def cssom(self) -> CSSOM:
+        # user's style sheets are layered over the browser styles (later ones take precedence)
+        if self._cssom is not None:
+            return self._cssom.result() if isinstance(self._cssom, Future) else self._cssom
+        cssom = self.engine.user_agent_cssom.layer()
+        if self.budget is not None:
+            self.budget.start('cssom')
+        for style_sheet in self.style_sheets:
+            if self.budget is not None:
+                self.budget.check_time()
+            cssom = css_parser.parse(style_sheet, cssom, self.css_diagnostics)
+        return cssom
+
+    @stage('dom', 'cssom')
+    def styled_dom(self) -> html_parser.DOMNode:
+        attachment.attach_styles(self.dom, self.cssom, self.budget)
+        return self.dom
+
+    @stage('styled_dom')
+    def render_tree(self) -> RenderBlock:
+        return renderer.construct_render_tree(self.styled_dom, self.budget)
+
+    @stage('render_tree')
+    def layout_tree(self) -> RenderBlock:
+        # render tree once it's laid out in the viewport
+        construct_layout(self.render_tree, self.width, self.height, self.layout_mode, self.lazy_text, self.budget)
+        return self.render_tree
+
+    @stage('layout_tree')
+    def display_list(self) -> paint.DisplayList:
+        return paint.construct_display_list(self.layout_tree, self.budget)
+
+    @stage('display_list')
+    def hit_test_index(self) -> hit_test.HitTestIndex:
+        return hit_test.HitTestIndex(self.display_list)
+
+    def element_from_point(self, x: int, y: int, x_offset=0, y_offset=0):
+        # Topmost block (and the word) at the point of the viewport, painted with the offsets (see `hit_test.py`)
+        return self.hit_test_index.element_from_point(x, y, x_offset, y_offset)
+
+    @stage('display_list')
+    def text_index(self) -> find_in_page.TextIndex:
+        return find_in_page.TextIndex(self.display_list)
+
+    def find(self, query: str) -> List[find_in_page.MatchLocation]:
+        # Matches of the query in the laid out text, case insensitive (see `find_in_page.py`)
+        return [self.text_index.locate(offset, len(query)) for offset in self.text_index.find(query)]
+
+    def paint(self, win: pygame.Surface, x_offset=0, y_offset=0, show_layout=False) -> pygame.Rect:
+        # Paints the document onto `win` (scrolled by the offsets), returns the rectangle enclosing the page
+        return paint.paint_display_list(win, self.display_list, x_offset, y_offset, show_layout, self.budget)
+
+    def layout_progressively(self, time_budget: float = None):
+        # Lays out the render tree a part at a time (see `layout.construct_layout_progressively`), yielding after
+        # each part so the part laid out so far can be painted (with `paint.paint_layout`), the layout stage is
+        # complete once it's exhausted
+        # Note: the time of the budget is not checked (it would include the time between the steps)
+        assert self.layout_mode == 'scalar', 'vectorized layout is not progressive'
+        if 'layout_tree' in self.stages:
+            return
+        render_tree = self.render_tree
+        steps = layout.construct_layout_progressively(render_tree, self.width, self.height, time_budget,
+                                                      self.lazy_text)
+        duration = 0  # time spent laying out, excluding the time between the steps
+        while True:
+            start = time.perf_counter()
+            step = next(steps, None)
+            duration += time.perf_counter() - start
+            if step is None:
+                break
+            yield step
+        self.stages['layout_tree'], self.timings['layout_tree'] = render_tree, duration
+        self.engine.trace_stage('layout_tree', duration, render_tree)
+
+    def realize_text(self, viewport_top: int, viewport_height: int) -> int:
+        # Constructs the lines of lazy text near the viewport (see `LazyTextLayout.realize`)
+        # and returns the change in height above the viewport (ie, how much to scroll so the content does not jump)
+        if self.lazy_text is None or not self.lazy_text.blocks:
+            return 0
+        num_blocks = len(self.lazy_text.blocks)
+        scroll_delta = self.lazy_text.realize(viewport_top, viewport_height)
+        if len(self.lazy_text.blocks) != num_blocks:  # blocks have moved, display list is constructed again
+            self.stages.pop('display_list', None)
+            self.stages.pop('hit_test_index', None)
+            self.stages.pop('text_index', None)
+        return scroll_delta
+
+    def render_viewports(self, viewports: List[Tuple[int, int]], workers: int = None) -> List['ViewportRendering']:
+        # Lays out and paints the document in each viewport (width, height), the stages till the render tree
+        # do not depend on the viewport, so they are computed once and shared by all the viewports
+        # Viewports are rendered in parallel by forked processes (which share the render tree copy-on-write),
+        # else (without fork) one after the other
+        # Note: the document's own layout is not changed (it's computed again if it was replaced)
+        render_tree = self.render_tree
+        workers = min(workers or os.cpu_count() or 1, len(viewports))
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=initialize_worker, initargs=(self,)) as executor:
+                return list(executor.map(render_viewport, viewports))
+        renderings = [render_viewport(viewport, self) for viewport in viewports]
+        if 'layout_tree' in self.stages:  # render tree has the layout of the last viewport
+            del self.stages['layout_tree']
+            self.stages.pop('display_list', None)
+            self.stages.pop('hit_test_index', None)
+            self.stages.pop('text_index', None)
+        return renderings
+
+    def render_snapshot(self, directory: str, name='snapshot', band_height=SNAPSHOT_BAND_HEIGHT,
+                        workers: int = None) -> List['SnapshotBand']:
+        # Paints the entire page (as wide as the viewport and as tall as the page) into horizontal bands of
+        # `band_height` pixels, each written to `<directory>/<name>-<index>.png`, so no surface (or image) of the
+        # entire page is held. Bands are painted in parallel by forked processes (which share the laid out render tree
+        # and display list copy-on-write), else (without fork) one after the other
+        # Note: fixed blocks are painted once, where they are on the page scrolled to the top
+        display_list = self.display_list  # computed before forking, so the workers do not compute it again
+        page_height = max(self.height, display_list.containing_rect.bottom)
+        # borders are thick lines, which are not drawn at all once their center line is outside the surface, so bands
+        # are painted with the widest border above and below them (and cropped), ie, borders across bands are whole
+        overlap = max((max(ro.box_model.border_top, ro.box_model.border_right, ro.box_model.border_bottom,
+                           ro.box_model.border_left) for ro in display_list.blocks), default=0)
+        display_list.tiles  # noqa, blocks are indexed once, so a band only goes through the blocks extending over it
+        bands = [(index, top, min(band_height, page_height - top), overlap,
+                  os.path.join(directory, f'{name}-{index}.png'))
+                 for index, top in enumerate(range(0, page_height, band_height))]
+        workers = min(workers or os.cpu_count() or 1, len(bands))
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=initialize_worker, initargs=(self,)) as executor:
+                return list(executor.map(render_snapshot_band, bands))
+        return [render_snapshot_band(band, self) for band in bands]
+
+
+class ViewportRendering:
+    # Page rendered in a viewport, `image` is a PNG of the viewport and `page_rect` encloses the entire page
+    def __init__(self, width: int, height: int, image: bytes, page_rect: Tuple[int, int, int, int], timings: dict):
+        self.width, self.height = width, height
+        self.image = image
+        self.page_rect = page_rect
+        self.timings = timings  # CPU time taken by layout, paint and encoding the image (in seconds)
+
+    def __repr__(self):
+        return f'ViewportRendering({self.width}x{self.height}, page={self.page_rect})'
+
+
+class SnapshotBand:
+    # Band of a snapshot of the entire page, from `top` (of the page) and `height` pixels tall, written to `path`
+    def __init__(self, index: int, top: int, width: int, height: int, path: str, timings: dict):
+        self.index = index
+        self.top = top
+        self.width, self.height = width, height
+        self.path = path
+        self.timings = timings  # CPU time taken by paint and encoding the image (in seconds)
+
+    def __repr__(self):
+        return f'SnapshotBand({self.index}, top={self.top}, {self.width}x{self.height})'
+
+
+# Document rendered by a worker process (forked), ie, its viewports or the bands of its snapshot
+_worker_document = None
+
+
+def initialize_worker(document: Document):
+    global _worker_document
+    _worker_document = document
+
+
+def render_viewport(viewport: Tuple[int, int], document: Document = None) -> ViewportRendering:
+    # Lays out and paints the render tree of the document (of the worker process by default) in the viewport
+    # Note: timings are the CPU time of the process, so they're not inflated by other processes rendering in parallel
+    document = document or _worker_document
+    width, height = viewport
+    timings = {}
+    start = time.process_time()
+    construct_layout(document.render_tree, width, height, document.layout_mode)
+    timings['layout'] = time.process_time() - start
+
+    start = time.process_time()
+    win = pygame.Surface((width, height))
+    win.fill(DEFAULT_BROWSER_BACKGROUND)
+    page_rect = paint.paint_layout(win, document.render_tree)
+    timings['paint'] = time.process_time() - start
+
+    start = time.process_time()
+    image = io.BytesIO()
+    pygame.image.save(win, image, 'png')
+    timings['encode'] = time.process_time() - start
+    return ViewportRendering(width, height, image.getvalue(), tuple(page_rect), timings)
+
+
+def render_snapshot_band(band: Tuple[int, int, int, int, str], document: Document = None) -> SnapshotBand:
+    # Paints a band (index, top, height, overlap and path) of the laid out document (of the worker process by default),
+    # along with `overlap` pixels above and below it, and writes the band as a PNG file
+    document = document or _worker_document
+    index, top, height, overlap, path = band
+    timings = {}
+    start = time.process_time()
+    win = pygame.Surface((document.width, height + 2 * overlap))
+    win.fill(DEFAULT_BROWSER_BACKGROUND)
+    paint.paint_display_list(win, document.display_list, 0, overlap - top, fixed_in_page=True)
+    timings['paint'] = time.process_time() - start
+
+    start = time.process_time()
+    pygame.image.save(win.subsurface((0, overlap, document.width, height)), path)
+    timings['encode'] = time.process_time() - start
+    return SnapshotBand(index, top, document.width, height, path, timings)
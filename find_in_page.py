@@ -0,0 +1,100 @@
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+from typing import List
+
+import pygame
+
+from paint import DisplayList
+
+# Find in page, ie, the matches of a query in the text of the page (case insensitive)
+# The texts of all the laid out lines are concatenated once the display list is constructed (in paint order),
+# so a query is a `str.find` over one string instead of a walk over the lines of every block. A match is an offset
+# in the concatenated text, mapped back to its render text (and then to its words and lines) only when it's shown
+# Texts are separated by `SEPARATOR`, so matches do not span render texts (eg, across `<b>` or blocks)
+# Note: only the first `MAX_MATCHES` matches are found, a query which extends the previous one (eg, while typing)
+# is refined from the previous matches (when they are all the matches)
+SEPARATOR = '\n'
+MAX_MATCHES = 10000
+
+# block of the match, and the rectangles of the match on each of its words (in page coordinates, except for
+# fixed blocks which are in viewport coordinates)
+MatchLocation = namedtuple('MatchLocation', ['block', 'rects'])
+
+
+class TextIndex:
+    def __init__(self, display_list: DisplayList):
+        self.starts = array('Q')  # offset of each render text in `text`
+        self.blocks = []  # block of each render text
+        self.text_indexes = array('I')  # index of each render text in the lines of its block
+        self.line_tops = {}  # lines object to the top of each line, on first location
+        texts, offset = [], 0
+        for ro in display_list.blocks:
+            if not ro.lines_object:
+                continue
+            for text_index, text_object in enumerate(ro.lines_object.text_objects):
+                texts.append(text_object.node.text)
+                self.starts.append(offset)
+                self.blocks.append(ro)
+                self.text_indexes.append(text_index)
+                offset += len(texts[-1]) + len(SEPARATOR)
+        self.text = SEPARATOR.join(texts).lower()
+        if len(self.text) != offset - len(SEPARATOR) * bool(texts):
+            # lower case of a few characters is longer (eg, 'İ'), such texts are matched as is
+            self.text = SEPARATOR.join(text.lower() if len(text.lower()) == len(text) else text for text in texts)
+        self.query = None  # last query and its matches, refined by the next query if it extends this one
+        self.matches = []
+        self.complete = False  # whether the matches are all the matches of the query
+
+    def find(self, query: str, limit=MAX_MATCHES) -> List[int]:
+        # Offsets of the (first `limit`) matches of the query, in the order of the page
+        query = query.lower()
+        if not query or SEPARATOR in query:
+            matches = []
+        elif self.query and query.startswith(self.query) and self.complete:
+            # the matches of a longer query are among the matches of the previous one
+            startswith = self.text.startswith
+            matches = [offset for offset in self.matches if startswith(query, offset)][:limit]
+        else:
+            matches, find, start = [], self.text.find, 0
+            while len(matches) < limit:
+                offset = find(query, start)
+                if offset < 0:
+                    break
+                matches.append(offset)
+                start = offset + 1  # matches may overlap, as the matches refined from the previous query
+        self.query, self.matches, self.complete = query, matches, len(matches) < limit
+        return matches
+
+    def locate(self, offset: int, length: int) -> MatchLocation:
+        # Block of the match (of `length` characters at the offset) and its rectangles (one on each word it spans)
+        part = bisect_right(self.starts, offset) - 1
+        ro, text_index = self.blocks[part], self.text_indexes[part]
+        lines = ro.lines_object
+        start = offset - self.starts[part]
+        end = start + length
+        text = lines.text_objects[text_index].node.text
+        font = lines.font(text_index)
+        if lines not in self.line_tops:
+            self.line_tops[lines] = list(accumulate(lines.line_heights, initial=0))
+        line_tops, line_heights = self.line_tops[lines], lines.line_heights
+        word_ends, word_widths, run_starts, run_offsets = (lines.word_ends, lines.word_widths, lines.run_starts,
+                                                           lines.run_offsets)
+        first_word, end_word = lines.text_starts[text_index], lines.text_starts[text_index + 1]
+        rects = []
+        word = bisect_right(word_ends, start, first_word, end_word)  # first word ending after the start
+        while word < end_word:
+            word_start = word_ends[word - 1] if word > first_word else 0
+            if word_start >= end:
+                break
+            run = bisect_right(run_starts, word) - 1
+            line = bisect_right(lines.line_starts, run) - 1
+            # words of the run are placed by their widths, the part of the word before the match by its own width
+            left = run_offsets[run] + sum(word_widths[run_starts[run]:word])
+            match_start, match_end = max(start, word_start), min(end, word_ends[word])
+            left += font.size(text[word_start:match_start])[0] if match_start > word_start else 0
+            rects.append(pygame.Rect(ro.box_model.content_left + left, ro.box_model.content_top + line_tops[line],
+                                     font.size(text[match_start:match_end])[0], line_heights[line]))
+            word += 1
+        return MatchLocation(ro, rects)
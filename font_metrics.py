@@ -0,0 +1,166 @@
+import os
+import pickle
+import re
+import sys
+from array import array
+
+import pygame
+
+from utils import iter_chunks
+
+try:  # long texts are measured with NumPy when it is available
+    import numpy as np
+except ImportError:
+    np = None
+
+# Font metric tables: advance width and height of each character in the common character ranges
+# (Basic Latin, Latin-1 Supplement and Latin Extended-A), so word widths are computed by summing table lookups
+# instead of measuring every word with `font.size` (words with other characters are still measured)
+# Note: `font.size` rounds and kerns glyph positions within the word, so widths computed from the tables can be
+# a pixel or two narrower than the words' `font.size` (heights are the same), enable validation to report them
+TABLE_SIZE = 0x180
+# texts at least this long are measured with NumPy, summing lookups in python is about as fast as `font.size`
+VECTORIZE_THRESHOLD = 64
+# Tables are computed once for each font and are cached next to the compiled python modules
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'font_metrics.pickle')
+
+# Same as the words of `text_layout`, ie, non white space characters followed by (at most) a white space character
+WORD_REGEX = re.compile(r'\S*\s|\S+\Z')
+# white space characters (all of them are below U+3001)
+WHITE_SPACES = [code for code in range(0x3001) if chr(code).isspace()]
+
+validate = False  # compare every width with `font.size`, differences are recorded in `divergences`
+divergences = []  # (font key, word, width from the tables, width from `font.size`)
+run_divergences = []  # same for the runs of words (of a line) whose widths are summed from the words' widths
+REPORTED_TEXT_SIZE = 60  # characters of a diverged word or run that are reported
+
+
+class FontMetrics:
+    # Advance widths and heights of the characters (indexed by code point) of a font
+    def __init__(self, font: pygame.font.Font, key, advances: array = None, heights: array = None):
+        self.font = font
+        self.key = key  # identifies the font (see `font_key`)
+        if advances is None:
+            sizes = [font.size(chr(code)) for code in range(TABLE_SIZE)]
+            advances, heights = array('H', [size[0] for size in sizes]), array('H', [size[1] for size in sizes])
+        self.advances, self.heights = advances, heights
+        # height of a word is the height of its tallest character, most characters have the least height
+        self.least_height = min(heights)
+        self.tall_characters = {chr(code) for code in range(TABLE_SIZE) if heights[code] > self.least_height}
+        self.advances_array = self.heights_array = self.white_spaces = None  # NumPy tables, created on first use
+
+    def measure(self, text: str):
+        # Returns the end offsets, widths and heights of the words in the text
+        if np is not None and len(text) >= VECTORIZE_THRESHOLD:
+            ends, widths, heights = self.measure_vectorized(text)
+        else:
+            ends, widths, heights = [], [], []
+            advance, height = self.advances.__getitem__, self.heights.__getitem__
+            least_height, tall_characters = self.least_height, self.tall_characters
+            end = 0
+            for word in WORD_REGEX.findall(text):
+                end += len(word)
+                try:
+                    widths.append(sum(map(advance, map(ord, word))))
+                    heights.append(least_height if tall_characters.isdisjoint(word) else
+                                   max(map(height, map(ord, word))))
+                except IndexError:  # characters outside the tables
+                    del widths[len(heights):]
+                    width, word_height = self.font.size(word)
+                    widths.append(width)
+                    heights.append(word_height)
+                ends.append(end)
+        if validate:
+            self.validate(text, ends, widths)
+        return ends, widths, heights
+
+    def iter_measure(self, text: str):
+        # Same as `measure`, a chunk of the text at a time (see `utils.iter_chunks`), so long texts need no lists
+        # (and arrays) of all their words and characters, ends are offsets in the whole text
+        for start, end in iter_chunks(text):
+            ends, widths, heights = self.measure(text[start:end] if start or end < len(text) else text)
+            yield [start + word_end for word_end in ends] if start else ends, widths, heights
+
+    def measure_vectorized(self, text: str):
+        # Same as `measure`, words are split and summed as array operations
+        if self.advances_array is None:
+            self.advances_array = np.array(self.advances, dtype=np.int64)
+            self.heights_array = np.array(self.heights, dtype=np.int64)
+            self.white_spaces = np.zeros(WHITE_SPACES[-1] + 2, dtype=bool)
+            self.white_spaces[WHITE_SPACES] = True
+        codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        is_space = self.white_spaces[np.minimum(codes, len(self.white_spaces) - 1)]
+        ends = np.flatnonzero(is_space) + 1
+        if not is_space[-1]:
+            ends = np.append(ends, len(codes))
+        starts = np.concatenate(([0], ends[:-1]))
+        in_table = codes < TABLE_SIZE
+        table_codes = codes * in_table
+        widths = np.add.reduceat(self.advances_array[table_codes], starts)
+        heights = np.maximum.reduceat(self.heights_array[table_codes], starts)
+        ends, widths, heights = ends.tolist(), widths.tolist(), heights.tolist()
+        # words with characters outside the tables are measured
+        if not in_table.all():
+            for index in np.flatnonzero(~np.logical_and.reduceat(in_table, starts)).tolist():
+                widths[index], heights[index] = self.font.size(text[ends[index - 1] if index else 0:ends[index]])
+        return ends, widths, heights
+
+    def validate(self, text: str, ends, widths):
+        start = 0
+        for end, width in zip(ends, widths):
+            exact_width = self.font.size(text[start:end])[0]
+            if width != exact_width:
+                divergences.append((self.key, text[start:end], width, exact_width))
+            start = end
+
+    def validate_run(self, text: str, width: int):
+        exact_width = self.font.size(text)[0]
+        if width != exact_width:
+            run_divergences.append((self.key, text, width, exact_width))
+
+
+def font_key(font_type, font_name: str):
+    # Tables are computed again when the font or the font renderer changes
+    return font_type, font_name, pygame.font.match_font(font_name), pygame.version.ver, \
+        pygame.font.get_sdl_ttf_version()
+
+
+def load_font_metrics(fonts):
+    # Returns the metrics of each font, `fonts` is a map of font key to pygame font
+    # Tables are read from the cache, and only missing tables are computed (and cached)
+    tables = {}
+    try:
+        with open(CACHE_FILE, 'rb') as f_cache:
+            tables = pickle.load(f_cache)
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+        pass  # missing or stale cache, compute them again
+
+    font_metrics, missing = {}, False
+    for key, font in fonts.items():
+        if key in tables:
+            font_metrics[font] = FontMetrics(font, key, *tables[key])
+        else:
+            font_metrics[font] = FontMetrics(font, key)
+            tables[key] = font_metrics[font].advances, font_metrics[font].heights
+            missing = True
+
+    if missing:
+        try:
+            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+            with open(CACHE_FILE, 'wb') as f_cache:
+                pickle.dump(tables, f_cache, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass  # caching is an optimization, not being able to write it is fine
+    return font_metrics
+
+
+def report_divergences(file=sys.stderr, limit=10):
+    # Prints the words and runs whose widths from the tables differ from `font.size`
+    for name, diverged in [('words', divergences), ('runs', run_divergences)]:
+        if not diverged:
+            print(f'Font metrics: widths of all the {name} are same as font.size', file=file)
+            continue
+        print(f'Font metrics: widths of {len(diverged)} {name} differ from font.size', file=file)
+        for (font_type, *_), text, width, exact_width in diverged[:limit]:
+            text = text if len(text) <= REPORTED_TEXT_SIZE else text[:REPORTED_TEXT_SIZE] + '...'
+            print(f'  {text!r} in {font_type}: {width} instead of {exact_width}', file=file)
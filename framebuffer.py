@@ -0,0 +1,221 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import pygame
+
+if os.name == 'posix':
+    import _posixshmem
+
+# Frames painted into shared memory, so other processes (eg, a video encoder or an inspector) read the pixels
+# without copies, instead of screenshots of the window. The buffer is a header followed by `num_slots` frames,
+# frames are written to the slots in turn (frame n to slot n % num_slots), while readers read the latest frame
+# (so a reader has till the writer comes back to that slot to read it)
+#
+#   header  magic, version, width, height, pitch (bytes per row), number of slots, latest frame (0 if none)
+#           and closed (1 once the writer is closed)
+#   slot    sequence, time (`time.time()` when published), x offset and y offset (the scroll offsets the frame
+#           was painted with), followed by the pixels (height rows of pitch bytes, BGRA, ie, 4 bytes per pixel)
+# A slot's sequence is 2 * n once frame n is published, and odd while it's being written, so a reader checks
+# the sequence again once it has read the pixels (see `FrameReader.is_valid`)
+# Note: fields are written by single aligned stores (8 bytes at most), a reader sees either the old or new value
+MAGIC = b'BRFB'
+VERSION = 1
+NUM_SLOTS = 3
+PIXEL_FORMAT = 'BGRA'  # same order as the surfaces of pygame, blitting to other orders is a lot slower
+HEADER = struct.Struct('<4sIIIIIQI')
+SLOT_HEADER = struct.Struct('<Qdii')
+LATEST_OFFSET = 24  # offset of latest frame in the header
+CLOSED_OFFSET = 32
+ALIGNMENT = 64  # header, slots and their pixels start at multiples of it
+PIXELS_OFFSET = (SLOT_HEADER.size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+# frame read from the buffer, pixels is a view of the slot's pixels in shared memory (valid till the slot
+# is written again)
+Frame = namedtuple('Frame', ['number', 'width', 'height', 'pitch', 'pixels', 'time', 'x_offset', 'y_offset'])
+
+
+def align(size: int):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def slot_offset(slot: int, pitch: int, height: int):
+    # offset of the slot's header, its pixels are at `PIXELS_OFFSET` from it
+    return align(HEADER.size) + slot * (PIXELS_OFFSET + align(pitch * height))
+
+
+class FrameBuffer:
+    # Writer of the frames, creates the shared memory (with a random name by default, see `name`)
+    #
+    #   framebuffer = FrameBuffer(1000, 600)
+    #   surface = framebuffer.begin()           # surface backed by the next slot
+    #   document.paint(surface, 0, scroll_top)
+    #   framebuffer.publish(0, scroll_top)       # readers see it as the latest frame
+    def __init__(self, width: int, height: int, name: str = None, num_slots=NUM_SLOTS):
+        assert width > 0 and height > 0 and num_slots > 1
+        self.width, self.height, self.num_slots = width, height, num_slots
+        self.pitch = width * 4
+        self.shared_memory = shared_memory.SharedMemory(name, create=True,
+                                                        size=slot_offset(num_slots, self.pitch, height))
+        buffer = self.shared_memory.buf
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, width, height, self.pitch, num_slots, 0, 0)
+        self.views, self.surfaces = [], []  # pixels of each slot, and the surface painting into them
+        for slot in range(num_slots):
+            offset = slot_offset(slot, self.pitch, height)
+            SLOT_HEADER.pack_into(buffer, offset, 0, 0.0, 0, 0)
+            view = buffer[offset + PIXELS_OFFSET:offset + PIXELS_OFFSET + self.pitch * height]
+            self.views.append(view)
+            self.surfaces.append(pygame.image.frombuffer(view, (width, height), PIXEL_FORMAT))
+        self.frame = 0  # latest published frame
+        self.writing = False
+
+    @property
+    def name(self):  # readers attach by this name
+        return self.shared_memory.name
+
+    def begin(self) -> pygame.Surface:
+        # Surface of the next frame, whose slot is marked as being written till it's published
+        # Note: it has the pixels of the frame `num_slots` frames before, paint it entirely
+        frame, slot = self.frame + 1, (self.frame + 1) % self.num_slots
+        struct.pack_into('<Q', self.shared_memory.buf, slot_offset(slot, self.pitch, self.height), 2 * frame - 1)
+        self.writing = True
+        return self.surfaces[slot]
+
+    def publish(self, x_offset=0, y_offset=0) -> int:
+        # Publishes the frame painted since `begin` as the latest frame, returns its number
+        assert self.writing, 'begin the frame before publishing it'
+        self.frame += 1
+        buffer = self.shared_memory.buf
+        SLOT_HEADER.pack_into(buffer, slot_offset(self.frame % self.num_slots, self.pitch, self.height),
+                              2 * self.frame, time.time(), x_offset, y_offset)
+        struct.pack_into('<Q', buffer, LATEST_OFFSET, self.frame)
+        self.writing = False
+        return self.frame
+
+    def close(self):
+        # Marks the buffer closed (readers stop) and removes it, readers attached keep their mapping
+        struct.pack_into('<I', self.shared_memory.buf, CLOSED_OFFSET, 1)
+        self.surfaces.clear()  # surfaces hold the views, which should be released before closing
+        for view in self.views:
+            view.release()
+        self.views.clear()
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+class FrameReader:
+    # Reader of the frames of a `FrameBuffer` (in any process), by its name
+    def __init__(self, name: str):
+        # the memory is mapped without `SharedMemory` on posix, which would register it to be removed when this
+        # process exits (before python 3.13), ie, while the writer is still using it
+        if os.name == 'posix':
+            fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+            try:
+                self.mapping = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            self.buffer = memoryview(self.mapping)
+        else:
+            self.mapping = shared_memory.SharedMemory(name)
+            self.buffer = self.mapping.buf
+        buffer, self.views = self.buffer, []
+        magic, version, self.width, self.height, self.pitch, self.num_slots, _, _ = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise Exception(f'{name} is not a frame buffer (version {VERSION})')
+        for slot in range(self.num_slots):
+            offset = slot_offset(slot, self.pitch, self.height) + PIXELS_OFFSET
+            self.views.append(buffer[offset:offset + self.pitch * self.height])
+
+    @property
+    def latest(self) -> int:  # number of the latest frame, 0 if none
+        return struct.unpack_from('<Q', self.buffer, LATEST_OFFSET)[0]
+
+    @property
+    def closed(self) -> bool:
+        return struct.unpack_from('<I', self.buffer, CLOSED_OFFSET)[0] == 1
+
+    def read(self, after=0):
+        # Latest frame if it's newer than frame `after`, else None, its pixels are not copied
+        # Note: check `is_valid` once the pixels are read, the writer may have come back to the slot in the meanwhile
+        while True:
+            number = self.latest
+            if number <= after:
+                return None
+            slot = number % self.num_slots
+            sequence, published, x_offset, y_offset = SLOT_HEADER.unpack_from(
+                self.buffer, slot_offset(slot, self.pitch, self.height))
+            if sequence == 2 * number:
+                return Frame(number, self.width, self.height, self.pitch, self.views[slot], published, x_offset,
+                             y_offset)
+            # slot is being written (with a newer frame), read the latest again
+
+    def is_valid(self, frame: Frame) -> bool:
+        # Whether the frame's pixels were not overwritten (since it was read)
+        slot_header = slot_offset(frame.number % self.num_slots, self.pitch, self.height)
+        return struct.unpack_from('<Q', self.buffer, slot_header)[0] == 2 * frame.number
+
+    def surface(self, frame: Frame) -> pygame.Surface:
+        # Copy of the frame as a surface (eg, to save it as an image)
+        return pygame.image.frombuffer(bytes(frame.pixels), (frame.width, frame.height), PIXEL_FORMAT)
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.buffer.release()
+        self.mapping.close()
+
+
+def consume(name: str, duration: float = None, save: str = None, poll_interval=0.001, log=sys.stderr):
+    # Reads the frames of the buffer till it's closed (or for `duration` seconds), and reports (to `log`) the frames
+    # read, the frames missed (published but not read, as newer frames were published by then) and the frames torn
+    # (overwritten while being read). With `save`, the last frame is saved as an image
+    reader = FrameReader(name)
+    if log:
+        print(f'{name}: {reader.width}x{reader.height}, {reader.num_slots} slots', file=log)
+    start = time.perf_counter()
+    frames_read = missed = torn = 0
+    last, first, last_frame = 0, None, None
+    try:
+        while not reader.closed and (duration is None or time.perf_counter() - start < duration):
+            frame = reader.read(last)
+            if frame is None:
+                time.sleep(poll_interval)
+                continue
+            first = first or frame.number
+            missed += frame.number - last - 1 if last else 0
+            # a consumer would process the pixels here (eg, pass the view to an encoder)
+            if not reader.is_valid(frame):
+                torn += 1
+            else:
+                frames_read += 1
+                if save:
+                    last_frame = reader.surface(frame)
+                    if not reader.is_valid(frame):
+                        last_frame = None
+            last = frame.number
+        duration = time.perf_counter() - start
+        if log:
+            print(f'{frames_read} frames read in {duration:.3f} s ({frames_read / duration:.1f} fps), '
+                  f'{missed} missed, {torn} torn (frames {first}..{last})', file=log)
+        if save and last_frame is not None:
+            pygame.image.save(last_frame, save)
+    finally:
+        reader.close()
+    return frames_read, missed, torn
+
+
+if __name__ == '__main__':
+    # Local consumer, eg, `python main.py --framebuffer frames` in one terminal and `python framebuffer.py frames`
+    parser = argparse.ArgumentParser(description='Reads the frames of a shared memory frame buffer')
+    parser.add_argument('name', type=str, help='name of the frame buffer')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to read for (till closed by default)')
+    parser.add_argument('--save', type=str, default=None, help='save the last frame read as an image')
+    args = parser.parse_args()
+    consume(args.name, args.duration, args.save)
@@ -0,0 +1,87 @@
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+
+from paint import DisplayList
+from render_object import RenderBlock
+from text_layout import WordObject
+from tile_index import TileIndex
+
+# Hit testing, ie, the block (and the word) under a point of the viewport, eg, under the mouse
+# Blocks are indexed by their vertical extent once the display list is constructed (after layout), in a tile index
+# (see `tile_index.py`), so a point is tested only against the blocks of its tile in each level
+# Topmost block is the one painted last, blocks are numbered in the order of the display list (see `paint.py`)
+
+# block is the topmost block at the point and word is the WordObject at the point (None when not on a word)
+Hit = namedtuple('Hit', ['block', 'word'])
+
+
+class HitTestIndex:
+    def __init__(self, display_list: DisplayList):
+        self.blocks = display_list.blocks
+        # border box (left, top, right, bottom) of each block, in page coordinates
+        # except fixed blocks which are in viewport coordinates (they are painted without scrolling)
+        self.rects = []
+        self.tiles = TileIndex()  # blocks by their border box (in paint order)
+        self.fixed_blocks = []  # fixed blocks are tested separately, with the point in viewport coordinates
+        self.line_tops = {}  # lines object to the top of each line (and the bottom of the last line), on first hit
+        for index, ro in enumerate(self.blocks):
+            left, top, width, height = ro.box_model.border_rect
+            self.rects.append((left, top, left + width, top + height))
+            if width <= 0 or height <= 0:
+                continue
+            if ro.position == 'fixed':
+                self.fixed_blocks.append(index)
+                continue
+            self.tiles.add(index, top, top + height)
+
+    def block_index(self, x: int, y: int, x_offset=0, y_offset=0) -> int:
+        # Paint index of the topmost block at the point (-1 if none), offsets are the scroll offsets of paint
+        rects, topmost = self.rects, -1
+        for index in reversed(self.fixed_blocks):
+            left, top, right, bottom = rects[index]
+            if left <= x < right and top <= y < bottom:
+                topmost = index
+                break
+        x, y = x - x_offset, y - y_offset  # page coordinates
+        for tile in self.tiles.at(y):
+            for index in reversed(tile):
+                if index <= topmost:
+                    break
+                left, top, right, bottom = rects[index]
+                if left <= x < right and top <= y < bottom:
+                    topmost = index
+                    break
+        return topmost
+
+    def element_from_point(self, x: int, y: int, x_offset=0, y_offset=0):
+        # Returns the Hit at the point of the viewport, None if there are no blocks at the point
+        index = self.block_index(x, y, x_offset, y_offset)
+        if index < 0:
+            return None
+        ro = self.blocks[index]
+        if ro.position != 'fixed':
+            x, y = x - x_offset, y - y_offset
+        return Hit(ro, self.word_at(ro, x - ro.box_model.content_left, y - ro.box_model.content_top))
+
+    def word_at(self, ro: RenderBlock, x: int, y: int):
+        # WordObject of the block's lines at the point (relative to the content box), None if not on a word
+        lines = ro.lines_object
+        if not lines or x < 0 or y < 0:
+            return None
+        if lines not in self.line_tops:
+            self.line_tops[lines] = list(accumulate(lines.line_heights, initial=0))
+        line = bisect_right(self.line_tops[lines], y) - 1
+        if line >= lines.num_lines:
+            return None
+        run_offsets, run_widths, run_starts = lines.run_offsets, lines.run_widths, lines.run_starts
+        for run in range(lines.line_starts[line], lines.line_starts[line + 1]):
+            if run_offsets[run] <= x < run_offsets[run] + run_widths[run]:
+                # words of the run are placed by their widths, the last word takes the rest of the run
+                offset, word_widths = run_offsets[run], lines.word_widths
+                for index in range(run_starts[run], run_starts[run + 1] - 1):
+                    offset += word_widths[index]
+                    if x < offset:
+                        return WordObject(lines, index)
+                return WordObject(lines, run_starts[run + 1] - 1)
+        return None
@@ -1,9 +1,17 @@
 from __future__ import annotations
 from typing import Union, List
-from utils import get_line_no, format_styles
+from functools import cached_property
+from utils import format_styles, count_newlines, rfind_newline, decode, iter_chunks, Diagnostics
+from budget import Budget
 import re
 
 
+# Texts are spaced, ie, a space at word beginnings (after punctuation, eg, 'a,b' is 'a, b') and white space collapsed
+# into single spaces, by joining their pieces (words along with the punctuation following them, and punctuation
+# before the first word) with spaces, a chunk at a time (see `utils.iter_chunks`)
+TEXT_PIECE = re.compile(r'[^\w\s]+|\w+[^\w\s]*')
+
+
 class Token:
     def __init__(self, kind, value, line, column):
         self.kind = kind
@@ -23,8 +31,9 @@ class Token:
         return f'TOKEN {self.kind} (line {self.line}, column {self.column}) {self.value!r} {attributes}'
 
 
-def tokenize(html):
-    # Converts HTML Page into tokens
+def tokenize(html, budget: Budget = None):
+    # Converts HTML Page (a string or a bytes-like buffer, eg, memory map) into tokens
+    # With `budget`, nodes (start, self-closing and text tokens) and words of the texts are counted as they're found
     attribute = r'''[\w-]+=([\w-]+|'[\w\s-]+'|"[\w\s-]+")'''
     token_specification = [
         ('COMMENT', r'<!--.*?-->'),
@@ -37,28 +46,55 @@ def tokenize(html):
         ('EXCEPTION', r'.+'),
     ]
     regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
+    if not isinstance(html, str):  # buffers are matched without decoding them, only the tokens are decoded
+        regex = regex.encode()
+    # line and column of tokens (same as `utils.get_line_no` of their start) are tracked incrementally
+    lines, line_start, position = 0, 0, 0
+    num_nodes = num_words = 0
     for m in re.finditer(regex, html, flags=re.DOTALL | re.IGNORECASE):
         kind = m.lastgroup
-        value = m.group()
-        line, column = get_line_no(html, m.start())
+        if budget is not None:
+            budget.tick()
         if kind in ['COMMENT', 'DOCTYPE', 'SPACE']:
             # Ignored, not part of DOM
             continue
-        elif kind == 'TEXT':
-            value = re.sub(r'\b(?=\w)', r' ', value)  # add spacing at word beginnings
-            value = re.sub(r'\s+', r' ', value).strip()  # remove unnecessary spacing
-            yield Token(kind, value, line, column)
+        end = m.start() + 1
+        newlines = count_newlines(html, position, end)
+        if newlines:
+            lines += newlines
+            line_start = rfind_newline(html, position, end) + 1
+        position = end
+        line, column = lines, end - line_start
+        if kind == 'TEXT':
+            # texts are decoded and spaced a chunk at a time, instead of copies of the whole text
+            if budget is not None:
+                num_nodes += 1
+                budget.check('nodes', num_nodes)
+            chunks = []
+            for chunk_start, chunk_end in iter_chunks(html, m.start(), m.end()):
+                chunk = decode(html[chunk_start:chunk_end])
+                if budget is not None:  # checked before the chunk is spaced
+                    num_words += len(chunk.split())
+                    budget.check('words', num_words)
+                spaced_chunk = ' '.join(TEXT_PIECE.findall(chunk))
+                if spaced_chunk:
+                    chunks.append(spaced_chunk)
+            yield Token(kind, ' '.join(chunks), line, column)
         elif kind in ['START', 'CLOSING']:
+            if budget is not None:
+                num_nodes += 1
+                budget.check('nodes', num_nodes)
+            value = decode(m.group())
             tag = re.match(rf'<(?P<TAG>[\w-]+)(\s+{attribute})*\s*/?>', value).group('TAG').lower()  # lower casing
             token = Token(kind, tag, line, column)
             for n in re.finditer(r'''(?P<PROPERTY>[\w-]+)=(?P<VALUE>[\w-]+|'[\w\s-]+'|"[\w\s-]+")''', value):
                 token[n.group('PROPERTY').lower()] = n.group('VALUE').strip("\'\"").lower()  # lower casing
             yield token
         elif kind == 'END':
-            tag = re.match(rf'</(?P<TAG>[\w-]+)\s*>', value).group('TAG').lower()  # lower casing
+            tag = re.match(rf'</(?P<TAG>[\w-]+)\s*>', decode(m.group())).group('TAG').lower()  # lower casing
             yield Token(kind, tag, line, column)
         else:
-            raise Exception(f'Unknown token {value!r} at line {line} column {column}.')
+            raise Exception(f'Unknown token {decode(m.group())!r} at line {line} column {column}.')
 
 
 class DOMNode:
@@ -76,8 +112,8 @@ class DOMNode:
     def id(self):
         return self.attributes.get('id', '')
 
-    @property
-    def classes(self):
+    @cached_property
+    def classes(self):  # attributes do not change once parsed
         return set(self.attributes.get('class', '').split())
 
     def add_child(self, node: Union[DOMNode, TextNode]):
@@ -102,15 +138,23 @@ class TextNode:
         return f'TextNode {self.text!r}'
 
 
-def parse(html):
+def parse(html, diagnostics: Diagnostics = None, budget: Budget = None):
     # Constructs DOM Tree from html text.
-    # Supports some amount of error handling
+    # Supports some amount of error handling (errors are reported to `diagnostics`)
+    # Raises BudgetExceeded when the page crosses the limits of `budget` (nodes, words, depth and time)
     #   - Ignores some unexpected closing tags,
     #   - Can add closing tags when missing
     # However its not perfect as it does it blindly and does not understand the contexts
+    # Note: number of open elements of each tag is tracked, so whether an end tag has a start tag on the stack
+    # is known without scanning the stack, and each element is pushed and popped once (linear in the tokens)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
     stack = []  # contains DOM nodes only from START tokens
+    open_tags = {}  # tag to the number of nodes with the tag on the stack
     root_node = None  # Will contain the document node
-    for token in tokenize(html):
+    if budget is not None:
+        budget.start('parse')
+    for token in tokenize(html, budget):
         if token.kind == 'TEXT':
             node = TextNode(token.value, token)
             if not stack:
@@ -130,41 +174,31 @@ def parse(html):
             else:
                 root_node = node  # The root level node
             stack.append(node)
+            open_tags[node.tag] = open_tags.get(node.tag, 0) + 1
+            if budget is not None:
+                budget.check('depth', len(stack))
         elif token.kind == 'END':
             if not stack:
                 raise Exception(f'Unexpected end tag `{token.value}` '
                                 f'at line {token.line} and column {token.column}')
-            if stack[-1].tag != token.value:
-                # If unexpected closing tag
-                print(f'Unexpected tag `{token.value}` at line {token.line} and column {token.column}')
-                temp_stack = stack[:]
-                while temp_stack[-1].tag != token.value:
-                    temp_stack.pop()
-                    if not temp_stack:
-                        print(f'Cannot find corresponding start tag for end tag `{token.value}` '
-                              f'at line {token.line} and column {token.column}. Ignoring it.')
-                        # Just ignore that closing tag
-                        break
-                else:
-                    # If corresponding start tag found
-                    while stack[-1].tag != token.value:
-                        # Pop out values till it match
-                        node = stack.pop()
-                        print(f'Automatically closing start tag `{node.tag}` '
-                              f'at line {node.token.line} and column {node.token.column}')
-                    # Pop out the matching tag
-                    stack.pop()
-            else:
-                # If matching closing tag
-                stack.pop()  # Pop out the matching tag
+            if not open_tags.get(token.value):
+                # If no corresponding start tag, just ignore that closing tag
+                diagnostics.report('Ignoring end tag without a start tag', token)
+                continue
+            # Pop out values till it match (if unexpected closing tag), and the matching tag
+            while True:
+                node = stack.pop()
+                open_tags[node.tag] -= 1
+                if node.tag == token.value:
+                    break
+                diagnostics.report('Automatically closing start tag', node.token)
 
             if not stack:
                 # if stack is exhausted, then rest tokens are not useful
                 break
     while stack:
         node = stack.pop()
-        print(f'Automatically closing start tag `{node.tag}` '
-              f'at line {node.token.line} and column {node.token.column}')
+        diagnostics.report('Automatically closing start tag', node.token)
 
     assert root_node.tag == 'html'
     return root_node
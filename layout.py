@@ -1,9 +1,15 @@
 from __future__ import annotations
-from render_object import RenderBlock
+from render_object import RenderBlock, RenderText, NO_OBJECT
 from css_properties import *
-from text_layout import construct_render_lines
+from text_layout import construct_render_lines, estimate_lines_height, get_text_objects
+import text_layout
 from box_model import BoxModel
+from budget import Budget
+import heapq
 import re
+import time
+from collections import OrderedDict
+from operator import itemgetter
 
 
 def compute_width(css_width: str, available_width: int, allow_auto=False):
@@ -24,40 +30,153 @@ def compute_box_model_properties(ro: RenderBlock, available_width: int, availabl
     # Note most properties are dependent on available width, unlike expectations
     # since height is not available upfront is most cases
     # following box model properties values are in either px or %
-    ro.box_model.margin_left = compute_width(ro.node.styles[MARGIN_LEFT], available_width)
-    ro.box_model.margin_right = compute_width(ro.node.styles[MARGIN_RIGHT], available_width)
-    ro.box_model.margin_top = compute_width(ro.node.styles[MARGIN_TOP], available_width)
-    ro.box_model.margin_bottom = compute_width(ro.node.styles[MARGIN_BOTTOM], available_width)
-
-    ro.box_model.padding_left = compute_width(ro.node.styles[PADDING_LEFT], available_width)
-    ro.box_model.padding_right = compute_width(ro.node.styles[PADDING_RIGHT], available_width)
-    ro.box_model.padding_top = compute_width(ro.node.styles[PADDING_TOP], available_width)
-    ro.box_model.padding_bottom = compute_width(ro.node.styles[PADDING_BOTTOM], available_width)
-
-    ro.box_model.border_left = compute_width(ro.node.styles[BORDER_LEFT], available_width)
-    ro.box_model.border_right = compute_width(ro.node.styles[BORDER_RIGHT], available_width)
-    ro.box_model.border_top = compute_width(ro.node.styles[BORDER_TOP], available_width)
-    ro.box_model.border_bottom = compute_width(ro.node.styles[BORDER_BOTTOM], available_width)
-
-    if ro.node.styles[WIDTH] == 'auto':
+    box_model, styles = ro.box_model, ro.node.styles  # render objects are views, look them up once
+    box_model.margin_left = compute_width(styles[MARGIN_LEFT], available_width)
+    box_model.margin_right = compute_width(styles[MARGIN_RIGHT], available_width)
+    box_model.margin_top = compute_width(styles[MARGIN_TOP], available_width)
+    box_model.margin_bottom = compute_width(styles[MARGIN_BOTTOM], available_width)
+
+    box_model.padding_left = compute_width(styles[PADDING_LEFT], available_width)
+    box_model.padding_right = compute_width(styles[PADDING_RIGHT], available_width)
+    box_model.padding_top = compute_width(styles[PADDING_TOP], available_width)
+    box_model.padding_bottom = compute_width(styles[PADDING_BOTTOM], available_width)
+
+    box_model.border_left = compute_width(styles[BORDER_LEFT], available_width)
+    box_model.border_right = compute_width(styles[BORDER_RIGHT], available_width)
+    box_model.border_top = compute_width(styles[BORDER_TOP], available_width)
+    box_model.border_bottom = compute_width(styles[BORDER_BOTTOM], available_width)
+
+    if styles[WIDTH] == 'auto':
         # In case of auto, box model occupies available space
         # ie content width is computed by subtracting margin, border and padding widths
-        ro.box_model.box_width = available_width
+        box_model.box_width = available_width
     else:
         # Based on box-sizing, width will either include or exclude padding and border
         # Note: margin is included in neither of the models
         # https://developer.mozilla.org/en-US/docs/Web/CSS/box-sizing
 
         if box_sizing == 'border-box':  # Box-sizing - border-box - width includes padding and border
-            ro.box_model.width = compute_width(ro.node.styles[WIDTH], available_width)
+            box_model.width = compute_width(styles[WIDTH], available_width)
         else:  # Box-sizing - content-box - width of the content
-            ro.box_model.content_width = compute_width(ro.node.styles[WIDTH], available_width)
+            box_model.content_width = compute_width(styles[WIDTH], available_width)
 
-    if ro.node.styles[HEIGHT] != 'auto':  # `height: auto` needs height of children
+    if styles[HEIGHT] != 'auto':  # `height: auto` needs height of children
         if box_sizing == 'border-box':  # Box-sizing - border-box
-            ro.box_model.height = compute_width(ro.node.styles[HEIGHT], available_height)
+            box_model.height = compute_width(styles[HEIGHT], available_height)
         else:  # Box-sizing - content-box
-            ro.box_model.content_height = compute_width(ro.node.styles[HEIGHT], available_height)
+            box_model.content_height = compute_width(styles[HEIGHT], available_height)
+
+
+def construct_box_model(ro: RenderBlock, available_width: int, available_height: int):
+    # Sets a new box model of the block with the properties that don't need children (see above)
+    ro.box_model = box_model = BoxModel()
+    compute_box_model_properties(ro, available_width, available_height)
+    return box_model
+
+
+# Layout of block subtrees laid out so far (in this process), by their structure (the layout styles, texts and children
+# of their render objects, see `subtree_keys`) and the size available to them. A subtree's layout does not depend on
+# its siblings (they only move it), so a repeated component (eg, a card of a feed, in any document) is replayed,
+# ie, the box models and lines of its blocks are copied, instead of laid out again (see `replay_subtree`)
+# Note: a subtree is memoized once it's seen again (so unique subtrees are not stored), the least recently used
+# subtrees are evicted once the memo exceeds `SUBTREE_MEMO_SIZE` (in render objects and characters of their texts)
+# and larger subtrees than `MAX_MEMOIZED_SUBTREE_SIZE` are not memoized
+SUBTREE_MEMO_SIZE = 1 << 20
+MAX_MEMOIZED_SUBTREE_SIZE = 4096
+SEEN_SUBTREES_SIZE = 1 << 16  # keys of the subtrees seen (once) so far
+SUBTREE_IDS_SIZE = 1 << 18
+subtree_memo = OrderedDict()  # key to (box model arguments and lines of each block, words, size)
+subtree_memo_size = 0
+seen_subtrees = OrderedDict()
+subtree_ids = {}  # structure of a subtree (its object's styles and the ids of its children) to its id
+# styles the layout of a block depends on (besides the structure), and of the inline objects (for their texts)
+get_layout_styles = itemgetter(MARGIN_TOP, MARGIN_RIGHT, MARGIN_BOTTOM, MARGIN_LEFT,
+                               PADDING_TOP, PADDING_RIGHT, PADDING_BOTTOM, PADDING_LEFT,
+                               BORDER_TOP, BORDER_RIGHT, BORDER_BOTTOM, BORDER_LEFT, WIDTH, HEIGHT,
+                               POSITION, TOP, LEFT, BOTTOM, RIGHT, FONT_SIZE, FONT_WEIGHT, FONT_STYLE)
+get_font_styles = itemgetter(FONT_SIZE, FONT_WEIGHT, FONT_STYLE)
+
+
+def clear_memos():
+    # Drops the subtrees memoized so far (eg, between the requests of the render server)
+    global subtree_memo_size
+    subtree_memo.clear()
+    seen_subtrees.clear()
+    subtree_ids.clear()
+    subtree_memo_size = 0
+
+
+def subtree_keys(root_ro: RenderBlock):
+    # Keys and sizes (render objects and characters of their texts) of the subtrees of all the render objects, by id
+    # A key is the id of the structure of the subtree, ie, the layout styles of the object followed by the keys of its
+    # children (or the text of a render text), so subtrees with equal keys are laid out the same (in the same available
+    # size), keys of larger subtrees than `MAX_MEMOIZED_SUBTREE_SIZE` are None
+    # Note: computed bottom up (in reverse pre-order), so each object is visited once, and as the structures are
+    # interned, a key is hashed and compared in constant time (unlike nested tuples, whose hashes are not cached)
+    if len(subtree_ids) > SUBTREE_IDS_SIZE:  # the memoized subtrees are keyed by their ids
+        clear_memos()
+    arena, root = root_ro.arena, root_ro.id
+    nodes, types = arena.nodes, arena.types
+    order, index = [], root
+    while index != NO_OBJECT:
+        order.append(index)
+        index = arena.next_in_subtree(index, root)
+    keys, sizes = [None] * len(arena), [0] * len(arena)
+    for index in reversed(order):
+        view_type, node = types[index], nodes[index]
+        if view_type is RenderText:
+            keys[index], sizes[index] = node.text, 1 + len(node.text)
+            continue
+        children = list(arena.children(index))
+        sizes[index] = size = 1 + sum([sizes[child] for child in children])
+        if size <= MAX_MEMOIZED_SUBTREE_SIZE:
+            own_styles = get_layout_styles(node.styles) if view_type is RenderBlock else get_font_styles(node.styles)
+            structure = (view_type, own_styles, *[keys[child] for child in children])
+            keys[index] = subtree_ids.setdefault(structure, len(subtree_ids))
+    return keys, sizes
+
+
+def iter_subtree_blocks(arena, root: int):
+    # Ids of the blocks of the subtree of `root` in pre-order (render texts and inline objects are skipped)
+    index = root
+    while index != NO_OBJECT:
+        yield index
+        first_child = arena.first_child[index]
+        index = arena.next_in_subtree(index, root, first_child != NO_OBJECT and arena.types[first_child] is RenderBlock)
+
+
+def memoize_subtree(arena, root: int, key, size: int):
+    # Stores the layout of the (finished) subtree of `root`, its position within the parent is not stored
+    global subtree_memo_size
+    box_models, lines_objects = arena.box_models, arena.lines_objects
+    blocks, num_words = [], 0
+    for index in iter_subtree_blocks(arena, root):
+        bm, lines_object = box_models[index], lines_objects[index]
+        relative_left, relative_top = (0, 0) if index == root else (bm.relative_left, bm.relative_top)
+        # Note: in the order of BoxModel's arguments
+        blocks.append(((bm.margin_top, bm.margin_right, bm.margin_bottom, bm.margin_left,
+                        bm.padding_top, bm.padding_right, bm.padding_bottom, bm.padding_left,
+                        bm.border_top, bm.border_right, bm.border_bottom, bm.border_left,
+                        bm.content_width, bm.content_height, relative_left, relative_top),
+                       lines_object.with_text_objects([]) if lines_object else None))
+        if lines_object:
+            num_words += lines_object.num_words
+    subtree_memo[key] = blocks, num_words, size
+    subtree_memo_size += size
+    while subtree_memo_size > SUBTREE_MEMO_SIZE:
+        subtree_memo_size -= subtree_memo.popitem(last=False)[1][2]
+
+
+def replay_subtree(arena, root: int, entry):
+    # Sets the box models and lines of the blocks of the subtree of `root` from the memoized layout of an equal subtree
+    # Returns the box model of `root` (positioned within its parent by the caller)
+    box_models, lines_objects = arena.box_models, arena.lines_objects
+    blocks, _, _ = entry
+    for index, (box_model_arguments, lines_object) in zip(iter_subtree_blocks(arena, root), blocks):
+        box_models[index] = BoxModel(*box_model_arguments)
+        lines_objects[index] = lines_object.with_text_objects(get_text_objects(arena.view(index))) \
+            if lines_object else None
+    return box_models[root]
 
 
 def compute_box_model_height(ro: RenderBlock, available_height: int, children_height: int, box_sizing='border-box'):
@@ -71,115 +190,291 @@ def compute_box_model_height(ro: RenderBlock, available_height: int, children_he
             ro.box_model.content_height = compute_width(ro.node.styles[HEIGHT], available_height)
 
 
-# Define two ways to construct layout - recursive or iterative
-# Using the iterative manner to support converting it to a generator function
+def compute_position(ro: RenderBlock):
+    # Moves a positioned block, relative to its parent's content box
+    # Note: relative blocks need their position in the flow, absolute and fixed blocks need the final size of parent
+    if ro.position == 'relative':
+        top = compute_width(ro.node.styles[TOP], ro.parent.box_model.content_width, allow_auto=True)
+        left = compute_width(ro.node.styles[LEFT], ro.parent.box_model.content_width, allow_auto=True)
+        bottom = compute_width(ro.node.styles[BOTTOM], ro.parent.box_model.content_width, allow_auto=True)
+        right = compute_width(ro.node.styles[RIGHT], ro.parent.box_model.content_width, allow_auto=True)
+        # Move it relatively with respect to its current position
+        ro.box_model.relative_top += top - bottom
+        ro.box_model.relative_left += left - right
+    else:  # in case of absolute and fixed
+        if ro.node.styles[TOP] != 'auto':
+            top = compute_width(ro.node.styles[TOP], ro.parent.box_model.content_width)
+            ro.box_model.relative_top = top
+        if ro.node.styles[LEFT] != 'auto':
+            left = compute_width(ro.node.styles[LEFT], ro.parent.box_model.content_width)
+            ro.box_model.relative_left = left
+
+        # bottom and right have higher priority than top and left ? (Mostly nope)
+        if ro.node.styles[BOTTOM] != 'auto':
+            bottom = compute_width(ro.node.styles[BOTTOM], ro.parent.box_model.content_width)
+            ro.box_model.relative_top = ro.parent.box_model.content_height - ro.box_model.box_height - bottom
+        if ro.node.styles[RIGHT] != 'auto':
+            right = compute_width(ro.node.styles[RIGHT], ro.parent.box_model.content_width)
+            ro.box_model.relative_left = ro.parent.box_model.content_width - ro.box_model.box_width - right
+
 
+def block_top(ro: RenderBlock):
+    # Top of the block (including margin) with respect to the root, from the relative positions
+    # Note: only for blocks in the flow (ie, with no absolute or fixed ancestor)
+    top = ro.box_model.relative_top
+    parent_ro = ro.parent
+    while parent_ro:
+        box_model = parent_ro.box_model
+        top += box_model.relative_top + box_model.margin_top + box_model.border_top + box_model.padding_top
+        parent_ro = parent_ro.parent
+    return top
 
-def construct_layout(root_ro: RenderBlock, window_width: int, window_height: int):
+
+class LazyTextLayout:
+    # Option for the layout to skip word measurement and line breaking of text blocks below the fold,
+    # their heights are estimated (from the number of characters and the average character width of the fonts)
+    # Lines of these blocks are constructed when they come within `margin` of the viewport (see `realize`)
+    def __init__(self, fold: int, margin: int = 0):
+        self.fold = fold  # text blocks starting below it are estimated
+        self.margin = margin
+        self.blocks = []  # blocks with estimated heights (and no lines) in document order
+
+    def is_below_fold(self, content_top: int):
+        return content_top > self.fold
+
+    def realize(self, viewport_top: int, viewport_height: int):
+        # Constructs the lines of estimated blocks within `margin` of the viewport, once the layout is complete
+        # Blocks after a realized block (and its ancestors with `auto` height) move by the change in its height
+        # Returns the change in height above the viewport, ie, how much the viewport needs to move down
+        # so its content does not jump
+        # Note: blocks are in document order, so are (mostly) in the order of their tops
+        blocks, low, high = self.blocks, 0, len(self.blocks)
+        while low < high:  # first block which is not entirely above the viewport (and the margin)
+            mid = (low + high) // 2
+            if block_top(blocks[mid]) + blocks[mid].box_model.box_height < viewport_top - self.margin:
+                low = mid + 1
+            else:
+                high = mid
+        end = low
+        while end < len(blocks) and block_top(blocks[end]) <= viewport_top + viewport_height + self.margin:
+            end += 1
+        if low == end:
+            return 0
+
+        height_deltas, scroll_delta = {}, 0  # change in box heights of blocks, by block
+        for ro in blocks[low:end]:
+            box_model = ro.box_model
+            top, box_height = block_top(ro), box_model.box_height
+            lines_object = construct_render_lines(ro, box_model.content_width)
+            if ro.node.styles[HEIGHT] == 'auto':
+                box_model.content_height = lines_object.height
+            if box_model.box_height != box_height:
+                height_deltas[ro] = box_model.box_height - box_height
+                if top + box_height <= viewport_top:
+                    scroll_delta += height_deltas[ro]
+        del blocks[low:end]
+        self.move_blocks(height_deltas)
+        return scroll_delta
+
+    @staticmethod
+    def move_blocks(height_deltas: dict):
+        # Moves the blocks after the blocks whose height changed, deepest parents first
+        # so that the change in height of a parent (with `auto` height) is known before its siblings are moved
+        # heap of (negated depth, insertion order, parent), `queued` avoids pushing a parent twice
+        parents, queued = [], set()
+
+        def queue_parent(parent_ro, depth):
+            if parent_ro not in queued:
+                queued.add(parent_ro)
+                heapq.heappush(parents, (-depth, len(queued), parent_ro))
+
+        for ro in height_deltas:
+            depth, parent_ro = 0, ro.parent
+            while parent_ro:
+                depth, parent_ro = depth + 1, parent_ro.parent
+            if ro.parent:
+                queue_parent(ro.parent, depth - 1)
+        while parents:
+            depth, _, parent_ro = heapq.heappop(parents)
+            depth = -depth
+            shift, bottom_anchored = 0, []
+            for child_ro in parent_ro.iter_children():
+                position = child_ro.position
+                if position == 'static' or position == 'relative':
+                    child_ro.box_model.relative_top += shift
+                    shift += height_deltas.get(child_ro, 0)
+                elif child_ro.node.styles[BOTTOM] != 'auto':
+                    bottom_anchored.append(child_ro)
+                elif child_ro.node.styles[TOP] == 'auto':  # placed after the siblings before it
+                    child_ro.box_model.relative_top += shift
+            if shift and parent_ro.node.styles[HEIGHT] == 'auto':
+                parent_ro.box_model.content_height += shift
+                for child_ro in bottom_anchored:
+                    compute_position(child_ro)
+                if parent_ro.parent:
+                    height_deltas[parent_ro] = height_deltas.get(parent_ro, 0) + shift
+                    queue_parent(parent_ro.parent, depth - 1)
+
+
+def construct_layout(root_ro: RenderBlock, window_width: int, window_height: int, lazy_text: LazyTextLayout = None,
+                     budget: Budget = None, memoize=True):
+    # Computes the layout of the entire render tree at once
+    for _ in construct_layout_progressively(root_ro, window_width, window_height, lazy_text=lazy_text, budget=budget,
+                                            memoize=memoize):
+        pass
+
+
+def construct_layout_progressively(root_ro: RenderBlock, window_width: int, window_height: int,
+                                   time_budget: float = None, lazy_text: LazyTextLayout = None, budget: Budget = None,
+                                   memoize=True):
+    # Generator which computes the layout in document order (pre-order depth first traversal of the blocks)
+    # Yields (the number of blocks laid out so far) whenever it has run for longer than `time_budget` seconds,
+    # so the laid out part of the document can be painted while the rest is laid out (never yields if None)
+    # Blocks are laid out when entered (properties which don't need children and position within the parent)
+    # and are finished after their children (`auto` height and positions of absolute and fixed children)
+    # Note: `auto` heights of unfinished blocks grow as their children are laid out,
+    # and blocks yet to be laid out have no box model
+    # With `lazy_text`, text blocks below its fold are estimated (and have no lines till they are realized)
+    # With `budget`, raises BudgetExceeded once it runs out of time (or stops with the blocks laid out so far
+    # if the budget is partial), the clock starts with the layout, ie, it includes the time between the steps
+    # With `memoize`, subtrees laid out before (in any document) are replayed (see `subtree_memo`), not with `lazy_text`
+    # as estimated blocks depend on their position in the page
     assert root_ro.node.tag == 'html' and root_ro.position == 'relative'
-    # block elements needing layout computation
-    render_blocks = [root_ro]  # Always contains block elements
-
-    # Mainly from blocks with `height: 'auto'` that have children
-    # But also all blocks that have children to compute children's relative positioning within it
-    # note ordering is important, blocks at the topological order
-    # blocks on top of the hierarchy are in the beginning of the list
-    blocks_needing_height = []
-
-    # also track positioned elements as they need positioning based on parent
-    # note: we only need them for absolutes and fixed when `bottom` and `right`
-    # are specified. For simplicity we compute them for all cases later.
-    positioned_elements = []
-
-    while render_blocks:  # pre-order depth-first traversal
-        ro = render_blocks.pop(0)
-        assert isinstance(ro, RenderBlock)  # expect only block
-        if not ro.parent:  # handling initial case
-            assert ro == root_ro
+    if budget is not None:
+        budget.start('layout')
+    # heights of static and relative positioned children laid out so far, for each unfinished block with block children
+    children_heights = []
+    # top of content box (with respect to the root) of each unfinished block with block children,
+    # None within absolute and fixed blocks (which are positioned after their parent is finished)
+    content_tops = []
+
+    # blocks are visited by walking the links of the render arena by id, a view is created once per block
+    # (for the functions computing its box model and lines), its parent and children are only looked up by id
+    arena = root_ro.arena
+    box_models, nodes, types = arena.box_models, arena.nodes, arena.types
+    parents, first_children, next_siblings = arena.parent, arena.first_child, arena.next_sibling
+    keys, sizes = subtree_keys(root_ro) if memoize and lazy_text is None else (None, None)
+    memoized = {}  # id of a block being laid out to its memo key, memoized once it's finished
+    uses_font_metrics = text_layout.font_metrics_tables is not None  # word widths differ
+
+    def finish(index: int, has_block_children: bool):
+        # Block and all its descendants have been laid out
+        if has_block_children:
+            children_height = children_heights.pop()
+            content_tops.pop()
+            if nodes[index].styles[HEIGHT] == 'auto':
+                # in case of auto compute height based on accumulated children height
+                box_models[index].content_height = children_height
+            for child in arena.children(index):
+                child_position = nodes[child].styles[POSITION]
+                if child_position == 'absolute' or child_position == 'fixed':
+                    compute_position(arena.view(child))
+        parent, position = parents[index], nodes[index].styles[POSITION]
+        if parent != NO_OBJECT and (position == 'static' or position == 'relative'):
+            # only static and relative positioned children contributes to parent height
+            # note: relative positioned elements are moved without affecting parent height
+            children_heights[-1] += box_models[index].box_height
+            if nodes[parent].styles[HEIGHT] == 'auto':
+                box_models[parent].content_height = children_heights[-1]
+        if memoized and index in memoized:
+            memoize_subtree(arena, index, memoized.pop(index), sizes[index])
+
+    start, num_blocks = time.perf_counter(), 0
+    root = index = root_ro.id  # block needing layout computation
+    while True:  # pre-order depth-first traversal
+        assert types[index] is RenderBlock  # expect only block
+        ro, styles, parent = arena.view(index), nodes[index].styles, parents[index]
+        if parent == NO_OBJECT:  # handling initial case
+            assert index == root
             width, height = window_width, window_height
         else:
             # width, (possibly) height of parent must of computed before children (pre-order traversal)
-            assert isinstance(ro.parent, RenderBlock)
-            width, height = ro.parent.box_model.content_width, ro.parent.box_model.content_height
-
-        # pre-processing
-        if ro.parent and ro.parent.node.styles[HEIGHT] == 'auto' and \
-                re.match(r'^\d+%$', ro.node.styles[HEIGHT]):
-            # if parent's height is `auto`, and current blocks's height is in `percent`
-            # then blocks height is also resolved to `auto`
-            # https://developer.mozilla.org/en-US/docs/Web/CSS/height#Formal_definition
-            ro.node.styles[HEIGHT] = 'auto'
+            # Note: `auto` height of the parent is not known yet (resolved to 0)
+            assert types[parent] is RenderBlock
+            parent_height_auto = nodes[parent].styles[HEIGHT] == 'auto'
+            width = box_models[parent].content_width
+            height = 0 if parent_height_auto else box_models[parent].content_height
 
-        if ro.is_positioned:  # collect positioned elements
-            positioned_elements.append(ro)
+            # pre-processing
+            if parent_height_auto and re.match(r'^\d+%$', styles[HEIGHT]):
+                # if parent's height is `auto`, and current blocks's height is in `percent`
+                # then blocks height is also resolved to `auto`
+                # https://developer.mozilla.org/en-US/docs/Web/CSS/height#Formal_definition
+                styles[HEIGHT] = 'auto'
 
-        ro.box_model = BoxModel()  # <---------- Box Model set in layout phase
         # Compute box model properties that don't need children information
-        compute_box_model_properties(ro, width, height)
-        if not ro.children:  # if not children and `auto`, `children_height` is resolved to 0
+        key = entry = None
+        if keys is not None and parent != NO_OBJECT and keys[index] is not None:
+            key = keys[index], width, height, parent_height_auto, uses_font_metrics
+            entry = subtree_memo.get(key)
+        if entry is not None:  # laid out along with its descendants
+            subtree_memo.move_to_end(key)
+            box_model = replay_subtree(arena, index, entry)
+        else:
+            box_model = construct_box_model(ro, width, height)  # <---------- Box Model set in layout phase
+            if key is not None and not memoized:  # not within a subtree to memoize (it's memoized along with it)
+                if key in seen_subtrees:
+                    memoized[index] = key
+                else:
+                    seen_subtrees[key] = None
+                    if len(seen_subtrees) > SEEN_SUBTREES_SIZE:
+                        seen_subtrees.popitem(last=False)
+        position = styles[POSITION]
+        if parent != NO_OBJECT:
+            # placed after the static and relative positioned siblings before it
+            box_model.relative_top = children_heights[-1]
+            if position == 'relative':
+                compute_position(ro)
+        if parent != NO_OBJECT and (content_tops[-1] is None or position == 'absolute' or position == 'fixed'):
+            content_top = None
+        else:
+            content_top = (content_tops[-1] if parent != NO_OBJECT else 0) + box_model.relative_top + \
+                box_model.margin_top + box_model.border_top + box_model.padding_top
+        # Note: children are either all block objects or inline/text objects
+        first_child = first_children[index]
+        has_block_children = first_child != NO_OBJECT and types[first_child] is RenderBlock
+        cost = 1  # units of work for the budget
+        if entry is not None:  # finished (its height is known), and is not descended into
+            has_block_children = False
+            cost = len(entry[0]) + entry[1]
+        elif first_child == NO_OBJECT:  # if not children and `auto`, `children_height` is resolved to 0
             compute_box_model_height(ro, height, children_height=0)
-        elif all(not isinstance(child_ro, RenderBlock) for child_ro in ro.children):
+        elif not has_block_children:
             # if none of the children are block elements, then height can be resolved
             # of the underlying text objects
             # Note: since underlying text is its children, content_width is used
-            lines_object = construct_render_lines(ro, ro.box_model.content_width)
+            if lazy_text is not None and content_top is not None and lazy_text.is_below_fold(content_top):
+                lines_height = estimate_lines_height(ro, box_model.content_width)
+                lazy_text.blocks.append(ro)
+            else:
+                lines_object = construct_render_lines(ro, box_model.content_width)
+                lines_height = lines_object.height
+                cost += len(lines_object.word_widths)  # lines cost by their words
             # Compute the height if `auto`
-            compute_box_model_height(ro, height, children_height=lines_object.height)
+            compute_box_model_height(ro, height, children_height=lines_height)
         else:
             # all its children expected to be block objects
-            assert ro.children and all(isinstance(child_ro, RenderBlock) for child_ro in ro.children)
-
-            # in case height is auto, its height can be computed only
-            # after it's children's height has been computed
-            # also its children needs relative positioning
-            blocks_needing_height.append(ro)
+            assert all(types[child] is RenderBlock for child in arena.children(index))
 
+        num_blocks += 1 if entry is None else len(entry[0])
+        if has_block_children:
             # Compute box-model properties of its children first in order of occurrence
-            render_blocks = ro.children[:] + render_blocks
-
-    # compute the height's of blocks based on it's children if height is `auto`
-    # also compute relative positioning of its children in either case
-    while blocks_needing_height:
-        # pickup elements from lower down in the tree first
-        ro = blocks_needing_height.pop()
-        children_height = 0
-        for child_ro in ro.children:
-            assert isinstance(child_ro, RenderBlock)
-            child_ro.box_model.relative_left = 0
-            child_ro.box_model.relative_top = children_height
-            if child_ro.position == 'static' or child_ro.position == 'relative':
-                # only static and relative positioned children contributes to parent height
-                # note: relative positioned elements will be moved later without affecting parent height
-                children_height += child_ro.box_model.box_height
-        if ro.node.styles[HEIGHT] == 'auto':
-            # in case of auto compute height based on accumulated children height
-            compute_box_model_height(ro, 0, children_height)
-
-    # Compute relative positions of positioned elements
-    while positioned_elements:
-        # Note only relative positioning is set in layout phase
-        ro = positioned_elements.pop()
-        if ro.parent:
-            if ro.position == 'relative':
-                top = compute_width(ro.node.styles[TOP], ro.parent.box_model.content_width, allow_auto=True)
-                left = compute_width(ro.node.styles[LEFT], ro.parent.box_model.content_width, allow_auto=True)
-                bottom = compute_width(ro.node.styles[BOTTOM], ro.parent.box_model.content_width, allow_auto=True)
-                right = compute_width(ro.node.styles[RIGHT], ro.parent.box_model.content_width, allow_auto=True)
-                # Move it relatively with respect to its current position
-                ro.box_model.relative_top += top - bottom
-                ro.box_model.relative_left += left - right
-            else:  # in case of absolute and fixed
-                if ro.node.styles[TOP] != 'auto':
-                    top = compute_width(ro.node.styles[TOP], ro.parent.box_model.content_width)
-                    ro.box_model.relative_top = top
-                if ro.node.styles[LEFT] != 'auto':
-                    left = compute_width(ro.node.styles[LEFT], ro.parent.box_model.content_width)
-                    ro.box_model.relative_left = left
-
-                # bottom and right have higher priority than top and left ? (Mostly nope)
-                if ro.node.styles[BOTTOM] != 'auto':
-                    bottom = compute_width(ro.node.styles[BOTTOM], ro.parent.box_model.content_width)
-                    ro.box_model.relative_top = ro.parent.box_model.content_height - ro.box_model.box_height - bottom
-                if ro.node.styles[RIGHT] != 'auto':
-                    right = compute_width(ro.node.styles[RIGHT], ro.parent.box_model.content_width)
-                    ro.box_model.relative_left = ro.parent.box_model.content_width - ro.box_model.box_width - right
+            # in case height is auto, its height can be computed only after it's children's height has been computed
+            children_heights.append(0)
+            content_tops.append(content_top)
+            index = first_child
+        else:
+            # finish the block, and its ancestors whose last child has been finished
+            finish(index, has_block_children=False)
+            while index != root and next_siblings[index] == NO_OBJECT:
+                index = parents[index]
+                finish(index, has_block_children=True)
+            if index == root:
+                return
+            index = next_siblings[index]
+
+        if budget is not None and budget.stop(cost):
+            return
+        if time_budget is not None and time.perf_counter() - start > time_budget:
+            yield num_blocks
+            start = time.perf_counter()
@@ -0,0 +1,43 @@
+import mmap
+import os
+from concurrent.futures import Executor
+from typing import List, Union
+
+import css_parser
+from css_parser import CSSOM
+from utils import Diagnostics
+
+# Files at least this large are memory mapped instead of being read into a string
+# the tokenizers match directly on the memory map (as bytes), so the file is never copied as a whole
+MMAP_THRESHOLD = 1 << 20
+
+
+def load(path: str) -> Union[str, mmap.mmap]:
+    # Returns the contents of the file, either as a string or as a (read only) memory map for large files
+    # Note: the memory map is unmapped once it's no longer referenced (ie, after parsing)
+    if os.stat(path).st_size < MMAP_THRESHOLD:
+        with open(path) as f:  # same as reading the whole file as text
+            return f.read()
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_WILLNEED'):  # start reading ahead, the tokenizer reads the pages in order
+        buffer.madvise(mmap.MADV_SEQUENTIAL)
+        buffer.madvise(mmap.MADV_WILLNEED)
+    return buffer
+
+
+def load_stylesheets(executor: Executor, style_sheets: List[str], cssom: CSSOM = None,
+                     diagnostics: Diagnostics = None):
+    # Reads the stylesheets concurrently and parses them in order (later rules take precedence)
+    # errors of all the stylesheets are reported to `diagnostics`
+    # Returns a future of the CSSOM, so the stylesheets can be parsed in the background (eg, while parsing HTML)
+    sources = [executor.submit(load, style_sheet) for style_sheet in style_sheets]
+
+    def parse_stylesheets():
+        # Note: submitted after the reads, so the reads are never queued behind it
+        result = cssom
+        for source in sources:
+            result = css_parser.parse(source.result(), result, diagnostics)
+        return result
+
+    return executor.submit(parse_stylesheets)
@@ -1,83 +1,247 @@
 import argparse
 import os
 import sys
+import time
 import pygame
 
-import html_parser
-import css_parser
-import attachment
-import renderer
 import layout
 import paint
-import utils
+import user_agent
+import font_metrics
+from framebuffer import FrameBuffer
+from engine import Engine, Document, DEFAULT_BROWSER_BACKGROUND, SNAPSHOT_BAND_HEIGHT
 
 # Obtain the HTML and CSS file names from cli
 parser = argparse.ArgumentParser(description='A Browser Rendering Engine')
 parser.add_argument('--html', type=str, default='index.html', help='html page to render', )
 parser.add_argument('--css', type=str, default=[], nargs='*', help='stylesheets for styling html page')
-args = parser.parse_args()
+parser.add_argument('--layout', type=str, default='progressive', choices=['progressive', 'scalar', 'vectorized'],
+                    help='layout implementation, progressive layout paints the page while it is laid out, '
+                         'vectorized layout needs numpy (for very large pages)')
+parser.add_argument('--lazy-text', action='store_true',
+                    help='estimate the heights of text below the first screen, its lines are constructed on scrolling')
+parser.add_argument('--font-metrics', action='store_true',
+                    help='compute word widths from font metric tables, faster but may differ by a pixel from font.size')
+parser.add_argument('--validate-font-metrics', action='store_true',
+                    help='compute word widths from font metric tables, '
+                         'and report the words and runs that differ from font.size')
+parser.add_argument('--inspect', action='store_true',
+                    help='outline the block under the mouse, and show its tag and the word under the mouse in the title')
+parser.add_argument('--framebuffer', type=str, default=None, metavar='NAME',
+                    help='also publish every frame to the shared memory frame buffer NAME, for other processes to read '
+                         '(eg, `python framebuffer.py NAME`)')
+parser.add_argument('--trace', action='store_true',
+                    help='print the dom and render trees, and the time taken by each stage of rendering')
+parser.add_argument('--viewports', type=str, default=[], nargs='*', metavar='WIDTHxHEIGHT',
+                    help='render the page in each viewport (eg, 320x568 1920x1080) into PNG files instead of '
+                         'opening a window, parsing, styles and render tree are shared by all the viewports')
+parser.add_argument('--snapshot', action='store_true',
+                    help='render the entire page into PNG files of horizontal bands (`<page>-snapshot-<index>.png`) '
+                         'instead of opening a window')
+parser.add_argument('--band-height', type=int, default=SNAPSHOT_BAND_HEIGHT,
+                    help='height of the bands of the snapshot (in pixels)')
+parser.add_argument('--output', type=str, default='.', help='directory of the PNG files of the viewports or snapshot')
+parser.add_argument('--workers', type=int, default=None,
+                    help='number of processes rendering the viewports (or bands of the snapshot) in parallel '
+                         '(number of CPUs by default)')
 
-html_file = args.html
-style_sheet_files = ['agent.css'] + args.css
-DEFAULT_BROWSER_BACKGROUND = (255, 255, 255)
 WIDTH, HEIGHT = 1000, 600
 SCROLL_SPEED = 1
+INSPECT_COLOR = (255, 0, 255)  # outline of the block under the mouse (with `--inspect`)
+# matches of find in page (Ctrl+F) are multiplied by these colors, so the text over them stays visible
+MATCH_COLOR = (255, 255, 0)
+CURRENT_MATCH_COLOR = (255, 150, 0)
+MATCHES_HIGHLIGHTED = 100  # matches highlighted before and after the current match
+LAYOUT_TIME_BUDGET = 1 / 120  # time spent on progressive layout every frame (in seconds)
 
-# Make sure all specified files exists
-for file in [html_file] + style_sheet_files:
-    if not os.path.exists(file):
-        print(f'Cannot find {file}', file=sys.stderr)
-        exit()
+
+def construct_render_tree(html_page, style_sheets, engine: Engine = None):
+    # Render tree of the page (and its title), the engine traces the trees if enabled
+    document = (engine or Engine()).open(html_page, style_sheets)
+    return document.render_tree, document.title
+
+
+def construct_layout_tree(html_page, style_sheets, window_width: int, window_height: int, layout_mode='scalar',
+                          lazy_text: layout.LazyTextLayout = None, engine: Engine = None):
+    document = (engine or Engine()).open(html_page, style_sheets, window_width, window_height, layout_mode,
+                                         lazy_text)
+    # render tree can now be painted
+    return document.layout_tree, document.title
 
 
-def construct_layout_tree(html_page, style_sheets, window_width: int, window_height: int):
-    with open(html_page) as f_html:
-        # construct DOM tree from html
-        dom = html_parser.parse(f_html.read())
-        page_title = html_parser.get_page_title(dom)
-        utils.print_tree(dom)
+def parse_viewport(viewport: str):
+    # WIDTHxHEIGHT, eg, 1000x600
+    try:
+        width, height = map(int, viewport.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid viewport {viewport!r}, expected WIDTHxHEIGHT')
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f'invalid viewport {viewport!r}, size should be positive')
+    return width, height
 
-        # construct css object model
-        cssom = None
-        for style_sheet in style_sheets:
-            with open(style_sheet) as f_css:
-                cssom = css_parser.parse(f_css.read(), cssom)
 
-        # apply styles
-        attachment.attach_styles(dom, cssom)
+def render_viewports(engine: Engine, html_page, style_sheets, viewports, output_directory, layout_mode='scalar',
+                     workers=None):
+    # Renders the page in each viewport into `<page>-<width>x<height>.png`, and reports the time saved by sharing
+    # the stages till the render tree against rendering each viewport separately
+    start = time.perf_counter()
+    document = engine.open(html_page, style_sheets, layout_mode=layout_mode)
+    document.render_tree  # noqa, computes the stages till render tree
+    shared_time = time.perf_counter() - start
+    renderings = document.render_viewports(viewports, workers)
 
-        # construct render tree
-        render_tree = renderer.construct_render_tree(dom)
-        utils.print_tree(render_tree)
+    os.makedirs(output_directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(html_page))[0]
+    for rendering in renderings:
+        with open(os.path.join(output_directory, f'{name}-{rendering.width}x{rendering.height}.png'), 'wb') as f:
+            f.write(rendering.image)
+    total_time = time.perf_counter() - start
 
-        # construct layout
-        layout.construct_layout(render_tree, window_width, window_height)
+    print(f'{len(viewports)} viewports of {html_page} rendered in {total_time:.3f} s '
+          f'(parse, styles and render tree {shared_time:.3f} s, once)')
+    viewport_times = []
+    for rendering in renderings:
+        viewport_times.append(sum(rendering.timings.values()))
+        timings = '  '.join(f'{stage} {duration:.3f} s' for stage, duration in rendering.timings.items())
+        print(f'  {rendering.width:5}x{rendering.height:<5}  {timings}')
+    # a separate run of each viewport repeats the shared stages, and renders one viewport at a time
+    separate_time = len(viewports) * shared_time + sum(viewport_times)
+    print(f'Separate runs: {separate_time:.3f} s (estimated), saved {separate_time - total_time:.3f} s '
+          f'({(separate_time - total_time) / separate_time:.0%})')
 
-        # render tree can now be painted
-        return render_tree, page_title
 
+def render_snapshot(engine: Engine, html_page, style_sheets, output_directory, layout_mode='scalar',
+                    band_height=SNAPSHOT_BAND_HEIGHT, workers=None):
+    # Renders the entire page into bands `<page>-snapshot-<index>.png`, and reports the time taken by each band
+    start = time.perf_counter()
+    document = engine.open(html_page, style_sheets, WIDTH, HEIGHT, layout_mode)
+    document.display_list  # noqa, computes the stages till display list (once, before the bands are painted)
+    shared_time = time.perf_counter() - start
 
-def main_loop(render_tree, title, width, height, fps=60):
+    os.makedirs(output_directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(html_page))[0]
+    bands = document.render_snapshot(output_directory, f'{name}-snapshot', band_height, workers)
+    total_time = time.perf_counter() - start
+
+    print(f'Snapshot of {html_page} ({WIDTH}x{sum(band.height for band in bands)}) rendered into {len(bands)} bands '
+          f'in {total_time:.3f} s (parse, styles, layout and display list {shared_time:.3f} s)')
+    for band in bands:
+        timings = '  '.join(f'{stage} {duration:.3f} s' for stage, duration in band.timings.items())
+        print(f'  {band.path}  top {band.top:8}  {timings}')
+
+
+def main_loop(document: Document, width, height, fps=60, layout_time_budget=None, inspect=False,
+              framebuffer: FrameBuffer = None):
+    # With `layout_time_budget`, the layout (if not computed yet) continues for a part of every frame,
+    # and the part laid out so far is painted, else the document is laid out before the first frame
+    # Lazy text of the document (whose lines were estimated in layout) is realized as it comes near the viewport
+    # With `inspect`, the block under the mouse is outlined and its tag (and the word under the mouse) is shown
+    # in the title, once the layout is complete (see `Document.element_from_point`)
+    # Ctrl+F finds the typed text in the page as it's typed (see `find_in_page.py`), Enter (or F3) scrolls to the
+    # next match and Shift+Enter to the previous one, Escape closes the search
+    # With `framebuffer`, frames are painted into its shared memory (and published) and then shown in the window
+    # Note: once laid out, frames paint the document's display list (which is constructed again only on changes),
+    # only the blocks overlapping the viewport are painted (see `paint.BlockTiles` and `tile_index.py`)
     pygame.init()
 
     win = pygame.display.set_mode((width, height))
-    pygame.display.set_caption(title)
+    pygame.display.set_caption(document.title)
     clock = pygame.time.Clock()
 
+    layout_steps = document.layout_progressively(layout_time_budget) if layout_time_budget else None
+    # blocks laid out so far, extended after every step (and painted only where they overlap the viewport)
+    progressive_display_list = paint.ProgressiveDisplayList(document.render_tree) if layout_steps else None
     scroll_top, scroll_left = 0, 0
     container_rect = None
+    caption = document.title
+    # find in page, matches are found again when the query changes or the text index is constructed again
+    query = None  # None when not searching
+    text_index, matches, current_match, locations = None, [], 0, {}
+    scroll_to_match = False
     run = True
 
     while run:
         for event in pygame.event.get():
-            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_q):
+            if event.type == pygame.QUIT:
                 run = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_f and event.mod & pygame.KMOD_CTRL:
+                query, text_index = query or '', None
+            elif query is None:
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_q:
+                    run = False
+            elif event.type == pygame.TEXTINPUT and not pygame.key.get_mods() & pygame.KMOD_CTRL:
+                query, text_index = query + event.text, None
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_BACKSPACE and query:
+                query, text_index = query[:-1], None
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                query, text_index, matches = None, None, []
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_RETURN, pygame.K_KP_ENTER, pygame.K_F3) \
+                    and matches:
+                current_match += -1 if event.mod & pygame.KMOD_SHIFT else 1
+                current_match %= len(matches)
+                scroll_to_match = True
+
+        if layout_steps is not None and next(layout_steps, None) is None:
+            layout_steps, progressive_display_list = None, None  # layout completed
+        if layout_steps is None:
+            # scrolled by the change in height above the viewport, so the content in the viewport does not move
+            scroll_top -= document.realize_text(-scroll_top, height)
+        if query is not None and layout_steps is None and text_index is not document.text_index:
+            text_index = document.text_index
+            matches, current_match, locations = text_index.find(query), 0, {}
+            scroll_to_match = bool(matches)
 
-        win.fill(DEFAULT_BROWSER_BACKGROUND)
-        # just paint the render tree onto `win`
-        container_rect = paint.paint_layout(win, render_tree, scroll_left, scroll_top)
+        canvas = framebuffer.begin() if framebuffer else win
+        canvas.fill(DEFAULT_BROWSER_BACKGROUND)
+        # just paint the render tree onto `canvas`
+        if layout_steps is None:
+            container_rect = document.paint(canvas, scroll_left, scroll_top)
+        else:  # part laid out so far
+            progressive_display_list.update()
+            container_rect = paint.paint_display_list(canvas, progressive_display_list, scroll_left, scroll_top)
+        new_caption = document.title
+        if inspect and layout_steps is None and pygame.mouse.get_focused():
+            hit = document.element_from_point(*pygame.mouse.get_pos(), scroll_left, scroll_top)
+            if hit:
+                block_rect = pygame.Rect(hit.block.box_model.border_rect)
+                if hit.block.position != 'fixed':
+                    block_rect.move_ip(scroll_left, scroll_top)
+                pygame.draw.rect(canvas, INSPECT_COLOR, block_rect, 1)
+                new_caption += f' - <{hit.block.node.tag}> {hit.word.word if hit.word else ""}'
+        if query is not None:
+            for index in range(max(current_match - MATCHES_HIGHLIGHTED, 0),
+                               min(current_match + MATCHES_HIGHLIGHTED + 1, len(matches))):
+                if index not in locations:
+                    locations[index] = text_index.locate(matches[index], len(query))
+                block, rects = locations[index]
+                for rect in rects:
+                    if block.position != 'fixed':
+                        rect = rect.move(scroll_left, scroll_top)
+                    canvas.fill(CURRENT_MATCH_COLOR if index == current_match else MATCH_COLOR, rect,
+                                special_flags=pygame.BLEND_RGB_MULT)
+            more = '' if text_index is None or text_index.complete else '+'
+            new_caption += f' - Find: {query} ({current_match + 1 if matches else 0}/{len(matches)}{more})'
+        if new_caption != caption:
+            caption = new_caption
+            pygame.display.set_caption(caption)
+        if framebuffer:
+            framebuffer.publish(scroll_left, scroll_top)
+            win.blit(canvas, (0, 0))
         pygame.display.update()
 
+        if scroll_to_match and query is not None:
+            # match is centered in the viewport, unless it's visible already
+            scroll_to_match = False
+            block, rects = locations[current_match]
+            if rects and block.position != 'fixed':
+                rect = rects[0].move(scroll_left, scroll_top)
+                if rect.top < 0 or rect.bottom > height:
+                    scroll_top += height // 2 - rect.centery
+                    scroll_top = min(max(scroll_top, height - container_rect.bottom), container_rect.top)
+                if rect.left < 0 or rect.right > width:
+                    scroll_left += width // 2 - rect.centerx
+                    scroll_left = min(max(scroll_left, width - container_rect.right), container_rect.left)
+
         keys = pygame.key.get_pressed()
         if keys[pygame.K_UP]:
             scroll_top -= SCROLL_SPEED
@@ -98,5 +262,67 @@ def main_loop(render_tree, title, width, height, fps=60):
 
 
 if __name__ == '__main__':
-    final_render_tree, html_page_title = construct_layout_tree(html_file, style_sheet_files, WIDTH, HEIGHT)
-    main_loop(final_render_tree, html_page_title, WIDTH, HEIGHT)
+    args = parser.parse_args()
+    if args.lazy_text and args.layout == 'vectorized':
+        parser.error('--lazy-text is not supported by the vectorized layout')
+
+    html_file = args.html
+    style_sheet_files = args.css  # user's style sheets, browser styles (`agent.css`) are precompiled
+
+    # Make sure all specified files exists
+    for file in [html_file, user_agent.USER_AGENT_STYLESHEET] + style_sheet_files:
+        if not os.path.exists(file):
+            print(f'Cannot find {file}', file=sys.stderr)
+            exit()
+
+    engine = Engine(use_font_metrics=args.font_metrics, validate_font_metrics=args.validate_font_metrics,
+                    trace=sys.stdout if args.trace else None)
+    if args.viewports:
+        try:
+            viewport_sizes = [parse_viewport(viewport) for viewport in args.viewports]
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        if args.lazy_text:
+            parser.error('--lazy-text is not supported with --viewports (viewports are painted entirely)')
+        render_viewports(engine, html_file, style_sheet_files, viewport_sizes, args.output,
+                         'vectorized' if args.layout == 'vectorized' else 'scalar', args.workers)
+        if args.validate_font_metrics:
+            font_metrics.report_divergences()
+        exit()
+    if args.snapshot:
+        if args.lazy_text:
+            parser.error('--lazy-text is not supported with --snapshot (the page is painted entirely)')
+        if args.band_height <= 0:
+            parser.error('--band-height should be positive')
+        render_snapshot(engine, html_file, style_sheet_files, args.output,
+                        'vectorized' if args.layout == 'vectorized' else 'scalar', args.band_height, args.workers)
+        if args.validate_font_metrics:
+            font_metrics.report_divergences()
+        exit()
+
+    # text below the first screen is estimated, and realized once within a screen of the viewport
+    lazy_text_layout = layout.LazyTextLayout(fold=HEIGHT, margin=HEIGHT) if args.lazy_text else None
+    html_document = engine.open(html_file, style_sheet_files, WIDTH, HEIGHT,
+                                'vectorized' if args.layout == 'vectorized' else 'scalar', lazy_text_layout)
+    frame_buffer = None
+    if args.framebuffer:
+        frame_buffer = FrameBuffer(WIDTH, HEIGHT, args.framebuffer)
+        print(f'Publishing frames to {frame_buffer.name}', file=sys.stderr)
+    try:
+        if args.layout == 'progressive':
+            # window is opened once the render tree is constructed, and the page is laid out between frames
+            html_document.render_tree  # noqa, computes the stages till render tree
+            main_loop(html_document, WIDTH, HEIGHT, layout_time_budget=LAYOUT_TIME_BUDGET, inspect=args.inspect,
+                      framebuffer=frame_buffer)
+        else:
+            html_document.layout_tree  # noqa, computes the stages till layout
+            main_loop(html_document, WIDTH, HEIGHT, inspect=args.inspect, framebuffer=frame_buffer)
+    finally:
+        if frame_buffer:
+            frame_buffer.close()
+    if html_document.diagnostics:
+        print(html_document.diagnostics, file=sys.stderr)
+    if html_document.css_diagnostics:
+        print(html_document.css_diagnostics, file=sys.stderr)
+    if args.validate_font_metrics:
+        font_metrics.report_divergences()
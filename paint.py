@@ -1,8 +1,12 @@
 import pygame
 from box_model import BoxModel
-from render_object import RenderBlock
+from render_object import RenderBlock, NO_OBJECT
+from tile_index import TileIndex
+from css_properties import POSITION
 from text_layout import RenderLines
-from collections import namedtuple
+from budget import Budget
+from collections import deque, namedtuple
+from typing import List
 
 # Colors while drawing layout
 BOX_OUTLINE_COLOR = (220, 20, 60)
@@ -10,6 +14,8 @@ BORDER_OUTLINE_COLOR = (255, 165, 0)
 PADDING_OUTLINE_COLOR = (30, 144, 255)
 CONTENT_OUTLINE_COLOR = (65, 105, 225)
 
+Border = namedtuple('Border', ['start_position', 'end_position', 'border_width'])
+
 
 # Note: all the paint functions expect the box_model's left and right values to be set
 def paint_box_model_layout(win: pygame.Surface, bm: BoxModel):
@@ -20,24 +26,71 @@ def paint_box_model_layout(win: pygame.Surface, bm: BoxModel):
     pygame.draw.rect(win, CONTENT_OUTLINE_COLOR, bm.content_rect, 1)
 
 
-def paint_render_lines(win: pygame.Surface, render_lines: RenderLines, left: int, top: int):
-    # Paint the words in the `render_lines` object
-    # Note: left and top are absolute positions with respect to `win`
-    line_offset = 0  # vertical offset
-    for line_object in render_lines.children:
-        line_height = line_object.height
-        word_offset = 0  # horizontal offset
-        for word_object in line_object.children:
+class RunSurfaces:
+    # Rendered text runs by (font, color, background color, text), so a run is rendered once and then only blitted
+    # (eg, on every frame while scrolling, and for the runs repeated in the page)
+    # Note: runs are rendered whole (SDL_ttf kerns and positions the glyphs at sub-pixel offsets within the run),
+    # the oldest runs are evicted once the surfaces exceed `max_pixels`
+    def __init__(self, max_pixels: int):
+        self.max_pixels = max_pixels
+        self.surfaces = {}
+        self.pixels = 0
+
+    def get(self, font, color, background_color, text: str) -> pygame.Surface:
+        key = (font, color, background_color, text)
+        surface = self.surfaces.get(key)
+        if surface is None:
             # Note: when background is None, no background is rendered
-            text_surface = word_object.font.render(word_object.word, True, word_object.text_object.color,
-                                                   word_object.text_object.background_color)
-            # correction factor to align the word to the center of the line
-            alignment_correction = (line_height - word_object.height) // 2
-            text_top = top + line_offset + alignment_correction
-            text_left = left + word_offset
-            win.blit(text_surface, (text_left, text_top))
-            word_offset += word_object.width
-        line_offset += line_height
+            surface = font.render(text, True, color, background_color)
+            width, height = surface.get_size()
+            self.pixels += width * height
+            while self.surfaces and self.pixels > self.max_pixels:
+                evicted = self.surfaces.pop(next(iter(self.surfaces)))
+                self.pixels -= evicted.get_width() * evicted.get_height()
+            self.surfaces[key] = surface
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.pixels = 0
+
+
+RUN_SURFACES_PIXELS = 1 << 23  # about 32 MB of surfaces
+run_surfaces = RunSurfaces(RUN_SURFACES_PIXELS)
+
+
+def paint_render_lines(win: pygame.Surface, render_lines: RenderLines, left: int, top: int, placements: list = None):
+    # Paint the text runs in the `render_lines` object, each run is rendered once (see `RunSurfaces`) and all the runs
+    # are blitted at once, with `placements` the runs are added to it instead (to be blitted along with other blocks)
+    # Runs outside the clip rectangle of `win` are skipped (lines below it are not even sliced into runs)
+    # Note: left and top are absolute positions with respect to `win`
+    clip_rect = win.get_clip()
+    line_heights = render_lines.line_heights
+    if top >= clip_rect.bottom or top + sum(line_heights) <= clip_rect.top:
+        return
+    text_styles = [(render_lines.font(text_index), text_object.color, text_object.background_color)
+                   for text_index, text_object in enumerate(render_lines.text_objects)]
+    batch = [] if placements is None else placements
+    line_starts, run_texts, run_starts, run_offsets, run_heights = (render_lines.line_starts, render_lines.run_texts,
+                                                                    render_lines.run_starts, render_lines.run_offsets,
+                                                                    render_lines.run_heights)
+    line_top = top
+    for line in range(len(line_heights)):
+        line_height = line_heights[line]
+        if line_top >= clip_rect.bottom:
+            break
+        if line_top + line_height > clip_rect.top:
+            for run in range(line_starts[line], line_starts[line + 1]):
+                # correction factor to align the run to the center of the line
+                run_top = line_top + (line_height - run_heights[run]) // 2
+                if run_top + run_heights[run] <= clip_rect.top:
+                    continue
+                text_index = run_texts[run]
+                text = render_lines.slice_words(text_index, run_starts[run], run_starts[run + 1])
+                batch.append((run_surfaces.get(*text_styles[text_index], text), (left + run_offsets[run], run_top)))
+        line_top += line_height
+    if placements is None:
+        win.blits(batch, False)
 
 
 def paint_box_model(win: pygame.Surface, bm: BoxModel, ro: RenderBlock, x_offset=0, y_offset=0):
@@ -51,19 +104,20 @@ def paint_box_model(win: pygame.Surface, bm: BoxModel, ro: RenderBlock, x_offset
     # For borders, we need to draw lines around the content
     # Note some correction factors are added to make borders precise
     # For default behaviour refer: https://www.pygame.org/docs/ref/draw.html#pygame.draw.line
-    Border = namedtuple('Border', ['start_position', 'end_position', 'border_width'])
+    left, top, width, height = bm.border_rect
+    right, bottom = left + width, top + height
     borders = [
-        Border((bm.left + bm.margin_left, bm.top + bm.margin_top + (bm.border_top - 1) // 2),
-               (bm.right - bm.margin_right - 1, bm.top + bm.margin_top + (bm.border_top - 1) // 2),
+        Border((left, top + (bm.border_top - 1) // 2),
+               (right - 1, top + (bm.border_top - 1) // 2),
                bm.border_top),  # Border Top
-        Border((bm.right - bm.margin_right - (bm.border_right + 3) // 2, bm.top + bm.margin_top),
-               (bm.right - bm.margin_right - (bm.border_right + 3) // 2, bm.bottom - bm.margin_bottom - 1),
+        Border((right - (bm.border_right + 3) // 2, top),
+               (right - (bm.border_right + 3) // 2, bottom - 1),
                bm.border_right),  # Border Right
-        Border((bm.left + bm.margin_left, bm.bottom - bm.margin_bottom - (bm.border_bottom + 3) // 2),
-               (bm.right - bm.margin_right - 1, bm.bottom - bm.margin_bottom - (bm.border_bottom + 3) // 2),
+        Border((left, bottom - (bm.border_bottom + 3) // 2),
+               (right - 1, bottom - (bm.border_bottom + 3) // 2),
                bm.border_bottom),  # Border Bottom
-        Border((bm.left + bm.margin_left + (bm.border_left - 1) // 2, bm.top + bm.margin_top),
-               (bm.left + bm.margin_left + (bm.border_left - 1) // 2, bm.bottom - bm.margin_bottom - 1),
+        Border((left + (bm.border_left - 1) // 2, top),
+               (left + (bm.border_left - 1) // 2, bottom - 1),
                bm.border_left),  # Border Left
     ]
     for start_position, end_position, border_width in borders:
@@ -74,32 +128,131 @@ def paint_box_model(win: pygame.Surface, bm: BoxModel, ro: RenderBlock, x_offset
             pygame.draw.line(win, pygame.Color(ro.border_color), scrolled_start, scrolled_end, border_width)
 
 
-def paint_layout(win: pygame.Surface, root_ro: RenderBlock, x_offset=0, y_offset=0, show_layout=False):
-    # Paint the render tree after layout stage onto `win`
-    # show_layout -> if enabled show only layout lines
-    # Use x_offset and y_offset to simulate scrolling behaviour
-    def draw_block(ro: RenderBlock):
-        if show_layout:
-            paint_box_model_layout(win, ro.box_model)
+def paint_extent(ro: RenderBlock):
+    # Top and bottom (in page coordinates) of what the block paints, ie, its box (with its borders, which are drawn
+    # as lines around their positions) and its lines (which may overflow the box)
+    bm = ro.box_model
+    border_width = max(bm.border_top, bm.border_right, bm.border_bottom, bm.border_left)
+    _, top, _, height = bm.box_rect
+    top, bottom = top - border_width, top + height + border_width
+    if ro.lines_object:
+        bottom = max(bottom, bm.content_top + sum(ro.lines_object.line_heights))
+    return top, bottom
+
+
+class BlockTiles(TileIndex):
+    # Indexes of the blocks (in the display list) by their paint extent, so painting a viewport only goes through
+    # the blocks which overlap it instead of all the blocks of the page
+    # Note: fixed blocks are painted on every viewport, so they're always found
+    def __init__(self):
+        super().__init__()
+        self.fixed_blocks = []
+
+    def add_block(self, index: int, ro: RenderBlock):
+        if ro.position == 'fixed':
+            self.fixed_blocks.append(index)
         else:
-            # paint the box with specified offsets
-            _x_offset, _y_offset = x_offset, y_offset
-            if ro.position == 'fixed':  # override the offsets
-                _x_offset, _y_offset = 0, 0
-            paint_box_model(win, ro.box_model, ro, _x_offset, _y_offset)
-            try:  # paint text if any
-                paint_render_lines(win, ro.lines_object, ro.box_model.content_left + _x_offset,
-                                   ro.box_model.content_top + _y_offset)
-            except AttributeError:  # thrown from ro.lines_object
-                pass
+            self.add(index, *paint_extent(ro))
+
+    def find_blocks(self, top: int, bottom: int) -> List[int]:
+        # Indexes of the blocks which may paint between the top and bottom (of the page), in paint order
+        return sorted(self.find(top, bottom).union(self.fixed_blocks))
+
+
+class DisplayList:
+    # Blocks in the order they are painted, with their (absolute) positions computed,
+    # and the rectangle which contains the entire page
+    # Note: it is valid till the layout changes, so it is painted again (eg, on scrolling) without traversing the tree
+    def __init__(self, blocks: list, containing_rect: pygame.Rect):
+        self.blocks = blocks
+        self.containing_rect = containing_rect
+        self._tiles = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def tiles(self) -> BlockTiles:  # blocks by their paint extent, indexed on first access (eg, first paint)
+        if self._tiles is None:
+            self._tiles = BlockTiles()
+            for index, ro in enumerate(self.blocks):
+                self._tiles.add_block(index, ro)
+        return self._tiles
+
+    def visible(self, top: int, bottom: int) -> List[int]:
+        # Indexes of the blocks which may paint between the top and bottom (of the page), in paint order
+        return self.tiles.find_blocks(top, bottom)
 
+
+class ProgressiveDisplayList(DisplayList):
+    # Display list of a render tree while it's laid out progressively (see `layout.construct_layout_progressively`),
+    # `update` adds the blocks laid out since the last update, so a block is positioned and added once instead of
+    # constructing the display list of the laid out part again for every step
+    # Blocks are added in paint order as they are laid out, and indexed by their paint extent once finished, while their
+    # unfinished ancestors (whose `auto` heights grow as their children are laid out) are painted on every viewport
+    # Note: absolute and fixed blocks are positioned once their parent is finished, they're left out (and painted once
+    # the layout is complete, by the display list of the document)
+    def __init__(self, root_ro: RenderBlock):
+        super().__init__([], pygame.Rect(0, 0, 0, 0))
+        self.root_ro = root_ro
+        self._tiles = BlockTiles()
+        # id of the next block to add (in pre-order) once it's laid out, NO_OBJECT once all are added
+        # Note: the blocks are walked by id (in the render arena), views are only created for the blocks added
+        self.next_block = root_ro.id
+        self.open_blocks = []  # indexes of the unfinished blocks, ie, the ancestors of the next block
+        self.finished_rect = pygame.Rect(0, 0, 0, 0)  # rectangle which contains the finished blocks
+
+    def update(self):
+        # Adds the blocks laid out since the last update (blocks yet to be laid out have no box model)
+        blocks, open_blocks = self.blocks, self.open_blocks
+        arena, root = self.root_ro.arena, self.root_ro.id
+        box_models, nodes, types = arena.box_models, arena.nodes, arena.types
+        block = self.next_block
+        while block != NO_OBJECT and box_models[block] is not None:
+            parent_block, box_model = arena.parent[block], box_models[block]
+            while open_blocks and blocks[open_blocks[-1]].id != parent_block:  # blocks before it are finished
+                self.finish(open_blocks.pop())
+            if parent_block != NO_OBJECT:
+                parent_box_model = box_models[parent_block]
+                box_model.top = parent_box_model.content_top + box_model.relative_top
+                box_model.left = parent_box_model.content_left + box_model.relative_left
+            else:
+                box_model.top, box_model.left = 0, 0
+            descend = False
+            position = nodes[block].styles[POSITION]
+            if parent_block == NO_OBJECT or position == 'static' or position == 'relative':
+                blocks.append(arena.view(block))
+                first_child = arena.first_child[block]
+                descend = first_child != NO_OBJECT and types[first_child] is RenderBlock
+                if descend:
+                    open_blocks.append(len(blocks) - 1)
+                else:
+                    self.finish(len(blocks) - 1)
+            block = arena.next_in_subtree(block, root, descend)
+        self.next_block = block
+        self.containing_rect = self.finished_rect.unionall([blocks[index].box_model.box_rect for index in open_blocks])
+
+    def finish(self, index: int):
+        ro = self.blocks[index]
+        self.finished_rect.union_ip(ro.box_model.box_rect)
+        self.tiles.add_block(index, ro)
+
+    def visible(self, top: int, bottom: int) -> List[int]:
+        return sorted(self.tiles.find(top, bottom).union(self.tiles.fixed_blocks, self.open_blocks))
+
+
+def construct_display_list(root_ro: RenderBlock, budget: Budget = None):
+    # Computes the positions of the blocks of the render tree (after layout stage) and the order they are painted
     # While painting, first static and relatively positioned elements are drawn
     # then absolutely positioned and finally fixed elements
     # Note: static, relative and absolute positioned elements move on scrolling
     # while fixed stays fixed to viewport
-    blocks = [root_ro]
-    absolute_blocks = []
-    fixed_blocks = []
+    # With `budget`, raises BudgetExceeded once it runs out of time (or stops with the blocks added so far if partial)
+    if budget is not None:
+        budget.start('display_list')
+    blocks = []
+    absolute_blocks = deque()
+    fixed_blocks = deque()
 
     # Setting the root level top and left offsets for computing others
     root_ro.box_model.top = 0
@@ -108,62 +261,110 @@ def paint_layout(win: pygame.Surface, root_ro: RenderBlock, x_offset=0, y_offset
     # rectangle which contains the entire page
     containing_rect = pygame.Rect(root_ro.box_model.box_rect)
 
+    # blocks are walked by id (in the render arena), views are only created for the blocks added to the display list
+    arena = root_ro.arena
+    box_models, nodes, types, parents, first_children = (arena.box_models, arena.nodes, arena.types, arena.parent,
+                                                         arena.first_child)
+
+    def paint_blocks(start_block: int):
+        # Adds the block followed by its static and relative positioned descendants (to be painted in that order)
+        # in a pre-order depth first traversal of the render arena
+        # absolute and fixed blocks found on the way are deferred (along with their descendants)
+        # Note: absolute children of absolute and fixed blocks are painted before other deferred absolute blocks
+        # Returns False if it stopped early (out of time)
+        prioritized_blocks = []
+        start_position = nodes[start_block].styles[POSITION]
+        block = start_block
+        while block != NO_OBJECT:
+            assert types[block] is RenderBlock
+            if budget is not None and budget.stop():
+                return False
+            parent_block, box_model, position = parents[block], box_models[block], nodes[block].styles[POSITION]
+            if box_model is None:  # yet to be laid out (progressive layout), skip it along with its descendants
+                block = arena.next_in_subtree(block, start_block, descend=False)
+                continue
+            if parent_block != NO_OBJECT:
+                assert types[parent_block] is RenderBlock
+                # Compute the positions from parent
+                parent_box_model = box_models[parent_block]
+                box_model.top = parent_box_model.content_top + box_model.relative_top
+                box_model.left = parent_box_model.content_left + box_model.relative_left
+                containing_rect.union_ip(box_model.box_rect)
+
+            painted = block == start_block or position == 'static' or position == 'relative'
+            if painted:
+                blocks.append(arena.view(block))
+            elif position == 'absolute':  # Note the intended order
+                if parent_block == start_block and start_position in ['absolute', 'fixed']:
+                    prioritized_blocks.append(block)
+                else:
+                    absolute_blocks.append(block)
+            elif position == 'fixed':
+                fixed_blocks.append(block)
+            # Note if blocks have children either they are all block or inline
+            first_child = first_children[block]
+            block = arena.next_in_subtree(block, start_block, painted and first_child != NO_OBJECT and
+                                          types[first_child] is RenderBlock)
+        absolute_blocks.extendleft(reversed(prioritized_blocks))
+        return True
+
     # Note: absolute and fixed elements may have static, relative and absolute elements
     # However will never have fixed elements and all fixed elements are children of viewport (html)
     # Paint all the blocks - priority based painting however
-    while blocks + absolute_blocks + fixed_blocks:
-        if blocks:
-            block = blocks.pop(0)
-            assert isinstance(block, RenderBlock)
-            if block.parent:
-                assert isinstance(block.parent, RenderBlock)
-                # Compute the positions from parent
-                block.box_model.top = block.parent.box_model.content_top + block.box_model.relative_top
-                block.box_model.left = block.parent.box_model.content_left + block.box_model.relative_left
-                containing_rect.union_ip(block.box_model.box_rect)
-
-            if block.position == 'static' or block.position == 'relative':
-                draw_block(block)
-                if all(isinstance(child_ro, RenderBlock) for child_ro in block.children):
-                    # Note if blocks have children either they are all block or inline
-                    blocks = block.children + blocks
-            elif block.position == 'absolute':  # Note the intended order
-                absolute_blocks.append(block)
-            elif block.position == 'fixed':
-                fixed_blocks.append(block)
-        elif absolute_blocks:
-            block = absolute_blocks.pop(0)
-            assert isinstance(block, RenderBlock)
-            if block.parent:
-                block.box_model.top = block.parent.box_model.content_top + block.box_model.relative_top
-                block.box_model.left = block.parent.box_model.content_left + block.box_model.relative_left
-                containing_rect.union_ip(block.box_model.box_rect)
-
-            draw_block(block)
-            if all(isinstance(child_ro, RenderBlock) for child_ro in block.children):
-                # First render the children of this block and its descendants before rendering other of the kind
-                # Absolute block is not expected to have fixed children
-                blocks = [child_ro for child_ro in block.children if
-                          child_ro.position in ['static', 'relative']] + blocks
-                absolute_blocks = [child_ro for child_ro in block.children if
-                                   child_ro.position == 'absolute'] + absolute_blocks
-        elif fixed_blocks:
-            # Point to Note: Fixed blocks are not impact by scroll
-            block = fixed_blocks.pop(0)
-            assert isinstance(block, RenderBlock)
-            if block.parent:
-                block.box_model.top = block.parent.box_model.content_top + block.box_model.relative_top
-                block.box_model.left = block.parent.box_model.content_left + block.box_model.relative_left
-                containing_rect.union_ip(block.box_model.box_rect)
-
-            draw_block(block)
-            if all(isinstance(child_ro, RenderBlock) for child_ro in block.children):
-                # Similar to above, however each of them is prioritized.
-                blocks = [child_ro for child_ro in block.children if
-                          child_ro.position in ['static', 'relative']] + blocks
-                absolute_blocks = [child_ro for child_ro in block.children if
-                                   child_ro.position == 'absolute'] + absolute_blocks
+    completed = paint_blocks(root_ro.id)
+    while completed and (absolute_blocks or fixed_blocks):
+        # Point to Note: Fixed blocks are not impact by scroll
+        completed = paint_blocks(absolute_blocks.popleft() if absolute_blocks else fixed_blocks.popleft())
+    return DisplayList(blocks, containing_rect)
+
+
+def paint_display_list(win: pygame.Surface, display_list: DisplayList, x_offset=0, y_offset=0, show_layout=False,
+                       budget: Budget = None, fixed_in_page=False):
+    # Paint the blocks of the display list onto `win`
+    # show_layout -> if enabled show only layout lines
+    # Use x_offset and y_offset to simulate scrolling behaviour
+    # With `fixed_in_page`, fixed blocks move with the offsets too, ie, they're painted where they are on the page
+    # scrolled to the top (eg, a part of a snapshot of the entire page) instead of on every viewport
+    # With `budget`, raises BudgetExceeded once it runs out of time (or stops with the blocks painted so far if partial)
+    if budget is not None:
+        budget.start('paint')
+    clip_rect = win.get_clip()
+    placements = []  # runs of text to blit, blitted at once before a box is painted over them (and at the end)
+    # only the blocks which may paint within the clip rectangle are gone through
+    blocks = display_list.blocks
+    for index in display_list.visible(clip_rect.top - y_offset, clip_rect.bottom - y_offset):
+        ro = blocks[index]
+        if budget is not None and budget.stop(1 + (len(ro.lines_object.word_widths) if ro.lines_object else 0)):
+            break
+        if show_layout:
+            paint_box_model_layout(win, ro.box_model)
+        else:
+            # paint the box with specified offsets
+            _x_offset, _y_offset = x_offset, y_offset
+            if ro.position == 'fixed' and not fixed_in_page:  # override the offsets
+                _x_offset, _y_offset = 0, 0
+            bm = ro.box_model
+            border_width = max(bm.border_top, bm.border_right, bm.border_bottom, bm.border_left)
+            # boxes without background and borders paint nothing, neither do the boxes outside the clip rectangle
+            # (inflated by the border width, as thick lines are drawn around their positions)
+            if (border_width or ro.background_color) and \
+                    clip_rect.colliderect(pygame.Rect(bm.border_rect).move(_x_offset, _y_offset)
+                                          .inflate(2 * border_width, 2 * border_width)):
+                if placements:  # text below the box
+                    win.blits(placements, False)
+                    placements.clear()
+                paint_box_model(win, bm, ro, _x_offset, _y_offset)
+            if ro.lines_object:  # paint text if any
+                paint_render_lines(win, ro.lines_object, bm.content_left + _x_offset, bm.content_top + _y_offset,
+                                   placements)
+    win.blits(placements, False)
 
     # return rectangle that encloses the entire page
     # useful for setting scrolling limits
-    return containing_rect
+    return pygame.Rect(display_list.containing_rect)
+
+
+def paint_layout(win: pygame.Surface, root_ro: RenderBlock, x_offset=0, y_offset=0, show_layout=False,
+                 budget: Budget = None):
+    # Paint the render tree after layout stage onto `win`
+    return paint_display_list(win, construct_display_list(root_ro, budget), x_offset, y_offset, show_layout, budget)
@@ -3,57 +3,207 @@ from html_parser import DOMNode, TextNode
 from typing import Union, List, Optional, TYPE_CHECKING
 from css_properties import *
 from box_model import BoxModel
+from array import array
 import re
 
 if TYPE_CHECKING:  # to prevent cycling dependency
-    from text_layout import WordObject, RenderLines
+    from text_layout import RenderLines
+
+
+NO_OBJECT = -1  # render object id used when there is no such object (eg, parent of the root)
+
+
+class RenderArena:
+    # Render tree stored as columns indexed by render object id
+    # Structure is kept in integer arrays, children are a doubly linked list of siblings,
+    # so structural edits are O(1) and traversals walk the arrays without copying children lists
+    # Render objects are thin views (arena and id) created on access, they hold no state of their own
+    def __init__(self):
+        self.types = []  # type of the render object view (RenderBlock, RenderInline or RenderText)
+        self.nodes = []  # DOM node (or text node) of the render object
+        # Computed during the layout phase
+        self.box_models = []  # box model of render blocks
+        self.lines_objects = []  # lines object of render blocks whose descendants are all inline/text objects
+        # structure
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.previous_sibling = array('i')
+        self.next_sibling = array('i')
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def allocate(self, view_type: type, node: Union[DOMNode, TextNode]):
+        # Returns the id of a new (detached) render object
+        self.types.append(view_type)
+        self.nodes.append(node)
+        for column in (self.box_models, self.lines_objects):
+            column.append(None)
+        for links in (self.parent, self.first_child, self.last_child, self.previous_sibling, self.next_sibling):
+            links.append(NO_OBJECT)
+        return len(self.nodes) - 1
+
+    def view(self, index: int):
+        # Render object with the given id (None for NO_OBJECT)
+        if index == NO_OBJECT:
+            return None
+        ro = object.__new__(self.types[index])
+        ro.arena, ro.id = self, index
+        return ro
+
+    def link(self, index: int, parent: int, previous: int):
+        # Inserts the detached `index` into children of `parent` after `previous` (first child if NO_OBJECT)
+        assert self.parent[index] == NO_OBJECT
+        following = self.next_sibling[previous] if previous != NO_OBJECT else self.first_child[parent]
+        self.parent[index] = parent
+        self.previous_sibling[index], self.next_sibling[index] = previous, following
+        if previous != NO_OBJECT:
+            self.next_sibling[previous] = index
+        else:
+            self.first_child[parent] = index
+        if following != NO_OBJECT:
+            self.previous_sibling[following] = index
+        else:
+            self.last_child[parent] = index
+
+    def unlink(self, index: int):
+        # Detaches `index` (along with its descendants) from its parent
+        parent, previous, following = self.parent[index], self.previous_sibling[index], self.next_sibling[index]
+        assert parent != NO_OBJECT
+        if previous != NO_OBJECT:
+            self.next_sibling[previous] = following
+        else:
+            self.first_child[parent] = following
+        if following != NO_OBJECT:
+            self.previous_sibling[following] = previous
+        else:
+            self.last_child[parent] = previous
+        self.parent[index] = self.previous_sibling[index] = self.next_sibling[index] = NO_OBJECT
+
+    def children(self, index: int):
+        # Iterates over the ids of children of `index`
+        child = self.first_child[index]
+        while child != NO_OBJECT:
+            yield child
+            child = self.next_sibling[child]
+
+    def next_in_subtree(self, index: int, root: int, descend=True):
+        # Id following `index` in the pre-order (depth first) traversal of subtree of `root`,
+        # children of `index` are skipped if not `descend`. NO_OBJECT at the end of the traversal
+        if descend and self.first_child[index] != NO_OBJECT:
+            return self.first_child[index]
+        while index != root:
+            if self.next_sibling[index] != NO_OBJECT:
+                return self.next_sibling[index]
+            index = self.parent[index]
+        return NO_OBJECT
 
 
 class RenderObject:
-    node: Union[DOMNode, TextNode]
-    parent: Optional[RenderChildren]
+    # View of a render object in a render arena, a new arena is created for a render tree's root
+    # Note: views are created on access, so compare them with `==` (not `is`),
+    # and objects can only be moved around within the same arena
+    __slots__ = ('arena', 'id')
+
+    def __init__(self, node: Union[DOMNode, TextNode], arena: Optional[RenderArena] = None):
+        self.arena = arena if arena is not None else RenderArena()
+        self.id = self.arena.allocate(type(self), node)
+
+    def __eq__(self, other):
+        return isinstance(other, RenderObject) and self.arena is other.arena and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.arena), self.id))
+
+    @property
+    def node(self) -> Union[DOMNode, TextNode]:
+        return self.arena.nodes[self.id]
+
+    @property
+    def parent(self) -> Optional[RenderChildren]:
+        return self.arena.view(self.arena.parent[self.id])
+
+    @property
+    def next_sibling(self) -> Optional[RenderObject]:
+        return self.arena.view(self.arena.next_sibling[self.id])
+
+    @property
+    def previous_sibling(self) -> Optional[RenderObject]:
+        return self.arena.view(self.arena.previous_sibling[self.id])
+
+    def next_in_subtree(self, root_ro: RenderObject, descend=True) -> Optional[RenderObject]:
+        # Render object following this one in a pre-order traversal of `root_ro`'s subtree
+        # (skipping its children if not `descend`), None at the end of the traversal
+        return self.arena.view(self.arena.next_in_subtree(self.id, root_ro.id, descend))
 
 
 class RenderChildren(RenderObject):
     # RenderObject which have children
-    children: List[RenderObject]
+    __slots__ = ()
 
-    def __init__(self):
-        self.parent = None
-        self.children = []
+    @property
+    def children(self) -> List[RenderObject]:
+        # Note: a new list, use `iter_children` or `first_child` and `next_sibling` to avoid copying
+        return list(self.iter_children())
+
+    def iter_children(self):
+        arena = self.arena
+        for child in arena.children(self.id):
+            yield arena.view(child)
+
+    @property
+    def first_child(self) -> Optional[RenderObject]:
+        return self.arena.view(self.arena.first_child[self.id])
+
+    @property
+    def last_child(self) -> Optional[RenderObject]:
+        return self.arena.view(self.arena.last_child[self.id])
 
     def add_child(self, ro: RenderObject):
-        ro.parent = self  # adopt the render object
-        self.children.append(ro)
+        assert ro.arena is self.arena
+        self.arena.link(ro.id, self.id, self.arena.last_child[self.id])  # adopt the render object
 
     def remove_child(self, ro: RenderObject):
-        ro.parent = None  # abandon the render object
-        self.children.remove(ro)
+        assert ro.arena is self.arena and self.arena.parent[ro.id] == self.id
+        self.arena.unlink(ro.id)  # abandon the render object
 
     def abandon_children(self):
-        for child_ro in self.children:
-            child_ro.parent = None  # abandon the render object
-        children, self.children = self.children, []  # remove all children
+        children = self.children
+        for child_ro in children:
+            self.arena.unlink(child_ro.id)  # abandon the render object
         return children
 
     def insert_after(self, ro: RenderObject, sibling: RenderObject):
         # Inserts the `ro` node into children after `sibling`
-        assert sibling in self.children
-        ro.parent = self  # adopt the render object
-        self.children.insert(self.children.index(sibling) + 1, ro)
+        assert ro.arena is self.arena and self.arena.parent[sibling.id] == self.id
+        self.arena.link(ro.id, self.id, sibling.id)  # adopt the render object
 
 
 class RenderBlock(RenderChildren):
+    __slots__ = ()
+
+    def __init__(self, node: DOMNode, arena: Optional[RenderArena] = None):
+        assert node.styles[DISPLAY] == 'block'
+        RenderChildren.__init__(self, node, arena)
+
     # Computed during the layout phase
-    # `lines_object` is defined when the descendants are all inline/text objects
-    lines_object: Optional[RenderLines]
-    box_model: BoxModel
+    @property
+    def box_model(self) -> BoxModel:
+        return self.arena.box_models[self.id]
 
-    def __init__(self, node: DOMNode):
-        RenderChildren.__init__(self)
+    @box_model.setter
+    def box_model(self, box_model: BoxModel):
+        self.arena.box_models[self.id] = box_model
 
-        assert node.styles[DISPLAY] == 'block'
-        self.node = node
+    @property
+    def lines_object(self) -> Optional[RenderLines]:
+        # defined when the descendants are all inline/text objects
+        return self.arena.lines_objects[self.id]
+
+    @lines_object.setter
+    def lines_object(self, lines_object: RenderLines):
+        self.arena.lines_objects[self.id] = lines_object
 
     @property
     def position(self):
@@ -79,46 +229,56 @@ class RenderBlock(RenderChildren):
 
 
 class RenderInline(RenderChildren):
-    def __init__(self, node: DOMNode):
-        RenderChildren.__init__(self)
+    __slots__ = ()
 
+    def __init__(self, node: DOMNode, arena: Optional[RenderArena] = None):
         assert node.styles[DISPLAY] == 'inline'
-        self.node = node
+        RenderChildren.__init__(self, node, arena)
 
     def __str__(self):
         return f'RenderInline {self.node}'
 
 
 class RenderText(RenderObject):
+    __slots__ = ()
     node: TextNode
-    words: List[WordObject]  # Computed in the layout phase
-
-    def __init__(self, node: TextNode):
-        self.node = node
 
     def __str__(self):
         return f'RenderText {self.node}'
 
+    @property
+    def words(self) -> List[str]:
+        # Computed in the layout phase, words are stored by the lines object of its block (sliced from text on access)
+        block_ro = self.parent
+        while not isinstance(block_ro, RenderBlock):
+            block_ro = block_ro.parent
+        return block_ro.lines_object.words(self) if block_ro.lines_object else []
+
+    @property
+    def parent_styles(self):
+        # styles of the parent (text nodes don't have styles of their own)
+        return self.arena.nodes[self.arena.parent[self.id]].styles
+
     @property
     def font_size(self):
-        font_size = self.parent.node.styles[FONT_SIZE]
+        font_size = self.parent_styles[FONT_SIZE]
         return int(font_size[:-2])
 
     @property
     def font_weight(self):
-        return self.parent.node.styles[FONT_WEIGHT]
+        return self.parent_styles[FONT_WEIGHT]
 
     @property
     def font_style(self):
-        return self.parent.node.styles[FONT_STYLE]
+        return self.parent_styles[FONT_STYLE]
 
     @property
     def background_color(self):
-        background_color = self.parent.node.styles[BACKGROUND_COLOR]
+        background_color = self.parent_styles[BACKGROUND_COLOR]
         return background_color if re.match(r'^#[0-9a-f]{6}$', background_color) else None
 
     @property
     def color(self):
-        color = self.parent.node.styles[COLOR]
+        color = self.parent_styles[COLOR]
         assert re.match(r'^#[0-9a-f]{6}$', color)
         return color
@@ -1,11 +1,12 @@
 from __future__ import annotations
 from html_parser import DOMNode, TextNode
 from attachment import parse_style, inherit_style
-from render_object import RenderBlock, RenderInline, RenderText
+from render_object import RenderArena, RenderBlock, RenderInline, RenderText
 from css_properties import DISPLAY
+from budget import Budget
 
 
-def anonymous_block(parent_node: DOMNode):
+def anonymous_block(parent_node: DOMNode, arena: RenderArena):
     # Creates a anonymous render block,
     # uses the parent node to compute inherited styles,
     # NOTE: the corresponding dom node has no parent as its not part of DOM
@@ -14,31 +15,38 @@ def anonymous_block(parent_node: DOMNode):
     node.parent = parent_node  # only add it to compute inherited styles
     inherit_style(node)
     node.parent = None  # remove it after computing inherited styles
-    return RenderBlock(node)
+    return RenderBlock(node, arena)
 
 
-def construct_render_tree(dom: DOMNode):
+def construct_render_tree(dom: DOMNode, budget: Budget = None):
     # Returns a render tree
     #   - with no display none elements
     #   - block objects contain either all inline/text objects or block objects
     #   - inline objects contain only inline/text objects
     #   - absolute and fixed block objects are children of
     #     positioned ancestor block object and viewport respectively
+    # Raises BudgetExceeded when the blocks (of the elements) or the time cross the limits of `budget`
     assert dom.styles[DISPLAY] == 'block'
+    if budget is not None:
+        budget.start('render_tree')
+    num_blocks = 1
 
-    root_ro = RenderBlock(dom)
+    root_ro = RenderBlock(dom)  # all the render objects are allocated in the root's arena
+    arena = root_ro.arena
     # Construct the initial render tree
     #   - removes display none blocks
     #   - block elements are only children of block elements
     #   - inline and text elements can be children of both inline and block elements
     render_objects = [root_ro]
     while render_objects:
-        ro = render_objects.pop(0)  # Depth first traversal
+        ro = render_objects.pop()  # Depth first traversal
         objects_needing_exploration = []  # To maintain in-order traversal
+        if budget is not None:
+            budget.tick(len(ro.node.children))
         for node in ro.node.children:
             if isinstance(node, TextNode):
                 # text is a leaf node, insert it to the parent.
-                text_ro = RenderText(node)
+                text_ro = RenderText(node, arena)
                 ro.add_child(text_ro)
                 continue
 
@@ -48,7 +56,10 @@ def construct_render_tree(dom: DOMNode):
                 continue
 
             elif node.styles[DISPLAY] == 'block':
-                block_ro = RenderBlock(node)
+                num_blocks += 1
+                if budget is not None:
+                    budget.check('blocks', num_blocks)
+                block_ro = RenderBlock(node, arena)
                 if ro.node.styles[DISPLAY] == 'inline':
                     # If parent is a inline block,
                     # can't render a block element inside it
@@ -70,36 +81,33 @@ def construct_render_tree(dom: DOMNode):
                     ro.add_child(block_ro)
                 objects_needing_exploration.append(block_ro)
             elif node.styles[DISPLAY] == 'inline':
-                inline_ro = RenderInline(node)
+                inline_ro = RenderInline(node, arena)
                 ro.add_child(inline_ro)
                 objects_needing_exploration.append(inline_ro)
-        render_objects = objects_needing_exploration + render_objects
+        render_objects.extend(reversed(objects_needing_exploration))  # first child is explored next
 
     # Move absolute and fixed render blocks up the ancestor chain
     # absolute block elements become the children of nearest positioned ancestor
     # fixed block elements become children of viewport (html render block)
     # NOTE: POSITIONS OF INLINE OBJECTS ARE IGNORED.
     assert root_ro.position == 'relative'
-    render_objects = [root_ro]
+    render_objects = [(root_ro, root_ro)]  # (render object, its nearest positioned ancestor or itself)
     while render_objects:
-        ro = render_objects.pop(0)  # Depth first traversal
+        ro, positioned_ro = render_objects.pop()  # Depth first traversal
         objects_needing_exploration = []
-        for child_ro in ro.children[:]:  # Note children can be removed during traversal
+        for child_ro in ro.children:  # Note children can be removed during traversal (children is a copy)
             if not isinstance(child_ro, RenderBlock):
                 continue
 
             # Only handling block elements
             if child_ro.position == 'absolute':
                 if not ro.is_positioned:
-                    # find the nearest positioned ancestor
-                    ancestor_ro = ro
-                    while not ancestor_ro.is_positioned:
-                        ancestor_ro = ancestor_ro.parent
-                        assert ancestor_ro
+                    # nearest positioned ancestor is tracked during the traversal
+                    assert positioned_ro.is_positioned
                     # remove from current parent
                     ro.remove_child(child_ro)
                     # adopted by the positioned ancestor
-                    ancestor_ro.add_child(child_ro)
+                    positioned_ro.add_child(child_ro)
             elif child_ro.position == 'fixed':
                 if ro != root_ro:
                     # remove from current parent
@@ -107,8 +115,8 @@ def construct_render_tree(dom: DOMNode):
                     # move it to the viewport (html)
                     root_ro.add_child(child_ro)
 
-            objects_needing_exploration.append(child_ro)
-        render_objects = objects_needing_exploration + render_objects
+            objects_needing_exploration.append((child_ro, child_ro if child_ro.is_positioned else positioned_ro))
+        render_objects.extend(reversed(objects_needing_exploration))
 
     # When blocks objects have both inline and block objects as children
     # we group inline blocks ino an anonymous block object
@@ -121,10 +129,10 @@ def construct_render_tree(dom: DOMNode):
     #           </BLOCK>
     render_objects = [root_ro]
     while render_objects:
-        ro = render_objects.pop(0)  # Depth first traversal
+        ro = render_objects.pop()  # Depth first traversal
         objects_needing_exploration = []
-        if ro.children and any(isinstance(child_ro, RenderBlock) for child_ro in ro.children) and \
-                any(not isinstance(child_ro, RenderBlock) for child_ro in ro.children):
+        if any(isinstance(child_ro, RenderBlock) for child_ro in ro.iter_children()) and \
+                any(not isinstance(child_ro, RenderBlock) for child_ro in ro.iter_children()):
             # If has children that's a mixture of block and inline elements
             children = ro.abandon_children()  # abandon children to recompute it
             anonymous_ro = None
@@ -136,7 +144,7 @@ def construct_render_tree(dom: DOMNode):
                     continue
                 # If a inline or text object
                 if not anonymous_ro:
-                    anonymous_ro = anonymous_block(ro.node)
+                    anonymous_ro = anonymous_block(ro.node, arena)
                     ro.add_child(anonymous_ro)  # add the anonymous block at child
                 # add the inline or text object into the anonymous block
                 assert isinstance(child_ro, RenderInline) or isinstance(child_ro, RenderText)
@@ -144,23 +152,24 @@ def construct_render_tree(dom: DOMNode):
         # Loop through (updated) children
         # Note since anonymous block only has inline/text objects,
         # it will not trigger further recursion.
-        for child_ro in ro.children:
+        for child_ro in ro.iter_children():
             if isinstance(child_ro, RenderBlock):
                 objects_needing_exploration.append(child_ro)
-        render_objects = objects_needing_exploration + render_objects
+        render_objects.extend(reversed(objects_needing_exploration))
 
     # assertions to make sure that render tree meets specified expectations
-    render_objects = [root_ro]
-    while render_objects:  # Any traversal would do
-        ro = render_objects.pop(0)
+    ro = root_ro
+    while ro:  # Any traversal would do
         if isinstance(ro, RenderText):  # no assertions on render text
+            ro = ro.next_in_subtree(root_ro)
             continue
-        if isinstance(ro, RenderBlock) and ro.children:
+        children = ro.children
+        if isinstance(ro, RenderBlock) and children:
             # all children are either block or inline/text
-            assert all(isinstance(child, RenderBlock) for child in ro.children) or \
-                   all(not isinstance(child, RenderBlock) for child in ro.children)
-            if all(isinstance(child, RenderBlock) for child in ro.children):
-                for child in ro.children:
+            assert all(isinstance(child, RenderBlock) for child in children) or \
+                   all(not isinstance(child, RenderBlock) for child in children)
+            if all(isinstance(child, RenderBlock) for child in children):
+                for child in children:
                     assert isinstance(child, RenderBlock)
                     if child.position == 'absolute':
                         # absolute blocks are children of positioned blocks
@@ -168,9 +177,9 @@ def construct_render_tree(dom: DOMNode):
                     if child.position == 'fixed':
                         # fixed blocks are children of viewport
                         assert ro == root_ro
-        if isinstance(ro, RenderInline) and ro.children:
+        if isinstance(ro, RenderInline) and children:
             # all children are inline/text
-            assert all(not isinstance(child, RenderBlock) for child in ro.children)
-        render_objects = ro.children + render_objects
+            assert all(not isinstance(child, RenderBlock) for child in children)
+        ro = ro.next_in_subtree(root_ro)
 
     return root_ro
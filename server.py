@@ -0,0 +1,378 @@
+import argparse
+import base64
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from budget import Budget, BudgetExceeded
+
+# Local rendering service, renders html (and css) posted to it into a PNG and/or a JSON dump of the layout
+# Pages are rendered by a pool of worker processes, each worker loads the fonts, the (precompiled) browser styles
+# and the font metric tables once when it starts, so a request only pays for its own document
+#
+# POST /render  {"html": "...", "css": ["..."], "width": 1000, "height": 600, "format": "png" | "json" | "both",
+#                "partial": false}
+#   png  -> image/png of the viewport
+#   json -> {"title": ..., "blocks": [...], "diagnostics": [...], "num_diagnostics": ..., "css_diagnostics": [...],
+#            "num_css_diagnostics": ...} (see `layout_dump`, and `utils.Diagnostics` for the parse errors of the html
+#            and of the css, only the first few are listed)
+# Pages are rendered within the resource budgets of the server (see `budget.py`), a page exceeding them is
+# rejected with 422 {"error": ..., "resource": ..., "limit": ..., "stage": ...}, unless the request is "partial"
+# and layout or paint ran out of time, then the part done in time is returned (the JSON dump has "truncated",
+# and the PNG the X-Truncated header with the stage)
+#   both -> the JSON dump with the PNG (base64 encoded) as "png"
+# GET /metrics  request counts, queue depth and latencies (in milliseconds)
+
+DEFAULT_WIDTH, DEFAULT_HEIGHT = 1000, 600
+MAX_VIEWPORT_SIZE = 8192  # larger viewports are rejected (the surface alone would be hundreds of MB)
+MAX_REQUEST_SIZE = 64 << 20  # bytes
+FORMATS = ['png', 'json', 'both']
+LATENCY_WINDOW = 1000  # latency percentiles are computed over these many latest requests
+
+# Warm state of a worker process (set up once by `initialize_worker`)
+_worker = None
+
+
+class Worker:
+    def __init__(self, layout_mode: str, use_font_metrics: bool, limits: dict = None, clear_memos=False):
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # workers never open a window
+        import pygame
+        from engine import Engine, DEFAULT_BROWSER_BACKGROUND
+        import layout
+
+        pygame.init()
+        # SDL handles the termination signals (as quit events), workers are stopped by the server instead
+        # and are terminated along with it, Ctrl+C in the terminal stops the server (not the workers)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.pygame, self.background = pygame, DEFAULT_BROWSER_BACKGROUND
+        self.layout_mode = layout_mode
+        self.limits = limits or {}  # arguments of the `Budget` of each request
+        # with `clear_memos`, the layout memo (see `layout.clear_memos`) is cleared after each request
+        # so a request never reuses (or keeps alive) the box models and lines of another one
+        self.clear_memos = layout.clear_memos if clear_memos else None
+        self.engine = Engine(use_font_metrics=use_font_metrics)
+        self.engine.user_agent_cssom  # noqa, loads the browser styles
+        self.surfaces = {}  # viewport size to the surface it's painted on, reused across requests
+        # warm up the rest of the pipeline (regular expressions, caches of text layout etc.)
+        self.render('<html><head><title>warm up</title></head><body><div>Warm <b>up</b></div></body></html>',
+                    ['div { padding-top: 1px; }'], DEFAULT_WIDTH, DEFAULT_HEIGHT, 'both')
+
+    def render(self, html: str, style_sheets: list, width: int, height: int, output_format: str, partial=False):
+        try:
+            return self.render_document(html, style_sheets, width, height, output_format, partial)
+        finally:
+            if self.clear_memos:
+                self.clear_memos()
+
+    def render_document(self, html: str, style_sheets: list, width: int, height: int, output_format: str,
+                        partial=False):
+        budget = Budget(**self.limits, partial=partial)
+        document = self.engine.document(html, style_sheets, width, height, self.layout_mode, budget=budget)
+        result = {}
+        if output_format != 'json':
+            if (width, height) not in self.surfaces:
+                self.surfaces[width, height] = self.pygame.Surface((width, height))
+            win = self.surfaces[width, height]
+            win.fill(self.background)
+            document.paint(win)
+            png = io.BytesIO()
+            self.pygame.image.save(win, png, 'png')
+            result['png'] = png.getvalue()
+        if output_format != 'png':
+            result['layout'] = {'title': document.title, 'blocks': layout_dump(document),
+                                'diagnostics': [diagnostic._asdict() for diagnostic in document.diagnostics],
+                                'num_diagnostics': len(document.diagnostics),
+                                'css_diagnostics': [diagnostic._asdict() for diagnostic in document.css_diagnostics],
+                                'num_css_diagnostics': len(document.css_diagnostics)}
+        if budget.truncated is not None:
+            result['truncated'] = budget.truncated.to_dict()
+            if 'layout' in result:
+                result['layout']['truncated'] = result['truncated']
+        return result
+
+
+def layout_dump(document):
+    # Blocks in pre-order as a flat list (so deep pages need no recursion to encode), each block has the index
+    # of its parent, its margin box and content box as [left, top, width, height] (in page coordinates, same as
+    # paint) and the text runs of its lines as [left, top, height, text]
+    from render_object import RenderBlock, NO_OBJECT
+    from css_properties import POSITION
+
+    document.display_list  # noqa, computes the positions of the blocks
+    root_ro = document.layout_tree
+    # blocks are walked by id in the render arena (no views are created)
+    arena, root = root_ro.arena, root_ro.id
+    box_models, nodes, lines_objects, types = arena.box_models, arena.nodes, arena.lines_objects, arena.types
+    blocks, indices = [], {}
+    index = root
+    while index != NO_OBJECT:
+        box_model, parent = box_models[index], arena.parent[index]
+        if box_model is None:  # not laid out (partial layout), skipped along with its descendants
+            index = arena.next_in_subtree(index, root, descend=False)
+            continue
+        indices[index] = len(blocks)
+        node = nodes[index]
+        block = {
+            'parent': indices[parent] if parent != NO_OBJECT else None,
+            'tag': node.tag,
+            'position': node.styles[POSITION],
+            'box': list(box_model.box_rect),
+            'content': list(box_model.content_rect),
+        }
+        lines_object = lines_objects[index]
+        if lines_object:
+            left, top = box_model.content_left, box_model.content_top
+            block['runs'] = [[left + offset, top + line_offset, run_height, text] for
+                             line_offset, _, _, text, offset, run_height in lines_object.iter_runs()]
+        blocks.append(block)
+        first_child = arena.first_child[index]
+        index = arena.next_in_subtree(index, root, first_child != NO_OBJECT and types[first_child] is RenderBlock)
+    return blocks
+
+
+def initialize_worker(layout_mode: str, use_font_metrics: bool, limits: dict = None, clear_memos=False):
+    global _worker
+    _worker = Worker(layout_mode, use_font_metrics, limits, clear_memos)
+
+
+def render_in_worker(html: str, style_sheets: list, width: int, height: int, output_format: str, partial=False):
+    # Returns the result with the time the worker started on it and how long it took (the rest is queueing)
+    started = time.time()
+    result = _worker.render(html, style_sheets, width, height, output_format, partial)
+    return result, started, time.time() - started
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {f'p{p}': round(values[min(len(values) * p // 100, len(values) - 1)] * 1000, 3) for p in (50, 90, 99)}
+
+
+class Metrics:
+    # Counters and latencies of the requests, shared by the request threads
+    def __init__(self, num_workers: int):
+        self.lock = threading.Lock()
+        self.num_workers = num_workers
+        self.requests = self.errors = 0
+        self.in_flight = self.max_queue_depth = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # submitted till result, in seconds
+        self.queue_times = deque(maxlen=LATENCY_WINDOW)  # submitted till a worker started on it
+        self.render_times = deque(maxlen=LATENCY_WINDOW)  # time taken by the worker
+
+    @property
+    def queue_depth(self):  # requests waiting for a worker
+        return max(self.in_flight - self.num_workers, 0)
+
+    def submitted(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def completed(self, latency, queue_time=None, render_time=None):
+        with self.lock:
+            self.in_flight -= 1
+            if render_time is None:
+                self.errors += 1
+                return
+            self.latencies.append(latency)
+            self.queue_times.append(queue_time)
+            self.render_times.append(render_time)
+
+    def report(self):
+        with self.lock:
+            return {
+                'workers': self.num_workers,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'latency_ms': percentiles(self.latencies),
+                'queue_ms': percentiles(self.queue_times),
+                'render_ms': percentiles(self.render_times),
+            }
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_request(body: bytes):
+    # Returns the arguments of `render_in_worker` from the json body of the request
+    try:
+        request = json.loads(body)
+    except ValueError as e:
+        raise RequestError(400, f'Invalid JSON: {e}')
+    if not isinstance(request, dict) or not isinstance(request.get('html'), str):
+        raise RequestError(400, '"html" is required')
+    style_sheets = request.get('css', [])
+    if isinstance(style_sheets, str):
+        style_sheets = [style_sheets]
+    if not isinstance(style_sheets, list) or not all(isinstance(css, str) for css in style_sheets):
+        raise RequestError(400, '"css" should be a stylesheet or a list of stylesheets')
+    width, height = request.get('width', DEFAULT_WIDTH), request.get('height', DEFAULT_HEIGHT)
+    if not all(isinstance(size, int) and 0 < size <= MAX_VIEWPORT_SIZE for size in (width, height)):
+        raise RequestError(400, f'"width" and "height" should be between 1 and {MAX_VIEWPORT_SIZE}')
+    output_format = request.get('format', 'png')
+    if output_format not in FORMATS:
+        raise RequestError(400, f'"format" should be one of {", ".join(FORMATS)}')
+    partial = request.get('partial', False)
+    if not isinstance(partial, bool):
+        raise RequestError(400, '"partial" should be true or false')
+    return request['html'], style_sheets, width, height, output_format, partial
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'RenderServer/1.0'
+    protocol_version = 'HTTP/1.1'  # keep alive
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send(200, 'application/json', json.dumps(self.server.metrics.report()).encode())
+        else:
+            self.send(404, 'text/plain', b'Not found\n')
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send(404, 'text/plain', b'Not found\n')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', -1))
+            if not 0 <= length <= MAX_REQUEST_SIZE:
+                self.close_connection = True  # body is not read
+                raise RequestError(413 if length > 0 else 411, 'Content-Length is missing or too large')
+            args = parse_request(self.rfile.read(length))
+        except RequestError as e:
+            self.send(e.status, 'text/plain', f'{e}\n'.encode())
+            return
+
+        metrics = self.server.metrics
+        submitted = time.time()
+        metrics.submitted()
+        try:
+            result, started, render_time = self.server.executor.submit(render_in_worker, *args).result()
+        except BudgetExceeded as e:
+            metrics.completed(time.time() - submitted)
+            self.send(422, 'application/json', json.dumps({'error': str(e), **e.to_dict()}).encode())
+            return
+        except Exception as e:  # errors while rendering the page (or a worker crashed)
+            metrics.completed(time.time() - submitted)
+            self.send(500, 'text/plain', f'{type(e).__name__}: {e}\n'.encode())
+            return
+        metrics.completed(time.time() - submitted, max(started - submitted, 0), render_time)
+
+        headers = {'X-Render-Time': f'{render_time * 1000:.3f}ms'}
+        if 'truncated' in result:
+            headers['X-Truncated'] = result['truncated']['stage']
+        if 'layout' not in result:
+            self.send(200, 'image/png', result['png'], headers)
+            return
+        if 'png' in result:
+            result['layout']['png'] = base64.b64encode(result['png']).decode()
+        self.send(200, 'application/json', json.dumps(result['layout']).encode(), headers)
+
+    def send(self, status: int, content_type: str, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class RenderServer(ThreadingHTTPServer):
+    # Each connection is handled in a thread, which waits for a worker process to render its request
+    def __init__(self, address, executor: ProcessPoolExecutor, metrics: Metrics, quiet=False):
+        super().__init__(address, RenderRequestHandler)
+        self.executor, self.metrics, self.quiet = executor, metrics, quiet
+
+
+class UnixRenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, executor: ProcessPoolExecutor, metrics: Metrics, quiet=False):
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a previous server
+        super().__init__(path, RenderRequestHandler)
+        self.executor, self.metrics, self.quiet = executor, metrics, quiet
+
+
+def start_workers(num_workers: int, layout_mode='scalar', use_font_metrics=False, limits: dict = None,
+                  clear_memos=False):
+    # Returns the pool of worker processes once all of them are warm
+    # `limits` are the arguments of the `Budget` each request is rendered within (unlimited by default)
+    # with `clear_memos`, requests don't share the layout memo (see `Worker`)
+    executor = ProcessPoolExecutor(num_workers, initializer=initialize_worker,
+                                   initargs=(layout_mode, use_font_metrics, limits, clear_memos))
+    # a task per worker, workers are started on demand and each one initializes before taking a task
+    for future in [executor.submit(time.sleep, 0.1) for _ in range(num_workers)]:
+        future.result()
+    return executor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local rendering service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--unix', type=str, default=None, help='listen on this unix socket instead')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--layout', type=str, default='scalar', choices=['scalar', 'vectorized'],
+                        help='layout implementation, vectorized layout needs numpy (for very large pages)')
+    parser.add_argument('--font-metrics', action='store_true',
+                        help='compute word widths from font metric tables, faster but may differ by a pixel')
+    parser.add_argument('--max-nodes', type=int, default=None, help='reject pages with more elements and texts')
+    parser.add_argument('--max-depth', type=int, default=None, help='reject pages with elements nested deeper')
+    parser.add_argument('--max-words', type=int, default=None, help='reject pages with more words of text')
+    parser.add_argument('--max-blocks', type=int, default=None, help='reject pages with more blocks to lay out')
+    parser.add_argument('--stage-time', type=float, default=None,
+                        help='seconds each stage (parse, style, layout, paint etc.) may take')
+    parser.add_argument('--clear-memos', action='store_true',
+                        help='clear the layout memo after each request, instead of sharing it across requests')
+    parser.add_argument('--quiet', action='store_true', help='do not log requests')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers should be at least 1')
+
+    # stopping the server (Ctrl+C or SIGTERM) shuts down the workers and removes the unix socket
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    budget_limits = {'max_nodes': args.max_nodes, 'max_depth': args.max_depth, 'max_words': args.max_words,
+                     'max_blocks': args.max_blocks, 'stage_time': args.stage_time}
+    workers = start_workers(args.workers, args.layout, args.font_metrics, budget_limits, args.clear_memos)
+    render_metrics = Metrics(args.workers)
+    if args.unix:
+        server = UnixRenderServer(args.unix, workers, render_metrics, args.quiet)
+        print(f'Rendering on unix socket {args.unix} with {args.workers} workers', file=sys.stderr)
+    else:
+        server = RenderServer((args.host, args.port), workers, render_metrics, args.quiet)
+        print(f'Rendering on http://{args.host}:{server.server_port} with {args.workers} workers', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        workers.shutdown()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
@@ -0,0 +1,82 @@
+import io
+import os
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # never opens a window
+
+import pygame
+
+import attachment
+import html_parser
+import layout
+import paint
+import renderer
+import user_agent
+import utils
+from benchmark import generate_deep_html
+
+# Deeply nested pages are rendered in bounded stack and time: every stage (parse, styles, render tree, layout, paint
+# and printing the tree) walks the tree iteratively, so it works within a small recursion limit, and in time linear
+# in the depth (time per level of the deep page is within `MAX_SLOWDOWN` of the time per level of a shallower one)
+# Run with `python -m pytest test_deep_nesting.py` (or `python test_deep_nesting.py`)
+DEPTH = 100000
+SHALLOW_DEPTH = 10000
+RECURSION_LIMIT = 200  # frames available to the stages (on top of the frames of the caller)
+MAX_SLOWDOWN = 3  # quadratic stages would be about DEPTH / SHALLOW_DEPTH times slower per level
+TIME_LIMIT = 180  # seconds to render the deep page, far above the time it takes (to not fail on slow machines)
+
+
+def stack_depth():
+    frame, depth = sys._getframe(1), 0
+    while frame:
+        frame, depth = frame.f_back, depth + 1
+    return depth
+
+
+def render(html: str):
+    # Renders the page with the recursion limit (a RecursionError fails the test), returns the time it took
+    # and the lines of the printed render tree
+    pygame.init()
+    win = pygame.Surface((1000, 600))
+    cssom = user_agent.load_user_agent_cssom().layer()
+    default_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(stack_depth() + RECURSION_LIMIT)
+    try:
+        start = time.perf_counter()
+        dom = html_parser.parse(html)
+        attachment.attach_styles(dom, cssom)
+        render_tree = renderer.construct_render_tree(dom)
+        layout.construct_layout(render_tree, 1000, 600)
+        paint.paint_layout(win, render_tree)
+        tree = io.StringIO()
+        utils.print_tree(render_tree, tree)
+        duration = time.perf_counter() - start
+    finally:
+        sys.setrecursionlimit(default_limit)
+    return duration, tree.getvalue().splitlines()
+
+
+def check_deep_nesting(tag: str):
+    shallow_duration, _ = render(generate_deep_html(SHALLOW_DEPTH, tag))
+    duration, lines = render(generate_deep_html(DEPTH, tag))
+    # every level is printed (a line for its render object, at least)
+    assert len(lines) >= DEPTH, f'{len(lines)} lines printed for {DEPTH} levels'
+    assert duration < TIME_LIMIT, f'{DEPTH} nested {tag} rendered in {duration:.1f} s'
+    slowdown = (duration / DEPTH) / (shallow_duration / SHALLOW_DEPTH)
+    assert slowdown < MAX_SLOWDOWN, \
+        f'{DEPTH} nested {tag} took {slowdown:.1f} times longer per level than {SHALLOW_DEPTH} nested {tag}'
+
+
+def test_deep_spans():
+    check_deep_nesting('span')
+
+
+def test_deep_divs():
+    check_deep_nesting('div')
+
+
+if __name__ == '__main__':
+    test_deep_spans()
+    test_deep_divs()
+    print('ok')
@@ -2,11 +2,14 @@ from __future__ import annotations
 from pygame.font import SysFont, init
 from collections import namedtuple
 from typing import List, Union
-from itertools import chain
+from math import ceil
+from array import array
+from bisect import bisect_right
 
 import re
 
-from render_object import RenderText, RenderObject, RenderChildren, RenderBlock, RenderInline
+from render_object import RenderText, RenderBlock, RenderInline, NO_OBJECT
+import font_metrics
 
 # Default fonts
 # TODO: could be moved to a configuration file
@@ -14,6 +17,9 @@ FONT = 'verdana'
 FONT_BOLD = 'verdanabold'
 FONT_ITALIC = 'verdanaitalic'
 FONT_BOLD_ITALIC = 'verdanabolditalic'
+# Font by (font_weight, font_style)
+FONT_NAMES = {('normal', 'normal'): FONT, ('bold', 'normal'): FONT_BOLD,
+              ('normal', 'italic'): FONT_ITALIC, ('bold', 'italic'): FONT_BOLD_ITALIC}
 
 # List of supported font sizes
 # in case user chooses a font_size outside it, the closest one is used instead
@@ -44,67 +50,239 @@ def initialize_fonts():
 # Get font is used to get the closest supported font
 get_font = initialize_fonts()
 
+# pygame font to its metric tables, when word widths are computed from the tables (instead of `font.size`)
+font_metrics_tables = None
 
-# WordObject, LineObject and RenderLines will be utilized during the layout and painting phases
-# They are also render objects, they are used to handle texts
+
+def use_font_metrics(validate=False):
+    # Word widths are computed by summing the advance widths of their characters from font metric tables,
+    # which can differ slightly from `font.size`, with `validate` the differences are recorded (see `font_metrics.py`)
+    global font_metrics_tables
+    fonts = {}
+    for font_size in SUPPORTED_FONT_SIZES:
+        for (font_weight, font_style), font_name in FONT_NAMES.items():
+            key = font_metrics.font_key(FontType(font_size, font_weight, font_style), font_name)
+            fonts[key] = get_font(font_size, font_weight, font_style)
+    font_metrics_tables = font_metrics.load_font_metrics(fonts)
+    font_metrics.validate = validate
+
+
+# TextRun, LineObject and RenderLines will be utilized during the layout and painting phases
+# They are used like render objects to handle texts
 # And are utilized in Layout phase in place of RenderInline and RenderTexts
+# Note: they are not part of the render arena, as they are constructed again on every layout
+
+# Words of a text, ie, non white space characters followed by (at most) a white space character
+# Input: 'Hello world! How are you?'
+# Output: ['Hello ', 'world! ', 'How ', 'are ', 'you?']
+WORD_REGEX = re.compile(r'\S*\s|\S+\Z')
+MAX_WORD_SIZE = 0xFFFF  # word sizes are stored as unsigned shorts, larger words are clamped (they overflow anyway)
+
+
+class TextRun:
+    # TextRun represents consecutive words of a line from the same render text (ie, with the same style)
+    # words are measured one by one for line breaking, but a run is rendered (and blitted) at once
+    # Note: it is a view of a run stored in RenderLines, created on access, its text is sliced when needed
+    __slots__ = ('lines', 'index')
+
+    def __init__(self, lines: RenderLines, index: int):
+        self.lines = lines
+        self.index = index
+
+    @property
+    def text_object(self) -> RenderText:  # render text it's part of
+        return self.lines.text_objects[self.lines.run_texts[self.index]]
+
+    @property
+    def font(self):  # the pygame font used while painting
+        return self.lines.font(self.lines.run_texts[self.index])
+
+    @property
+    def start(self):  # index of the first word (within the render lines)
+        return self.lines.run_starts[self.index]
+
+    @property
+    def end(self):  # index after the last word
+        return self.lines.run_starts[self.index + 1]
+
+    @property
+    def text(self):
+        return self.lines.slice_words(self.lines.run_texts[self.index], self.start, self.end)
+
+    @property
+    def offset(self):  # horizontal offset within the line
+        return self.lines.run_offsets[self.index]
+
+    @property
+    def width(self):
+        return self.lines.run_widths[self.index]
+
+    @property
+    def height(self):
+        return self.lines.run_heights[self.index]
+
+    @property
+    def num_words(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f'TextRun({self.text!r}, offset={self.offset}, size=({self.width}, {self.height}))'
 
-class WordObject(RenderObject):
-    # WordObject represents a word withing a render text
-    def __init__(self, word: str, ro: RenderText):
-        # Keep track of the word and render text it's part of
-        self.word = word
-        self.text_object = ro
-        font = get_font(ro.font_size, ro.font_weight, ro.font_style)
-        self.font = font  # get the pygame font, will be used later why painting
-        self.size = font.size(word)  # Compute the layout space it occupies
+
+class WordObject:
+    # WordObject represents a word within a render text (eg, the word under the cursor, see `hit_test.py`)
+    # Note: it is a view of a word stored in RenderLines, created on access
+    __slots__ = ('lines', 'index')
+
+    def __init__(self, lines: RenderLines, index: int):
+        self.lines = lines
+        self.index = index
+
+    @property
+    def text_index(self):  # index of the render text it's part of
+        return bisect_right(self.lines.text_starts, self.index) - 1
+
+    @property
+    def text_object(self) -> RenderText:
+        return self.lines.text_objects[self.text_index]
+
+    @property
+    def font(self):
+        return self.lines.font(self.text_index)
+
+    @property
+    def word(self):
+        return self.lines.slice_words(self.text_index, self.index, self.index + 1)
 
     @property
     def width(self):
-        return self.size[0]
+        return self.lines.word_widths[self.index]
 
     @property
     def height(self):
-        return self.size[1]
+        return self.lines.word_heights[self.index]
 
     def __repr__(self):
-        return f'WordObject({self.word!r}, size={self.size})'
+        return f'WordObject({self.word!r}, size=({self.width}, {self.height}))'
 
 
-class LineObject(RenderChildren):
-    # LineObject is a list of WordObjects that will be rendered on the same line
-    children: List[WordObject]
+class LineObject:
+    # LineObject is a list of TextRuns that will be rendered on the same line
+    # Note: it is a view of a line stored in RenderLines, created on access
+    __slots__ = ('lines', 'index')
 
-    def __init__(self):
-        RenderChildren.__init__(self)
+    def __init__(self, lines: RenderLines, index: int):
+        self.lines = lines
+        self.index = index
+
+    @property
+    def children(self) -> List[TextRun]:
+        line_starts = self.lines.line_starts
+        return [TextRun(self.lines, run) for run in range(line_starts[self.index], line_starts[self.index + 1])]
 
     @property
-    def width(self):  # Width needed by the line - sum of all word widths
-        return sum(wo.width for wo in self.children)
+    def width(self):  # Width needed by the line - sum of all run widths
+        return sum(run.width for run in self.children)
 
     @property
-    def height(self):  # Height of the line - max of all word heights
-        return max(wo.height for wo in self.children)
+    def height(self):  # Height of the line - max of all run heights
+        return self.lines.line_heights[self.index]
 
     def __str__(self):
-        words = ', '.join(map(str, self.children))
-        return f'LineObject({words})'
+        runs = ', '.join(map(repr, self.children))
+        return f'LineObject({runs})'
 
     def __repr__(self):
-        return f'LineObject(num_words={len(self.children)})'
+        return f'LineObject(num_words={self.num_words})'
 
     @property
     def num_words(self):
-        return len(self.children)
+        return sum(run.num_words for run in self.children)
 
 
-class RenderLines(RenderChildren):
+class RenderLines:
     # RenderLines is a list of all RenderLines resulting from children of a
     # RenderBlock whose descendants are all inline or text objects
-    children: List[LineObject]
+    # Words, runs and lines are stored as columns (arrays), so there are no objects for them
+    # words are sliced from the text of the render texts, and runs and lines are views, when needed (eg, while painting)
+    def __init__(self, text_objects: List[RenderText]):
+        self.text_objects = text_objects
+        # words of all the render texts in order, the end offset of a word is within the text of its render text
+        self.text_starts = array('I', [0])  # index of the first word of each render text (and the number of words)
+        self.word_ends = array('I')
+        self.word_widths = array('H')
+        self.word_heights = array('H')
+        # runs (words from start of the run till start of the next run) and lines (runs from start of the line
+        # till start of the next line), with the number of words (and runs) at the end
+        self.run_texts = array('I')  # index of the render text of each run
+        self.run_starts = array('I')
+        self.run_offsets = array('I')
+        self.run_widths = array('I')
+        self.run_heights = array('H')
+        self.line_starts = array('I')
+        self.line_heights = array('H')
+
+    def add_words(self, text: str, font):
+        # Splits the text (of the next render text) into words, and measures them in its font
+        word_ends, word_widths, word_heights = self.word_ends, self.word_widths, self.word_heights
+        if font_metrics_tables is not None:  # measured a chunk at a time, so long texts need no lists of all words
+            for ends, widths, heights in font_metrics_tables[font].iter_measure(text):
+                word_ends.extend(ends)
+                word_widths.extend([width if width < MAX_WORD_SIZE else MAX_WORD_SIZE for width in widths])
+                word_heights.extend([height if height < MAX_WORD_SIZE else MAX_WORD_SIZE for height in heights])
+            self.text_starts.append(len(word_ends))
+            return
+        start = 0
+        for match in WORD_REGEX.finditer(text):
+            end = match.end()
+            width, height = font.size(text[start:end])
+            word_ends.append(end)
+            word_widths.append(width if width < MAX_WORD_SIZE else MAX_WORD_SIZE)
+            word_heights.append(height if height < MAX_WORD_SIZE else MAX_WORD_SIZE)
+            start = end
+        self.text_starts.append(len(word_ends))
+
+    def with_text_objects(self, text_objects: List[RenderText]) -> RenderLines:
+        # Same words, runs and lines for other render texts (with the same texts and fonts)
+        # Note: the arrays are shared, they are not changed once the lines are constructed
+        lines_object = RenderLines.__new__(RenderLines)  # shallow copy (quicker than `copy`)
+        lines_object.__dict__.update(self.__dict__)
+        lines_object.text_objects = text_objects
+        return lines_object
+
+    def font(self, text_index: int):
+        # font of the render text at text_index
+        text_object = self.text_objects[text_index]
+        return get_font(text_object.font_size, text_object.font_weight, text_object.font_style)
+
+    def iter_runs(self):
+        # Yields (line_offset, line_height, text_index, text, offset, height) of each run, reading the columns directly
+        # (vertical offset of its line, and horizontal offset within the line)
+        line_starts, line_heights = self.line_starts, self.line_heights
+        run_texts, run_starts, run_offsets, run_heights = self.run_texts, self.run_starts, self.run_offsets, self.run_heights
+        line_offset = 0
+        for line in range(len(line_heights)):
+            line_height = line_heights[line]
+            for run in range(line_starts[line], line_starts[line + 1]):
+                yield (line_offset, line_height, run_texts[run],
+                       self.slice_words(run_texts[run], run_starts[run], run_starts[run + 1]),
+                       run_offsets[run], run_heights[run])
+            line_offset += line_height
+
+    def slice_words(self, text_index: int, start: int, end: int):
+        # text of the words from index `start` till `end` (exclusive) of the render text at text_index
+        text = self.text_objects[text_index].node.text
+        return text[self.word_ends[start - 1] if start > self.text_starts[text_index] else 0:self.word_ends[end - 1]]
+
+    def words(self, text_object: RenderText) -> List[str]:
+        # words of the render text
+        text_index = self.text_objects.index(text_object)
+        return [self.slice_words(text_index, index, index + 1)
+                for index in range(self.text_starts[text_index], self.text_starts[text_index + 1])]
 
-    def __init__(self):
-        RenderChildren.__init__(self)
+    @property
+    def children(self) -> List[LineObject]:
+        return [LineObject(self, line) for line in range(self.num_lines)]
 
     @property
     def width(self):  # Width is max of all lines widths
@@ -112,15 +290,15 @@ class RenderLines(RenderChildren):
 
     @property
     def height(self):  # height is sum of all line heights
-        return sum(lo.height for lo in self.children)
+        return sum(self.line_heights)
 
     @property
     def num_lines(self):
-        return len(self.children)
+        return len(self.line_heights)
 
     @property
     def num_words(self):
-        return sum(lo.num_words for lo in self.children)
+        return len(self.word_ends)
 
     def __str__(self):
         lines = ', '.join(map(str, self.children))
@@ -130,63 +308,116 @@ class RenderLines(RenderChildren):
         return f'RenderLines(num_lines={self.num_lines},num_words={self.num_words},size=({self.width},{self.height}))'
 
 
-def compute_word_objects(text_object: RenderText):
-    # Takes RenderText and constructs word objects from the it's text
-
-    # Splits the text within into words
-    # Input: 'Hello world! How are you?'
-    # Output: ['Hello ', 'world! ', 'How ', 'are ', 'you?']
-    words = list(filter(lambda _: _, re.split(r'(?<=\s)', text_object.node.text)))
-    # Construct word objects from those words
-    text_object.words = [WordObject(word, text_object) for word in words]
-    return text_object.words
-
-
-def construct_lines_object(word_objects: List[WordObject], available_width: int):
+def construct_lines_object(text_objects: List[RenderText], available_width: int):
+    lines_object = RenderLines(text_objects)
+    fonts = [get_font(text_object.font_size, text_object.font_weight, text_object.font_style)
+             for text_object in text_objects]
+    for text_object, font in zip(text_objects, fonts):
+        lines_object.add_words(text_object.node.text, font)
+    word_widths, word_heights, text_starts = lines_object.word_widths, lines_object.word_heights, lines_object.text_starts
+    run_texts, run_starts, run_heights = lines_object.run_texts, lines_object.run_starts, lines_object.run_heights
+    line_starts, line_heights = lines_object.line_starts, lines_object.line_heights
     # If some word is greater than available width, we'll use that as the width
-    width = max(available_width, max(wo.width for wo in word_objects))
-    lines_object = RenderLines()
-    line_object = None
-    for wo in word_objects:
-        if line_object and line_object.width + wo.width <= width:
+    width = max(available_width, max(word_widths, default=0))
+    line_width = None  # width of the current line (None till the first line)
+    for text_index in range(len(text_objects)):
+        run_start = None  # words of a render text on the same line are added to the same run
+        for index in range(text_starts[text_index], text_starts[text_index + 1]):
+            word_width, word_height = word_widths[index], word_heights[index]
+            if line_width is None or line_width + word_width > width:
+                # If line doesn't exist or can't be accommodated
+                # Create a new line starting with that word
+                line_width, run_start = 0, None
+                line_starts.append(len(run_starts))
+                line_heights.append(0)
             # If word can be accommodated in existing line
-            line_object.add_child(wo)
-        else:
-            # If line doesn't exist or can't be accommodated
-            # Create a new line with that word
-            line_object = LineObject()
-            line_object.add_child(wo)
-            lines_object.add_child(line_object)
+            if run_start is None:
+                run_start = index
+                run_texts.append(text_index)
+                run_starts.append(index)
+                run_heights.append(0)
+            if word_height > run_heights[-1]:
+                run_heights[-1] = word_height
+                if word_height > line_heights[-1]:
+                    line_heights[-1] = word_height
+            line_width += word_width
+    run_starts.append(len(word_widths))
+    line_starts.append(len(run_texts))
+
+    # Lines are broken on widths of words, but a run is (slightly) wider than the sum of widths of its words
+    # (as glyph advances are rounded for each word), so runs are placed one after the other by their own width
+    # With the font metric tables, the width of a run is the sum of the advances of its characters, ie, the sum of
+    # widths of its words (words with characters outside the tables were measured with `font.size`)
+    tables = [font_metrics_tables[font] for font in fonts] if font_metrics_tables is not None else None
+    for line in range(lines_object.num_lines):
+        offset = 0
+        for run in range(line_starts[line], line_starts[line + 1]):
+            if tables is None:
+                run_width = fonts[run_texts[run]].size(
+                    lines_object.slice_words(run_texts[run], run_starts[run], run_starts[run + 1]))[0]
+            else:
+                run_width = sum(word_widths[run_starts[run]:run_starts[run + 1]])
+                if font_metrics.validate:
+                    tables[run_texts[run]].validate_run(
+                        lines_object.slice_words(run_texts[run], run_starts[run], run_starts[run + 1]), run_width)
+            lines_object.run_offsets.append(offset)
+            lines_object.run_widths.append(run_width)
+            offset += run_width
     return lines_object
 
 
+def get_text_objects(ro: Union[RenderBlock, RenderInline]):
+    # Obtain the text objects within the given block or inline object (in order)
+    # Note: descendants are walked by id in the render arena, so deeply nested inline objects need no recursion
+    # and views are only created for the text objects
+    arena, root, t_objects = ro.arena, ro.id, []
+    types = arena.types
+    child = arena.first_child[root]
+    while child != NO_OBJECT:
+        if types[child] is RenderText:
+            t_objects.append(arena.view(child))
+        else:
+            assert types[child] is RenderInline
+        child = arena.next_in_subtree(child, root)
+    return t_objects
+
+
+def has_inline_children(block_object: RenderBlock):
+    # Whether the block has children, all of them inline or text objects (looked up by id in the render arena)
+    arena = block_object.arena
+    return arena.first_child[block_object.id] != NO_OBJECT and \
+        all(arena.types[child] is not RenderBlock for child in arena.children(block_object.id))
+
+
 def construct_render_lines(block_object: RenderBlock, available_width: int):
     # expects a block object whose child are all inline or text objects
-    # Constructs a RenderLines object, with the words populated from the RenderText descendants
+    # Constructs a RenderLines object, with runs of words from the RenderText descendants
     # How many word can be accommodated in a given line is determined by the available width
     # however if available_width is less than max word width, then later is preferred
 
     # all it's descents must be inline or text objects, though condition only checks for its children
-    assert block_object.children and \
-           all(not isinstance(child_ro, RenderBlock) for child_ro in block_object.children)
-
-    def get_text_objects(ro: Union[RenderBlock, RenderInline]):
-        # Recursively obtain the text objects within the given inline object
-        t_objects = []
-        for child_ro in ro.children:
-            if isinstance(child_ro, RenderText):
-                t_objects.append(child_ro)
-            else:
-                assert isinstance(child_ro, RenderInline)
-                t_objects.extend(get_text_objects(child_ro))
-        return t_objects
-
-    text_objects = get_text_objects(block_object)
+    assert has_inline_children(block_object)
 
-    # Aggregate words from each of the text objects
-    word_objects = list(chain.from_iterable(compute_word_objects(text_object) for text_object in text_objects))
-
-    # Construct render lines object from the word objects based on available width
+    # Construct render lines object from the words of the text objects based on available width
     # Note: all words needs to passed at one go to construct the render lines objects
-    block_object.lines_object = construct_lines_object(word_objects, available_width)
+    block_object.lines_object = construct_lines_object(get_text_objects(block_object), available_width)
     return block_object.lines_object
+
+
+# Text used to compute the average width of characters of a font
+AVERAGE_TEXT = 'the quick brown fox jumps over the lazy dog THE QUICK BROWN FOX JUMPS OVER THE LAZY DOG 0123456789,.'
+_average_character_widths = {}  # font to average width of its characters
+
+
+def estimate_lines_height(block_object: RenderBlock, available_width: int):
+    # Estimates the height of the lines of the block without measuring words or breaking lines
+    # ie, number of lines (from the number of characters and average character widths) times the line height
+    assert has_inline_children(block_object)
+    text_width, line_height = 0, 0
+    for text_object in get_text_objects(block_object):
+        font = get_font(text_object.font_size, text_object.font_weight, text_object.font_style)
+        if font not in _average_character_widths:
+            _average_character_widths[font] = font.size(AVERAGE_TEXT)[0] / len(AVERAGE_TEXT)
+        text_width += len(text_object.node.text) * _average_character_widths[font]
+        line_height = max(line_height, font.get_height())
+    return ceil(text_width / max(available_width, 1)) * line_height
@@ -0,0 +1,46 @@
+from typing import Iterator, List
+
+# Items (eg, blocks of the display list, by their index) indexed by their vertical extent in a grid of rows of tiles
+# whose height grows by `TILE_GROWTH` for each level, an item is added to the first level where it spans at most two
+# tiles. So each item is in at most two tiles, and a point (or a range) is only looked up in its tiles of each level
+# (tall items like body are in the few tiles of the higher levels)
+# Used by paint (blocks overlapping the viewport, see `paint.BlockTiles`) and hit testing (see `hit_test.py`)
+TILE_HEIGHT = 128
+TILE_GROWTH = 4
+
+
+class TileIndex:
+    def __init__(self):
+        self.levels = []  # tile to the items in the tile (in the order they were added), for each level
+
+    def add(self, item: int, top: int, bottom: int):
+        # Adds the item spanning from top to bottom (exclusive, empty items are added to the tile of their top)
+        bottom = max(bottom, top + 1) - 1
+        level, tile_height = 0, TILE_HEIGHT
+        while bottom // tile_height - top // tile_height > 1:
+            level, tile_height = level + 1, tile_height * TILE_GROWTH
+        while len(self.levels) <= level:
+            self.levels.append({})
+        tiles = self.levels[level]
+        for tile in range(top // tile_height, bottom // tile_height + 1):
+            if tile in tiles:
+                tiles[tile].append(item)
+            else:
+                tiles[tile] = [item]
+
+    def at(self, y: int) -> Iterator[List[int]]:
+        # Items of the tile containing y, for each level (they may not contain the point)
+        tile_height = TILE_HEIGHT
+        for tiles in self.levels:
+            yield tiles.get(y // tile_height, ())
+            tile_height *= TILE_GROWTH
+
+    def find(self, top: int, bottom: int) -> set:
+        # Items of the tiles overlapping top to bottom (exclusive), ie, the items which may overlap it
+        items = set()
+        tile_height = TILE_HEIGHT
+        for tiles in self.levels:
+            for tile in range(top // tile_height, (bottom - 1) // tile_height + 1):
+                items.update(tiles.get(tile, ()))
+            tile_height *= TILE_GROWTH
+        return items
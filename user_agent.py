@@ -0,0 +1,55 @@
+import os
+import pickle
+import css_parser
+from css_parser import CSSOM
+
+# Browser (default) styles
+USER_AGENT_STYLESHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.css')
+# Compiled user agent stylesheets are cached next to the compiled python modules
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+
+# Compiled CSSOMs already loaded in this process, by stylesheet path
+_compiled_cssoms = {}
+
+
+def cache_key(style_sheet: str):
+    # The cache is invalidated when either the stylesheet or the css parser changes
+    stat, parser_stat = os.stat(style_sheet), os.stat(css_parser.__file__)
+    return stat.st_mtime_ns, stat.st_size, parser_stat.st_mtime_ns, parser_stat.st_size
+
+
+def compile_stylesheet(style_sheet: str):
+    # Parses the stylesheet into a frozen CSSOM
+    with open(style_sheet) as f_css:
+        return css_parser.parse(f_css.read()).freeze()
+
+
+def load_user_agent_cssom(style_sheet: str = USER_AGENT_STYLESHEET):
+    # Returns the frozen CSSOM of the user agent stylesheet, which is parsed only when it is not
+    # already loaded in this process or cached on disk (or if it has changed since then).
+    # Pages layer their own rules over it with `CSSOM.layer`.
+    key = cache_key(style_sheet)
+    if style_sheet in _compiled_cssoms and _compiled_cssoms[style_sheet][0] == key:
+        return _compiled_cssoms[style_sheet][1]
+
+    cache_file = os.path.join(CACHE_DIRECTORY, os.path.basename(style_sheet) + '.pickle')
+    cssom = None
+    try:
+        with open(cache_file, 'rb') as f_cache:
+            cached_key, cached_cssom = pickle.load(f_cache)
+        if cached_key == key and isinstance(cached_cssom, CSSOM):
+            cssom = cached_cssom
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+        pass  # missing or stale cache, compile it again
+
+    if cssom is None:
+        cssom = compile_stylesheet(style_sheet)
+        try:
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            with open(cache_file, 'wb') as f_cache:
+                pickle.dump((key, cssom), f_cache, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass  # caching is an optimization, not being able to write it is fine
+
+    _compiled_cssoms[style_sheet] = key, cssom
+    return cssom
@@ -1,5 +1,16 @@
+import re
+from collections import namedtuple
+from typing import List
+
 from css_properties import *
 
+# Long texts are processed a chunk at a time (eg, spaced while tokenizing, measured while laying out), so the memory
+# needed is proportional to a chunk (and to the result) instead of copies of the whole text and lists of its words
+# Chunks are cut after a white space, so words are not split across chunks
+CHUNK_SIZE = 1 << 16
+WHITE_SPACE = re.compile(r'\s')
+WHITE_SPACE_BYTES = re.compile(rb'\s')
+
 
 def get_line_no(text: str, index: int):
     # Returns the line and column number of the given index.
@@ -10,27 +21,73 @@ def get_line_no(text: str, index: int):
     return lines, len(last_line)
 
 
-def print_tree(root):
-    # Recursively prints a tree structure,
-    # uses `str` function to print the node
+def count_newlines(text, start: int, end: int):
+    # Number of newlines in text[start:end], text is either a string or a bytes-like buffer (eg, memory map)
+    if isinstance(text, str):
+        return text.count('\n', start, end)
+    # memory maps cannot count, the span is copied a chunk at a time
+    return sum(text[chunk:min(chunk + CHUNK_SIZE, end)].count(b'\n') for chunk in range(start, end, CHUNK_SIZE))
+
+
+def rfind_newline(text, start: int, end: int):
+    # Index of the last newline in text[start:end] (-1 if none), text is either a string or a bytes-like buffer
+    return text.rfind('\n' if isinstance(text, str) else b'\n', start, end)
+
+
+def iter_chunks(text, start=0, end=None, size=CHUNK_SIZE):
+    # Yields (start, end) of the chunks of text[start:end], each one (but the last) is at least `size` characters
+    # long and ends with a white space, text is either a string or a bytes-like buffer
+    end = len(text) if end is None else end
+    white_space = WHITE_SPACE if isinstance(text, str) else WHITE_SPACE_BYTES
+    while end - start > size:
+        match = white_space.search(text, start + size, end)
+        if match is None:  # rest of the text is a single word
+            break
+        yield start, match.end()
+        start = match.end()
+    if start < end:
+        yield start, end
+
+
+def decode(value):
+    # Tokens matched on bytes-like buffers (eg, memory maps) are decoded to strings
+    return value if isinstance(value, str) else value.decode(errors='replace')
+
+
+# Deeper nodes are printed with the indentation of this depth (and their depth), so that lines don't keep growing
+MAX_PRINT_DEPTH = 64
+
+
+def format_tree(root):
+    # Yields the lines of a tree structure (iteratively, so deep trees don't need recursion),
+    # uses `str` function to format the node, and nodes are formatted only as the lines are consumed
     # expects the node to have `children` attribute
-    def __print(node, prefix='|', last=True):
+    nodes = [(root, '|', True, 0)]  # (node, prefix, is last child, depth) yet to be formatted
+    while nodes:
+        node, prefix, last, depth = nodes.pop()
         current_prefix = prefix
         if last:
             prefix = prefix[:-1] + ' '
             current_prefix = prefix[:-1] + '`'
-        print(f'{current_prefix}---{str(node)}')
+        if depth > MAX_PRINT_DEPTH:
+            yield f'{current_prefix}---({depth}) {str(node)}'
+        else:
+            yield f'{current_prefix}---{str(node)}'
         try:
-            for child in node.children:
-                if node.children[-1] == child:
-                    __print(child, prefix + '\t|', True)
-                else:
-                    __print(child, prefix + '\t|', False)
+            children = list(node.children)
         except AttributeError:
             # When node has no children
-            pass
+            continue
+        if depth < MAX_PRINT_DEPTH:
+            prefix += '\t|'
+        for index in reversed(range(len(children))):
+            nodes.append((children[index], prefix, index == len(children) - 1, depth + 1))
+
 
-    __print(root)
+def print_tree(root, file=None):
+    # Prints a tree structure (see `format_tree`)
+    for line in format_tree(root):
+        print(line, file=file)
 
 
 def format_styles(styles: dict):
@@ -46,3 +103,37 @@ def format_styles(styles: dict):
         f'position: {styles[POSITION]} {styles[TOP]} {styles[RIGHT]} {styles[BOTTOM]} {styles[LEFT]}, '\
         f'font: {styles[FONT_SIZE]} {styles[FONT_WEIGHT]} {styles[FONT_STYLE]}, ' \
         f'color: {styles[COLOR]} {styles[BACKGROUND_COLOR]}'
+
+
+# Errors recovered from while parsing (eg, stray or missing end tags of html, invalid declarations of css), only the
+# first few are kept so broken (or crafted) pages with lots of errors cost no more than the errors they keep
+# Note: tag is the tag of html errors, and the offending text of css errors
+MAX_DIAGNOSTICS = 100
+MAX_DIAGNOSTIC_TEXT = 100  # longer tags (and texts) are cut
+Diagnostic = namedtuple('Diagnostic', ['message', 'tag', 'line', 'column'])
+
+
+class Diagnostics:
+    # Diagnostics of a page (or its stylesheets), the ones beyond the limit are only counted
+    def __init__(self, limit=MAX_DIAGNOSTICS):
+        self.limit = limit
+        self.entries: List[Diagnostic] = []
+        self.count = 0  # including the dropped ones
+
+    def report(self, message: str, token):
+        # token is a token of either tokenizer (value, line and column)
+        self.count += 1
+        if len(self.entries) < self.limit:
+            self.entries.append(Diagnostic(message, token.value[:MAX_DIAGNOSTIC_TEXT], token.line, token.column))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __str__(self):
+        lines = [f'{message} `{tag}` at line {line} and column {column}' for message, tag, line, column in self.entries]
+        if self.count > len(self.entries):
+            lines.append(f'... and {self.count - len(self.entries)} more')
+        return '\n'.join(lines)
@@ -0,0 +1,221 @@
+from __future__ import annotations
+from operator import itemgetter
+import numpy as np
+
+from render_object import RenderBlock
+from css_properties import *
+from text_layout import construct_render_lines
+from box_model import BoxModel
+
+# Optional NumPy backed layout, computes the same layout as `layout.construct_layout`
+# Box model properties of all the blocks are stored in flat arrays indexed by block id (pre-order index),
+# and are computed level by level (widths, top-down) and bottom-up (heights) as batched array operations
+
+BOX_PROPERTIES = [
+    ('margin_top', MARGIN_TOP), ('margin_right', MARGIN_RIGHT),
+    ('margin_bottom', MARGIN_BOTTOM), ('margin_left', MARGIN_LEFT),
+    ('padding_top', PADDING_TOP), ('padding_right', PADDING_RIGHT),
+    ('padding_bottom', PADDING_BOTTOM), ('padding_left', PADDING_LEFT),
+    ('border_top', BORDER_TOP), ('border_right', BORDER_RIGHT),
+    ('border_bottom', BORDER_BOTTOM), ('border_left', BORDER_LEFT),
+]
+# Properties which can also be `auto`
+AUTO_PROPERTIES = [WIDTH, HEIGHT, TOP, LEFT, BOTTOM, RIGHT]
+LENGTH_PROPERTIES = [prop for _, prop in BOX_PROPERTIES] + AUTO_PROPERTIES
+# Styles used in layout, blocks with the same values share the parsed values
+get_layout_styles = itemgetter(*LENGTH_PROPERTIES, POSITION)
+
+_parsed_lengths = {}  # css value to (pixels, percent, is_auto)
+
+
+def parse_length(css_value: str):
+    # Length is resolved as `pixels + available * percent // 100`, and is 0 when `auto`
+    if css_value not in _parsed_lengths:
+        if css_value == 'auto':
+            _parsed_lengths[css_value] = 0, 0, True
+        elif css_value.endswith('px'):
+            _parsed_lengths[css_value] = int(css_value[:-2]), 0, False
+        elif css_value.endswith('%'):
+            _parsed_lengths[css_value] = 0, int(css_value[:-1]), False
+        else:
+            raise Exception(f'Unknown width format {css_value!r}')
+    return _parsed_lengths[css_value]
+
+
+class Lengths:
+    # Specified value of a css property of all the blocks
+    def __init__(self, pixels, percent, auto):
+        self.pixels, self.percent, self.auto = pixels, percent, auto
+
+    def resolve(self, available, index=slice(None)):
+        # Computed value (in pixels) for the blocks at `index` given their available width (or height)
+        return self.pixels[index] + available * self.percent[index] // 100
+
+
+class BlockArrays:
+    # Struct of arrays of the render blocks of a render tree, indexed by block id (pre-order)
+    def __init__(self, root_ro: RenderBlock):
+        self.blocks = []  # block id to render block
+        parents, depths = [], []
+        render_blocks = [(root_ro, -1, 0)]
+        while render_blocks:  # pre-order depth first traversal
+            ro, parent, depth = render_blocks.pop()
+            block_id = len(self.blocks)
+            self.blocks.append(ro)
+            parents.append(parent)
+            depths.append(depth)
+            if parent >= 0 and self.blocks[parent].node.styles[HEIGHT] == 'auto' and \
+                    ro.node.styles[HEIGHT].endswith('%'):
+                # if parent's height is `auto`, and current blocks's height is in `percent`
+                # then blocks height is also resolved to `auto` (same as in scalar layout)
+                ro.node.styles[HEIGHT] = 'auto'
+            child_ro = ro.last_child
+            while isinstance(child_ro, RenderBlock):  # children are either all blocks or none
+                render_blocks.append((child_ro, block_id, depth + 1))
+                child_ro = child_ro.previous_sibling
+
+        self.size = len(self.blocks)
+        self.parent = np.array(parents, dtype=np.int64)
+        self.depth = np.array(depths, dtype=np.int64)
+        self.has_block_children = np.zeros(self.size, dtype=bool)
+        self.has_block_children[self.parent[1:]] = True
+        self.is_text = np.array([ro.first_child is not None for ro in self.blocks], dtype=bool) & ~self.has_block_children
+
+        # specified values, styles are parsed once for each distinct combination of values
+        distinct_styles = {}
+        style_ids = np.array([distinct_styles.setdefault(get_layout_styles(ro.node.styles), len(distinct_styles))
+                              for ro in self.blocks], dtype=np.int64)
+        distinct_styles = list(distinct_styles)
+        parsed = np.array([[parse_length(value) for value in styles[:-1]] for styles in distinct_styles],
+                          dtype=np.int64).reshape(len(distinct_styles), len(LENGTH_PROPERTIES), 3)[style_ids]
+        self.specified = {prop: Lengths(parsed[:, i, 0], parsed[:, i, 1], parsed[:, i, 2].astype(bool))
+                          for i, prop in enumerate(LENGTH_PROPERTIES)}
+        position = np.array([styles[-1] for styles in distinct_styles], dtype=object)[style_ids]
+        self.is_flow = (position == 'static') | (position == 'relative')
+        self.is_relative = position == 'relative'
+        self.is_out_of_flow = (position == 'absolute') | (position == 'fixed')
+
+        # computed values
+        self.computed = {name: np.zeros(self.size, dtype=np.int64) for name, _ in BOX_PROPERTIES}
+        self.content_width = np.zeros(self.size, dtype=np.int64)
+        self.content_height = np.zeros(self.size, dtype=np.int64)
+        self.relative_left = np.zeros(self.size, dtype=np.int64)
+        self.relative_top = np.zeros(self.size, dtype=np.int64)
+
+    def levels(self):
+        # block ids grouped by depth, from the root down
+        order = np.argsort(self.depth, kind='stable')
+        boundaries = np.flatnonzero(np.diff(self.depth[order])) + 1
+        return np.split(order, boundaries)
+
+    def box_size(self, index=slice(None)):
+        # box width and box height (including margins) of the blocks at `index`
+        c = self.computed
+        box_width = self.content_width[index] + c['margin_left'][index] + c['margin_right'][index] + \
+            c['padding_left'][index] + c['padding_right'][index] + c['border_left'][index] + c['border_right'][index]
+        box_height = self.content_height[index] + c['margin_top'][index] + c['margin_bottom'][index] + \
+            c['padding_top'][index] + c['padding_bottom'][index] + c['border_top'][index] + c['border_bottom'][index]
+        return box_width, box_height
+
+    def compute_properties(self, index, available_width, available_height):
+        # Box model properties that depend only on the available width and height (for blocks at `index`)
+        # Note most properties are dependent on available width (same as in scalar layout)
+        c = self.computed
+        for name, prop in BOX_PROPERTIES:
+            c[name][index] = self.specified[prop].resolve(available_width, index)
+        padding_width = c['padding_left'][index] + c['padding_right'][index]
+        border_width = c['border_left'][index] + c['border_right'][index]
+        margin_width = c['margin_left'][index] + c['margin_right'][index]
+        padding_height = c['padding_top'][index] + c['padding_bottom'][index]
+        border_height = c['border_top'][index] + c['border_bottom'][index]
+
+        # `width: auto` occupies the available width, otherwise width is the border-box width
+        width = self.specified[WIDTH]
+        self.content_width[index] = np.where(
+            width.auto[index], np.maximum(available_width - padding_width - border_width - margin_width, 0),
+            np.maximum(width.resolve(available_width, index) - border_width - padding_width, 0))
+        # `height: auto` needs height of children, computed later
+        height = self.specified[HEIGHT]
+        self.content_height[index] = np.where(
+            height.auto[index], 0,
+            np.maximum(height.resolve(available_height, index) - border_height - padding_height, 0))
+
+    def stack_children(self):
+        # relative position of each block within its parent, ie, sum of box heights of its
+        # previous static and relative positioned siblings (cumulative sums grouped by parent)
+        children = np.argsort(self.parent[1:], kind='stable') + 1  # siblings stay in order
+        _, box_height = self.box_size(children)
+        flow_height = box_height * self.is_flow[children]
+        preceding = np.cumsum(flow_height) - flow_height
+        parents = self.parent[children]
+        group_start = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+        group_sizes = np.diff(np.r_[group_start, len(children)])
+        self.relative_top[children] = preceding - np.repeat(preceding[group_start], group_sizes)
+        self.relative_left[children] = 0
+
+    def position_blocks(self):
+        # relative positions of positioned elements (relative to parent's content box)
+        index = np.flatnonzero((self.is_relative | self.is_out_of_flow) & (self.parent >= 0))
+        parent = self.parent[index]
+        parent_width, parent_height = self.content_width[parent], self.content_height[parent]
+        s = self.specified
+        top, left = s[TOP].resolve(parent_width, index), s[LEFT].resolve(parent_width, index)
+        bottom, right = s[BOTTOM].resolve(parent_width, index), s[RIGHT].resolve(parent_width, index)
+        box_width, box_height = self.box_size(index)
+        relative_top, relative_left = self.relative_top[index], self.relative_left[index]
+
+        # relative blocks move with respect to their current position (`auto` resolves to 0)
+        is_relative = self.is_relative[index]
+        moved_top = np.where(is_relative, relative_top + top - bottom, relative_top)
+        moved_left = np.where(is_relative, relative_left + left - right, relative_left)
+        # absolute and fixed blocks are placed within the parent, bottom and right have higher priority
+        out_of_flow = self.is_out_of_flow[index]
+        moved_top = np.where(out_of_flow & ~s[TOP].auto[index], top, moved_top)
+        moved_left = np.where(out_of_flow & ~s[LEFT].auto[index], left, moved_left)
+        moved_top = np.where(out_of_flow & ~s[BOTTOM].auto[index], parent_height - box_height - bottom, moved_top)
+        moved_left = np.where(out_of_flow & ~s[RIGHT].auto[index], parent_width - box_width - right, moved_left)
+        self.relative_top[index], self.relative_left[index] = moved_top, moved_left
+
+    def write_box_models(self):
+        # Sets the box model of each render block from the arrays
+        # Note: the columns are in the order of BoxModel's arguments
+        rows = np.stack([self.computed[name] for name, _ in BOX_PROPERTIES] + [
+            self.content_width, self.content_height, self.relative_left, self.relative_top], axis=1).tolist()
+        for ro, row in zip(self.blocks, rows):
+            ro.box_model = BoxModel(*row)
+
+
+def construct_layout(root_ro: RenderBlock, window_width: int, window_height: int):
+    assert root_ro.node.tag == 'html' and root_ro.position == 'relative'
+    arrays = BlockArrays(root_ro)
+    levels = arrays.levels()
+
+    # widths (and specified heights) top-down, the parent's are needed for the children
+    # Note: parent's content height is still 0 when it is `auto` (same as in scalar layout)
+    arrays.compute_properties(levels[0], window_width, window_height)
+    for level in levels[1:]:
+        parent = arrays.parent[level]
+        arrays.compute_properties(level, arrays.content_width[parent], arrays.content_height[parent])
+
+    # blocks containing only inline/text objects, height of `auto` is height of its lines
+    auto_height = arrays.specified[HEIGHT].auto
+    for block_id in np.flatnonzero(arrays.is_text).tolist():
+        ro = arrays.blocks[block_id]
+        lines_object = construct_render_lines(ro, int(arrays.content_width[block_id]))
+        if auto_height[block_id]:
+            arrays.content_height[block_id] = lines_object.height
+
+    # heights bottom-up, `auto` is the sum of heights of static and relative positioned children
+    for level in reversed(levels[1:]):
+        _, box_height = arrays.box_size(level)
+        children_height = np.bincount(arrays.parent[level], weights=box_height * arrays.is_flow[level],
+                                      minlength=arrays.size).astype(np.int64)
+        parents = np.unique(arrays.parent[level])
+        parents = parents[auto_height[parents]]
+        arrays.content_height[parents] = children_height[parents]
+
+    if arrays.size > 1:
+        arrays.stack_children()
+        arrays.position_blocks()
+    arrays.write_box_models()
+    return arrays